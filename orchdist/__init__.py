@@ -45,17 +45,57 @@ A python module for executing ``distutils`` commands in concurrency
 
 from distutils.dist import Distribution
 from distutils.cmd import Command
-from distutils.ccompiler import new_compiler
+from distutils.ccompiler import CCompiler, new_compiler, gen_preprocess_options
 from distutils.sysconfig import customize_compiler
-from concurrent.futures import ThreadPoolExecutor
+from distutils import log
+from distutils.errors import DistutilsExecError, CompileError, LibError, LinkError
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import asyncio
 from functools import partial
+import copy
+import hashlib
+import heapq
+import json
+import os
+import pickle
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import typing
+import urllib.error
+import urllib.request
+
+from . import adaptive
+from . import jobserver
+from . import remote
 
 
 class SequencifyFail(RuntimeError):
-    """internal exception -- fail to sequencify"""
-    pass
+    """raised when commands fail to sequencify -- they depend on each other
+
+    ``cycle`` is the list of commands forming the cycle, starting and ending
+    with the same command"""
+
+    def __init__(self, cycle):
+        super().__init__('recursive: ' + ' -> '.join(cycle))
+        self.cycle = cycle
+
+
+class CommandsFailed(RuntimeError):
+    """raised by ``OrchDistribution`` in ``keep_going`` mode when commands fail
+
+    ``errors`` is a list of ``(command, exception)`` in the order they failed.
+    ``skipped`` is the list of commands not run because they depend on them"""
+
+    def __init__(self, errors, skipped):
+        super().__init__('%d command(s) failed: %s' % (
+            len(errors), ', '.join(command for command, _ in errors)))
+        self.errors = errors
+        self.skipped = skipped
 
 
 class OrchDistribution(Distribution):
@@ -71,12 +111,214 @@ class OrchDistribution(Distribution):
         """
         keyword arguments:
           max_workers: specify the max number of workers to execute commands
+          build_db: filename of the database used to skip up-to-date ``BuildC`` targets
+          priority: dispatch ready commands with the longest path to a final command first
+          history_file: filename of the ``BuildHistory`` to load durations from and record runs to
+          executor: ``'thread'`` (default) or ``'process'``. the backend commands run in
+            unless their class sets ``executor``
+          fail_fast: on the first failure, cancel coroutine commands and terminate
+            the subprocesses spawned through ``spawn`` and ``spawn_async``
+          keep_going: on failures, still run every command that does not depend on a
+            failed one, then raise ``CommandsFailed``
+          artifact_cache: an ``ArtifactCache``, or a directory for a ``LocalArtifactCache``,
+            shared by ``Compile``, ``StaticLink`` and ``Link`` across checkouts
+          remote_workers: list of ``'host:port'`` of ``orchdist.remote`` workers, or a
+            ``RemoteExecutor``, to compile translation units of ``Compile`` on
+          jobserver: by default, the GNU make jobserver in ``MAKEFLAGS``, if any, is
+            joined and a token taken for every command run besides the first one.
+            ``'pipe'`` or ``'fifo'`` also serves a jobserver of ``max_workers`` jobs
+            to spawned sub builds when there is none to join. False disables it
+          resources: dict maps the name of a resource commands declare in their
+            ``resources`` to its capacity, e.g. ``{'link': 2, 'memory': 16 << 30}``.
+            ``'slots'`` is limited by ``max_workers``, ``'memory'`` (bytes) by the
+            physical memory if not given, others are unlimited if not given
+          adaptive: True, a dict of keyword arguments of ``AdaptiveLimit`` or an
+            ``AdaptiveLimit``, to run fewer commands at a time than ``max_workers``
+            while the host is loaded by other jobs. see ``orchdist.adaptive``
+          listeners: list of ``BuildListener`` told about the progress of builds,
+            e.g. ``orchdist.progress.ProgressReporter``
+          pipeline_memory: bytes of preprocessed sources ``Preprocess`` commands with
+            ``in_memory`` set may hold at a time, 256 MiB by default. beyond it they
+            are written to ``output_file``
+
+        by default, no more commands are dispatched after a failure and the first
+        exception is raised once the running commands have finished
         """
-        self.max_workers = kwargs.get('max_workers')
-        if 'max_workers' in kwargs:
-            del kwargs['max_workers']
+        self.max_workers = kwargs.pop('max_workers', None)
+        self.build_db = kwargs.pop('build_db', None)
+        if self.build_db is not None:
+            self.build_db = BuildDatabase(self.build_db)
+        self.priority = kwargs.pop('priority', False)
+        self.history = kwargs.pop('history_file', None)
+        if self.history is not None:
+            self.history = BuildHistory(self.history)
+        self.executor = kwargs.pop('executor', 'thread')
+        self.fail_fast = kwargs.pop('fail_fast', False)
+        self.keep_going = kwargs.pop('keep_going', False)
+        if self.fail_fast and self.keep_going:
+            raise ValueError('fail_fast and keep_going are exclusive')
+        self.artifact_cache = kwargs.pop('artifact_cache', None)
+        if isinstance(self.artifact_cache, str):
+            self.artifact_cache = LocalArtifactCache(self.artifact_cache)
+        self.remote_executor = kwargs.pop('remote_workers', None)
+        if self.remote_executor is not None and not isinstance(self.remote_executor,
+                                                               remote.RemoteExecutor):
+            self.remote_executor = remote.RemoteExecutor(self.remote_executor)
+        self.jobserver = kwargs.pop('jobserver', None)
+        self.resources = kwargs.pop('resources', None) or {}
+        self.adaptive = kwargs.pop('adaptive', None)
+        if self.adaptive is True:
+            self.adaptive = adaptive.AdaptiveLimit()
+        elif isinstance(self.adaptive, dict):
+            self.adaptive = adaptive.AdaptiveLimit(**self.adaptive)
+        self.listeners = list(kwargs.pop('listeners', None) or ())
+        self.pipeline_budget = MemoryBudget(kwargs.pop('pipeline_memory', 256 << 20))
         super().__init__(*args, **kwargs)
         self.is_running = {}
+        self.job_pool = None
+        self.scheduler = None
+        self.spawn_slots = None
+        self.job_tokens = None
+        self.compiler_pool = CompilerPool()
+        self.processes = set()
+        self.processes_lock = threading.Lock()
+        self.cancelled = False
+        self.sub_commands_cache = {}
+        self.creators = []
+        self.durations = {}
+        self.records = []
+        if self.history is not None:
+            self.durations.update(self.history.durations())
+
+    def command_executor(self, command):
+        """returns the backend ``command`` runs in, ``'thread'`` or ``'process'``"""
+        executor = self.command_attr(command, 'executor') or self.executor
+        if executor not in ('thread', 'process'):
+            raise ValueError('unknown executor %r of command %r' % (executor, command))
+        return executor
+
+    def run_command_in_process(self, command, process_pool):
+        """run ``command`` in a worker process of ``process_pool``
+
+        the command is finalized here and its state returned by ``get_state``
+        is shipped to the worker, where its class must be importable. its
+        ``result`` is shipped back. sub commands are expected to have run"""
+        if self.have_run.get(command):
+            return
+        log.info("running %s", command)
+        cmd_obj = self.get_command_obj(command)
+        cmd_obj.ensure_finalized()
+        cmd_obj.result = process_pool.submit(_run_in_process,
+                                             type(cmd_obj),
+                                             cmd_obj.get_state()).result()
+        self.have_run[command] = 1
+
+    def open_jobserver(self, jobs):
+        """returns ``(jobserver, served)``. ``jobserver`` is the ``Jobserver`` to take
+        tokens from, or None, and ``served`` whether it was created to serve ``jobs`` jobs"""
+        if self.jobserver is False:
+            return None, False
+        if isinstance(self.jobserver, jobserver.Jobserver):
+            return self.jobserver, False
+        client = jobserver.Jobserver.from_environ()
+        if client is not None or self.jobserver is None:
+            return client, False
+        return jobserver.Jobserver.serve(jobs, self.jobserver), True
+
+    def command_resources(self, command):
+        """returns a dict maps the resources ``command`` needs while running
+        to their amount. it takes one ``'slots'`` unless it says otherwise"""
+        resources = {'slots': 1}
+        resources.update(self.command_attr(command, 'resources') or {})
+        return resources
+
+    def command_cost(self, command):
+        """returns the estimated cost of ``command`` in seconds
+
+        the ``cost`` hint of the command is used if set, otherwise the duration
+        recorded in ``self.durations``. defaults to 1"""
+        cost = self.command_attr(command, 'cost')
+        if cost is None:
+            cost = self.durations.get(command, 1.0)
+        return cost
+
+    def command_attr(self, command, name):
+        """returns the attribute ``name`` of the command object of ``command``,
+        or of its command class while it has no object, or None"""
+        cmd_obj = self.command_obj.get(command)
+        if cmd_obj is None:
+            return getattr(self.get_command_class(command), name, None)
+        return getattr(cmd_obj, name, None)
+
+    def creator_of(self, command):
+        """returns the registered ``CommandCreator`` which has ``command``, or None"""
+        for creator in self.creators:
+            if creator.has(command):
+                return creator
+        return None
+
+    def get_command_class(self, command):
+        """returns the command class of ``command``, creating it by the registered
+        ``CommandCreator`` having it if not created yet"""
+        if command not in self.cmdclass:
+            creator = self.creator_of(command)
+            if creator is not None:
+                self.cmdclass[command] = creator.command_class(command)
+        return super().get_command_class(command)
+
+    def sub_commands_of(self, command):
+        """returns the sub commands of ``command``
+
+        those of a command of a registered ``CommandCreator`` are looked up in
+        it as long as the command has no object. otherwise the result of
+        ``get_sub_commands`` is cached until the class or the ``sub_commands``
+        of the command change"""
+        if command not in self.command_obj:
+            creator = self.creator_of(command)
+            if creator is not None:
+                deps = creator.deps_of(command)
+                if deps is not None:
+                    return list(deps)
+        cmd_obj = self.get_command_obj(command)
+        signature = (type(cmd_obj), list(cmd_obj.sub_commands))
+        cached = self.sub_commands_cache.get(command)
+        if cached is None or cached[0] != signature:
+            cached = (signature, cmd_obj.get_sub_commands())
+            self.sub_commands_cache[command] = cached
+        return cached[1]
+
+    def command_graph(self, commands):
+        """build the dependency graph of ``commands``
+
+        returns a tuple ``(order, deps)``. ``order`` is the list of sequencified
+        commands and ``deps`` maps every command in it to its sub commands
+
+        raise ``SequencifyFail`` if fails"""
+        order = []
+        deps = {}
+        for root in commands:
+            if root in deps:
+                continue
+            path = [root]
+            on_path = {root}
+            subs = [iter(self.sub_commands_of(root))]
+            while subs:
+                for sub in subs[-1]:
+                    if sub in deps:
+                        continue
+                    if sub in on_path:
+                        raise SequencifyFail(path[path.index(sub):] + [sub])
+                    path.append(sub)
+                    on_path.add(sub)
+                    subs.append(iter(self.sub_commands_of(sub)))
+                    break
+                else:
+                    subs.pop()
+                    command = path.pop()
+                    on_path.discard(command)
+                    deps[command] = self.sub_commands_of(command)
+                    order.append(command)
+        return order, deps
 
     def sequencify_commands(self, commands):
         """sequencify ``commands``. returns a list of sequencified commands
@@ -84,73 +326,301 @@ class OrchDistribution(Distribution):
         sub commands will be put before their parent classes
 
         raise ``SequencifyFail`` if fails"""
-
-        def sequencify(commands, results, nest):
-            for command in commands:
-                if command not in results:
-                    if command in nest:
-                        raise SequencifyFail('recursive')
-                    deps = self.get_command_obj(command).get_sub_commands()
-                    if deps:
-                        nest.append(command)
-                        sequencify(deps, results, nest)
-                        nest.pop()
-                    results.append(command)
-            return results
-        return sequencify(commands, [], [])
+        return self.command_graph(commands)[0]
 
     def is_sub_commands_have_run(self, command):
         """returns whether all sub commands of ``command`` have run"""
-        for subcmd in self.get_command_obj(command).get_sub_commands():
+        for subcmd in self.sub_commands_of(command):
             if not self.have_run.get(subcmd):
                 return False
         return True
 
+    def input_index(self, commands=None):
+        """map the files read by ``commands``, or ``self.commands`` if None, and
+        their sub commands to the sets of commands reading them
+
+        the files a command reads are given by its ``input_files`` method, which
+        ``BuildC`` commands have, including the headers found by the build
+        database. a command whose options come from a sub command that has not
+        run yet, as told by ``options_resolved``, is left out; it is reached
+        through that sub command. files written by commands that have run are
+        left out as well. the paths are absolute. the distribution gets an
+        in-memory build database if it has none"""
+        if commands is None:
+            commands = self.commands
+        if self.build_db is None:
+            self.build_db = BuildDatabase(None)
+        index = {}
+        outputs = set()
+        existing = set(self.command_obj)
+        states = {}
+        try:
+            for command in self.command_graph(commands)[0]:
+                have_run = self.have_run.get(command)
+                if command in existing and not have_run:
+                    # ``get_option`` stores the options it resolves
+                    states[command] = dict(vars(self.command_obj[command]))
+                cmd_obj = self.get_command_obj(command)
+                input_files = getattr(cmd_obj, 'input_files', None)
+                if input_files is None:
+                    continue
+                options_resolved = getattr(cmd_obj, 'options_resolved', None)
+                if not (have_run or options_resolved is None or
+                        self.is_sub_commands_have_run(command) or options_resolved()):
+                    continue
+                try:
+                    for path in input_files():
+                        index.setdefault(os.path.abspath(path), set()).add(command)
+                    if have_run:
+                        outputs.update(os.path.abspath(path) for path in cmd_obj.output_files())
+                except Exception as e:
+                    log.warn('orchdist: cannot index the files read by %s: %r', command, e)
+        finally:
+            for command in list(self.command_obj):
+                if command not in existing and not self.have_run.get(command):
+                    del self.command_obj[command]
+            for command, state in states.items():
+                cmd_obj = self.command_obj[command]
+                vars(cmd_obj).clear()
+                vars(cmd_obj).update(state)
+        for path in outputs:
+            index.pop(path, None)
+        return index
+
+    def affected_commands(self, paths, commands=None, index=None):
+        """returns the commands among ``commands``, or ``self.commands`` if None,
+        and their sub commands which read ``paths`` or depend on one that does,
+        in sequencified order. ``index`` is the result of ``input_index``,
+        computed if None"""
+        if commands is None:
+            commands = self.commands
+        if index is None:
+            index = self.input_index(commands)
+        order, deps = self.command_graph(commands)
+        dependents = {command: [] for command in order}
+        for command in order:
+            for dep in deps[command]:
+                dependents[dep].append(command)
+        affected = set()
+        stack = [command for path in paths
+                 for command in index.get(os.path.abspath(path), ())]
+        while stack:
+            command = stack.pop()
+            if command not in affected:
+                affected.add(command)
+                stack.extend(dependents[command])
+        return [command for command in order if command in affected]
+
+    def run_affected(self, paths, commands=None, index=None):
+        """run the commands returned by ``affected_commands`` again. returns them
+
+        their other sub commands run only if they have not run yet, which the
+        build database makes cheap when they are up to date"""
+        affected = self.affected_commands(paths, commands, index)
+        if affected:
+            for command in affected:
+                # a new command object resolves its ``Builder.result_of`` options again
+                self.command_obj.pop(command, None)
+                self.have_run[command] = 0
+            self._run_commands(affected)
+        return affected
+
     def _run_commands(self, commands):
-        """run given ``commands`` in concurrency"""
+        """run given ``commands`` in concurrency
+
+        raise ``SequencifyFail`` if they depend on each other"""
+        scheduler = CommandScheduler(self, commands)
+        try:
+            scheduler.run()
+        finally:
+            self._finish_run(scheduler)
+
+    async def run_commands_async(self, commands=None):
+        """run given ``commands``, or ``self.commands`` if None, in concurrency
+        on the running event loop
+
+        commands whose ``run`` or ``run_async`` is a coroutine function are
+        awaited on the loop, others run in worker threads"""
+        if commands is None:
+            commands = self.commands
+        scheduler = CommandScheduler(self, commands, asynchronous=True)
         try:
-            commands = self.sequencify_commands(commands)
-        except SequencifyFail:
-            for cmd in commands:
-                super(OrchDistribution, self).run_command(cmd)
+            await scheduler.run_async()
+        finally:
+            self._finish_run(scheduler)
+
+    async def run_command_async(self, command):
+        """coroutine version of ``run_command`` for a command ``CommandScheduler.is_coroutine``
+        returns True for. its sub commands are expected to have run"""
+        if self.have_run.get(command):
             return
-        with ThreadPoolExecutor(max_workers=self.max_workers) as job_pool:
-            event_loop = asyncio.new_event_loop()
+        log.info("running %s", command)
+        cmd_obj = self.get_command_obj(command)
+        cmd_obj.ensure_finalized()
+        if asyncio.iscoroutinefunction(cmd_obj.run):
+            await cmd_obj.run()
+        else:
+            await cmd_obj.run_async()
+        self.have_run[command] = 1
+
+    async def spawn_async(self, cmd, error=DistutilsExecError, dry_run=0, capture_output=False):
+        """run the command line ``cmd`` in an ``asyncio`` subprocess like ``distutils.spawn`` does
+
+        raise ``error`` if it fails. at most ``max_workers`` subprocesses are
+        spawned at a time while a scheduler is running. if ``capture_output``
+        is set, its standard output is returned"""
+        log.info(' '.join(cmd))
+        if dry_run:
+            return
+        slots = self.spawn_slots
+        if slots is not None:
+            await slots.acquire()
+        try:
+            if self.cancelled:
+                raise error('command %r cancelled' % cmd[0])
             try:
-                futures = []
-                def _runs():
-                    def _run(command):
-                        try:
-                            super(OrchDistribution, self).run_command(command)
-                        except Exception as e:
-                            event_loop.stop()
-                            return e
-                        finally:
-                            del self.is_running[command]
-                        event_loop.call_soon_threadsafe(_runs)
-                        return None
-                    finished = True
-                    for cmd in commands:
-                        if not self.have_run.get(cmd):
-                            finished = False
-                            break
-                    if finished:
-                        event_loop.stop()
-                        return
-                    for cmd in commands:
-                        if not self.have_run.get(cmd) and not self.is_running.get(cmd) and self.is_sub_commands_have_run(cmd):
-                            self.is_running[cmd] = True
-                            futures.append(job_pool.submit(_run, cmd))
-                event_loop.call_soon(_runs)
-                event_loop.run_forever()
-                for future in futures:
-                    e = future.result()
-                    if e is not None:
-                        raise e
+                process = await asyncio.create_subprocess_exec(
+                    *cmd, pass_fds=self.pass_fds(),
+                    stdout=subprocess.PIPE if capture_output else None)
+            except OSError as e:
+                raise error('command %r failed: %s' % (cmd[0], e.strerror))
+            with self.processes_lock:
+                self.processes.add(process)
+            try:
+                output, _ = await process.communicate()
+                returncode = process.returncode
+            except asyncio.CancelledError:
+                process.terminate()
+                raise
             finally:
-                event_loop.close()
+                with self.processes_lock:
+                    self.processes.discard(process)
+        finally:
+            if slots is not None:
+                slots.release()
+        if returncode:
+            raise error('command %r failed with exit code %d' % (cmd[0], returncode))
+        return output
+
+    def spawn(self, cmd, dry_run=0, input=None, capture_output=False):
+        """run the command line ``cmd`` like ``distutils.spawn`` does, keeping
+        the process where ``terminate_processes`` can stop it
+
+        ``input`` is written to its standard input if not None. if
+        ``capture_output`` is set, its standard output is returned"""
+        log.info(' '.join(cmd))
+        if dry_run:
+            return
+        if self.cancelled:
+            raise DistutilsExecError('command %r cancelled' % cmd[0])
+        try:
+            process = subprocess.Popen(cmd, pass_fds=self.pass_fds(),
+                                       stdin=subprocess.PIPE if input is not None else None,
+                                       stdout=subprocess.PIPE if capture_output else None)
+        except OSError as e:
+            raise DistutilsExecError('command %r failed: %s' % (cmd[0], e.strerror))
+        with self.processes_lock:
+            self.processes.add(process)
+        try:
+            output, _ = process.communicate(input)
+        finally:
+            with self.processes_lock:
+                self.processes.discard(process)
+        if process.returncode:
+            raise DistutilsExecError('command %r failed with exit code %d' %
+                                     (cmd[0], process.returncode))
+        return output
+
+    def pass_fds(self):
+        """returns the file descriptors spawned processes inherit to join the jobserver"""
+        if self.job_tokens is None:
+            return ()
+        return self.job_tokens.pass_fds
+
+    def terminate_processes(self):
+        """cancel the commands spawned through ``spawn`` and ``spawn_async``"""
+        self.cancelled = True
+        with self.processes_lock:
+            processes = list(self.processes)
+        for process in processes:
+            try:
+                process.terminate()
+            except ProcessLookupError:
+                pass
+
+    def _finish_run(self, scheduler):
+        """collect the records of ``scheduler`` and save the history and build database"""
+        self.records.extend(scheduler.records)
+        if self.history is not None and scheduler.records:
+            self.history.add_run(scheduler.records)
+            self.history.save()
+        if self.build_db is not None:
+            self.build_db.save()
+
+    def export_trace(self, filename):
+        """write the records of the commands run so far to ``filename``
+        in the Chrome trace event format (``about:tracing``)"""
+        with open(filename, 'w') as f:
+            json.dump(BuildHistory.chrome_trace(self.records), f)
+
+    def export_ninja(self, filename, commands=None, script=None):
+        """write a ninja file building ``commands``, or ``self.commands`` if None,
+        to ``filename``. other commands than ``BuildC`` ones are run by calling
+        back into ``script``, the setup script by default. see ``orchdist.ninja``"""
+        from . import ninja
+        if commands is None:
+            commands = self.commands
+        with open(filename, 'w') as f:
+            ninja.NinjaExporter(self, script).write(f, commands)
+
+    def watch(self, commands=None, watcher=None, rounds=None, callback=None):
+        """build ``commands``, or ``self.commands`` if None, then rebuild the commands
+        affected by every change of the files they read until interrupted, or
+        ``rounds`` rebuilds have been done. see ``orchdist.watch.Watch``"""
+        from . import watch
+        if commands is None:
+            commands = self.commands
+        watch.Watch(self, commands, watcher).run(rounds, callback)
+
+    def map_jobs(self, fn, *iterables):
+        """call ``fn`` on the items of ``iterables`` like ``map`` does, using the
+        workers of the running scheduler. returns a list of results
+
+        jobs no worker has picked up yet are run by the calling thread, so a
+        command can wait on its own jobs without deadlocking the pool. a worker
+        runs a job only if it gets one of the ``'slots'`` of the scheduler at
+        once and, with a jobserver, a token"""
+        jobs = list(zip(*iterables))
+        job_pool = self.job_pool
+        if job_pool is None or len(jobs) < 2:
+            return [fn(*job) for job in jobs]
+        tokens = self.job_tokens
+        if tokens is not None:
+            fn_with_token = partial(_call_with_token, tokens, fn)
+        else:
+            fn_with_token = fn
+        if self.scheduler is not None:
+            fn_with_token = partial(_call_with_slot, self.scheduler, fn_with_token)
+        futures = [job_pool.submit(fn_with_token, *job) for job in jobs[1:]]
+        try:
+            results = [fn(*jobs[0])]
+            for future, job in zip(futures, jobs[1:]):
+                if future.cancel():
+                    results.append(fn(*job))
+                    continue
+                result = future.result()
+                if result is _NO_TOKEN:
+                    result = fn(*job)
+                results.append(result)
+            return results
+        finally:
+            for future in futures:
+                future.cancel()
 
     def run_command(self, command):
+        # ``OrchCommand.run`` runs every sub command, which has run already
+        if self.have_run.get(command):
+            return
         self._run_commands([command])
 
     def run_commands(self):
@@ -165,6 +635,15 @@ class OrchDistribution(Distribution):
         for command, klass in cmdclass.items():
             self.register_cmdclass(command, klass)
 
+    def add_listener(self, listener):
+        """tell the ``BuildListener`` ``listener`` about the progress of builds"""
+        self.listeners.append(listener)
+
+    def register_creator(self, creator):
+        """let the ``CommandCreator`` ``creator`` create the command classes of its
+        commands when they are looked up"""
+        self.creators.append(creator)
+
     def add_commands(self, *commands):
         """add ``commands`` to ``self.commands``"""
         if not hasattr(self, 'commands'):
@@ -172,12 +651,572 @@ class OrchDistribution(Distribution):
         self.commands.extend(commands)
 
 
+_NO_TOKEN = object()
+
+
+def _call_with_slot(scheduler, fn, *args):
+    """call ``fn`` with ``args`` holding a slot of ``scheduler``.
+    returns ``_NO_TOKEN`` if none is free"""
+    if not scheduler.take_job_slot():
+        return _NO_TOKEN
+    try:
+        return fn(*args)
+    finally:
+        scheduler.give_job_slot()
+
+
+def _call_with_token(tokens, fn, *args):
+    """call ``fn`` with ``args`` holding a token of the jobserver ``tokens``.
+    returns ``_NO_TOKEN`` if none is available"""
+    token = tokens.acquire(blocking=False)
+    if token is None:
+        return _NO_TOKEN
+    try:
+        return fn(*args)
+    finally:
+        tokens.release(token)
+
+
+class BuildHistory:
+    """persistent timing history of the commands run by ``OrchDistribution``
+
+    every run is stored as a list of records, one per command, with keys
+    ``command``, ``ready``, ``start``, ``end`` (seconds since the epoch),
+    ``wait`` (seconds spent in the ready queue), ``worker`` (name of the
+    worker thread) and ``error`` (repr of the exception or None).
+    only the last ``max_runs`` runs are kept"""
+
+    VERSION = 1
+
+    def __init__(self, filename, max_runs=20):
+        self.filename = filename
+        self.max_runs = max_runs
+        self.runs = []
+        try:
+            with open(filename, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') == self.VERSION:
+            self.runs = data.get('runs', [])
+
+    def durations(self):
+        """returns a dict maps every command to its last successful duration"""
+        result = {}
+        for records in self.runs:
+            for record in records:
+                if record['error'] is None:
+                    result[record['command']] = record['end'] - record['start']
+        return result
+
+    def add_run(self, records):
+        """add the records of a run"""
+        self.runs.append(list(records))
+        del self.runs[:-self.max_runs]
+
+    def save(self):
+        """write the history to ``self.filename``"""
+        tmpname = '%s.%d.tmp' % (self.filename, os.getpid())
+        with open(tmpname, 'w') as f:
+            json.dump({'version': self.VERSION, 'runs': self.runs}, f)
+        os.replace(tmpname, self.filename)
+
+    @staticmethod
+    def chrome_trace(records):
+        """returns ``records`` converted to the Chrome trace event format"""
+        if not records:
+            return {'traceEvents': []}
+        base = min(record['ready'] for record in records)
+        workers = {}
+        events = []
+        for record in sorted(records, key=lambda record: record['start']):
+            tid = workers.setdefault(record['worker'], len(workers) + 1)
+            events.append({
+                'name': record['command'],
+                'cat': 'command' if record['error'] is None else 'command,error',
+                'ph': 'X',
+                'pid': 1,
+                'tid': tid,
+                'ts': (record['start'] - base) * 1e6,
+                'dur': (record['end'] - record['start']) * 1e6,
+                'args': {'wait': record['wait'], 'error': record['error']},
+            })
+        for worker, tid in workers.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                           'args': {'name': worker}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+class BuildListener:
+    """receives the events of the scheduler of a build
+
+    the methods are called on the thread running the scheduler with the
+    time of the event, as returned by ``time.time()``. exceptions they raise
+    are logged and otherwise ignored. override those needed"""
+
+    def on_build_start(self, scheduler, timestamp):
+        """the build of ``scheduler`` starts. ``scheduler.indegree`` has the
+        commands to run"""
+
+    def on_ready(self, command, timestamp):
+        """the sub commands of ``command`` have run"""
+
+    def on_start(self, command, timestamp):
+        """``command`` is dispatched to a worker"""
+
+    def on_finish(self, command, timestamp, duration):
+        """``command`` has run for ``duration`` seconds"""
+
+    def on_error(self, command, timestamp, error):
+        """``command`` has raised ``error``"""
+
+    def on_build_finish(self, scheduler, timestamp):
+        """the build of ``scheduler`` is over, whether it failed or not"""
+
+
+class CommandScheduler:
+    """event driven scheduler used by ``OrchDistribution`` to run commands
+
+    the dependency graph is built once. every command keeps a counter of its
+    sub commands that have not run yet, and goes into the ready queue when
+    the counter drops to zero. finishing a command only touches its dependents
+
+    ready commands are dispatched in sequencified order, or by ``priorities``
+    if ``priority`` of the distribution is set, as long as the resources they
+    need fit into ``capacity``. with ``adaptive`` of the distribution set,
+    the capacity of ``'slots'`` follows its limit, sampled while running
+
+    commands are run in worker threads, except those ``is_coroutine`` returns
+    True for, which are awaited on the event loop of the scheduler
+
+    the ``listeners`` of the distribution are told about every command
+    getting ready, starting, finishing and failing
+
+    once all dependents of a command in the graph have run, or the run is
+    over, its ``release_result`` method is called if it has one, to drop the
+    data it holds for them"""
+
+    def __init__(self, dist, commands, asynchronous=False):
+        self.dist = dist
+        self.asynchronous = asynchronous
+        self.order, self.deps = dist.command_graph(commands)
+        self.dependents = {}
+        self.indegree = {}
+        for cmd in self.order:
+            if dist.have_run.get(cmd):
+                continue
+            self.dependents[cmd] = []
+            count = 0
+            for dep in self.deps[cmd]:
+                if not dist.have_run.get(dep):
+                    self.dependents[dep].append(cmd)
+                    count += 1
+            self.indegree[cmd] = count
+        self.consumers = {cmd: len(dependents) for cmd, dependents in self.dependents.items()}
+        self.priorities = self.critical_paths() if dist.priority else None
+        self.ready = []
+        self.ready_count = 0
+        self.ready_at = {}
+        self.records = []
+        self.process_pool = None
+        self.listening = False
+        self.started = {}
+        for cmd in self.order:
+            if self.indegree.get(cmd) == 0:
+                self.push_ready(cmd)
+        max_workers = dist.max_workers
+        if max_workers is None:
+            max_workers = min(32, (os.cpu_count() or 1) + 4)
+        self.max_workers = max_workers
+        self.capacity = dict(dist.resources)
+        self.capacity['slots'] = min(self.capacity.get('slots', max_workers), max_workers)
+        if 'memory' not in self.capacity:
+            memory = physical_memory()
+            if memory is not None:
+                self.capacity['memory'] = memory
+        self.bounds = dict(self.capacity)
+        self.in_use = {}
+        self.demands = {}
+        # slots taken by jobs of ``map_jobs`` from worker threads
+        self.job_slots = 0
+        self.lock = threading.Lock()
+
+    def notify(self, event, *args):
+        """call method ``event`` of the listeners of the distribution with ``args``"""
+        for listener in self.dist.listeners:
+            try:
+                getattr(listener, event)(*args)
+            except Exception as e:
+                log.warn('orchdist: listener %r failed on %s: %r', listener, event, e)
+
+    def critical_paths(self):
+        """returns a dict maps every command to the cost of the longest path
+        from it to a command no other command depends on"""
+        paths = {}
+        for cmd in reversed(self.order):
+            if cmd in self.indegree:
+                paths[cmd] = self.dist.command_cost(cmd) + max(
+                    [paths[dependent] for dependent in self.dependents[cmd]] or [0])
+        return paths
+
+    def push_ready(self, command):
+        """put ``command`` into the ready queue"""
+        priority = self.priorities[command] if self.priorities is not None else 0
+        heapq.heappush(self.ready, (-priority, self.ready_count, command))
+        self.ready_count += 1
+        self.ready_at[command] = time.time()
+        if self.listening:
+            self.notify('on_ready', command, self.ready_at[command])
+
+    def demand(self, command):
+        """returns the resources ``command`` needs, each cut down to its initial
+        capacity so a command needing more than there is still runs, alone"""
+        demand = self.demands.get(command)
+        if demand is None:
+            demand = {}
+            for name, amount in self.dist.command_resources(command).items():
+                if name in self.bounds:
+                    amount = min(amount, self.bounds[name])
+                if amount:
+                    demand[name] = amount
+            self.demands[command] = demand
+        return demand
+
+    def pop_ready(self):
+        """take the next command whose resources are available out of the ready
+        queue and reserve them. returns None if there is none
+
+        a command that has to wait holds back the resources it is short of
+        from the commands after it, so it is not starved by smaller ones"""
+        waiting = []
+        short = set()
+        command = None
+        with self.lock:
+            in_use = dict(self.in_use)
+            if self.job_slots:
+                in_use['slots'] += self.job_slots
+            while self.ready:
+                entry = heapq.heappop(self.ready)
+                demand = self.demand(entry[2])
+                lacking = {name for name, amount in demand.items()
+                           if name in self.capacity and in_use.get(name) and
+                           in_use[name] + amount > self.capacity[name]}
+                if not lacking and short.isdisjoint(demand):
+                    command = entry[2]
+                    break
+                waiting.append(entry)
+                short.update(lacking)
+                if 'slots' in short:
+                    break
+            for entry in waiting:
+                heapq.heappush(self.ready, entry)
+            if command is not None:
+                for name, amount in demand.items():
+                    self.in_use[name] = self.in_use.get(name, 0) + amount
+        return command
+
+    def release(self, command):
+        """give back the resources reserved for ``command``"""
+        with self.lock:
+            for name, amount in self.demand(command).items():
+                self.in_use[name] -= amount
+
+    def take_job_slot(self):
+        """take one of the ``'slots'`` for a job of a running command, called from
+        its thread. returns False if none is free"""
+        with self.lock:
+            if self.in_use.get('slots', 0) + self.job_slots >= self.capacity['slots']:
+                return False
+            self.job_slots += 1
+            return True
+
+    def give_job_slot(self):
+        """give back a slot taken by ``take_job_slot``"""
+        with self.lock:
+            self.job_slots -= 1
+
+    def start_record(self, command):
+        """returns a new timing record of ``command`` which starts now"""
+        record = {
+            'command': command,
+            'ready': self.ready_at[command],
+            'start': time.time(),
+            'worker': threading.current_thread().name,
+            'error': None,
+        }
+        record['wait'] = record['start'] - record['ready']
+        return record
+
+    def end_record(self, record, error=None):
+        """end ``record`` with ``error`` raised by its command"""
+        record['end'] = time.time()
+        self.records.append(record)
+        if error is not None:
+            record['error'] = repr(error)
+        else:
+            self.dist.durations[record['command']] = record['end'] - record['start']
+
+    def execute(self, command):
+        """run ``command`` in a worker and record its timing"""
+        record = self.start_record(command)
+        try:
+            if self.process_pool is not None and self.dist.command_executor(command) == 'process':
+                self.dist.run_command_in_process(command, self.process_pool)
+            else:
+                Distribution.run_command(self.dist, command)
+        except BaseException as e:
+            self.end_record(record, e)
+            raise
+        self.end_record(record)
+
+    async def execute_async(self, command):
+        """run ``command`` on the event loop and record its timing"""
+        record = self.start_record(command)
+        try:
+            await self.dist.run_command_async(command)
+        except BaseException as e:
+            self.end_record(record, e)
+            raise
+        self.end_record(record)
+
+    def is_coroutine(self, command):
+        """returns whether ``command`` runs as a coroutine on the event loop
+
+        that is when its ``run`` is a coroutine function, or the scheduler runs
+        asynchronously and the command has a coroutine ``run_async``"""
+        cmd_obj = self.dist.get_command_obj(command)
+        return (asyncio.iscoroutinefunction(cmd_obj.run) or
+                (self.asynchronous and
+                 asyncio.iscoroutinefunction(getattr(cmd_obj, 'run_async', None))))
+
+    def finish(self, command):
+        """mark ``command`` finished and move its ready dependents into the ready queue"""
+        for dependent in self.dependents[command]:
+            self.indegree[dependent] -= 1
+            if not self.indegree[dependent]:
+                self.push_ready(dependent)
+        for dep in self.deps[command]:
+            if dep in self.consumers:
+                self.consumers[dep] -= 1
+                if not self.consumers[dep]:
+                    self.release_result(dep)
+
+    def release_result(self, command):
+        """call ``release_result`` of the object of ``command``, if any"""
+        release = getattr(self.dist.command_obj.get(command), 'release_result', None)
+        if release is not None:
+            release()
+
+    def skipped(self):
+        """returns the commands that cannot run because a command they depend on failed"""
+        return [cmd for cmd in self.order if self.indegree.get(cmd)]
+
+    async def schedule(self, event_loop, job_pool):
+        """dispatch ready commands to ``job_pool`` until all commands have run
+
+        failures are handled according to ``fail_fast`` and ``keep_going``
+        of the distribution. with a jobserver, every command running besides
+        the first one holds a token of it"""
+        running = {}
+        errors = []
+        stopped = False
+        tokens = self.dist.job_tokens
+        held = {}
+        spare = []
+        waiting = None
+        limit = self.dist.adaptive
+        ticker = None
+        if limit is not None:
+            self.capacity['slots'] = limit.start(self.bounds['slots'])
+        self.listening = bool(self.dist.listeners)
+        if self.listening:
+            self.notify('on_build_start', self, time.time())
+            for entry in sorted(self.ready):
+                self.notify('on_ready', entry[2], self.ready_at[entry[2]])
+        try:
+            while True:
+                while self.ready and not stopped and len(running) < self.max_workers:
+                    token = None
+                    if tokens is not None and len(running) > len(held):
+                        if not spare:
+                            if waiting is None:
+                                waiting = tokens.acquire_async(event_loop)
+                            break
+                        token = spare.pop()
+                    cmd = self.pop_ready()
+                    if cmd is None:
+                        if token is not None:
+                            spare.append(token)
+                        break
+                    self.dist.is_running[cmd] = True
+                    if self.listening:
+                        self.started[cmd] = time.time()
+                        self.notify('on_start', cmd, self.started[cmd])
+                    if self.is_coroutine(cmd):
+                        future = asyncio.ensure_future(self.execute_async(cmd))
+                    else:
+                        future = event_loop.run_in_executor(job_pool, self.execute, cmd)
+                    running[future] = cmd
+                    if token is not None:
+                        held[future] = token
+                if spare and (stopped or not self.ready):
+                    for token in spare:
+                        tokens.release(token)
+                    spare = []
+                if not running:
+                    break
+                pending = set(running)
+                if waiting is not None:
+                    pending.add(waiting)
+                if limit is not None:
+                    if ticker is None:
+                        ticker = asyncio.ensure_future(asyncio.sleep(limit.interval))
+                    pending.add(ticker)
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    if future is ticker:
+                        ticker = None
+                        self.capacity['slots'] = limit.update(len(running))
+                        continue
+                    if future is waiting:
+                        waiting = None
+                        try:
+                            spare.append(future.result())
+                        except OSError as e:
+                            log.warn('orchdist: %s, ignoring the jobserver', e)
+                            tokens = None
+                        continue
+                    cmd = running.pop(future)
+                    self.release(cmd)
+                    if future in held:
+                        spare.append(held.pop(future))
+                    del self.dist.is_running[cmd]
+                    if future.cancelled():
+                        errors.append((cmd, asyncio.CancelledError()))
+                        if self.listening:
+                            self.notify('on_error', cmd, time.time(), errors[-1][1])
+                        continue
+                    if future.exception() is not None:
+                        errors.append((cmd, future.exception()))
+                        if self.listening:
+                            self.notify('on_error', cmd, time.time(), errors[-1][1])
+                        if self.dist.keep_going or stopped:
+                            continue
+                        stopped = True
+                        if self.dist.fail_fast:
+                            for other in running:
+                                if isinstance(other, asyncio.Task):
+                                    other.cancel()
+                            self.dist.terminate_processes()
+                        continue
+                    if self.listening:
+                        now = time.time()
+                        self.notify('on_finish', cmd, now, now - self.started[cmd])
+                    self.finish(cmd)
+        finally:
+            if waiting is not None:
+                waiting.cancel()
+            if ticker is not None:
+                ticker.cancel()
+            if tokens is not None:
+                for token in spare + list(held.values()):
+                    tokens.release(token)
+            for cmd in self.consumers:
+                self.release_result(cmd)
+            if self.listening:
+                self.notify('on_build_finish', self, time.time())
+        if errors:
+            if self.dist.keep_going:
+                raise CommandsFailed(errors, self.skipped())
+            raise errors[0][1]
+
+    async def run_async(self):
+        """run all commands in concurrency on the running event loop"""
+        if not self.indegree:
+            return
+        event_loop = asyncio.get_event_loop()
+        if any(self.dist.command_executor(cmd) == 'process' for cmd in self.indegree):
+            self.process_pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as job_pool:
+                outer_pool, self.dist.job_pool = self.dist.job_pool, job_pool
+                outer_scheduler, self.dist.scheduler = self.dist.scheduler, self
+                outer_slots, self.dist.spawn_slots = (self.dist.spawn_slots,
+                                                      asyncio.Semaphore(self.max_workers))
+                outer_tokens = self.dist.job_tokens
+                served = False
+                if outer_tokens is None:
+                    self.dist.job_tokens, served = self.dist.open_jobserver(self.max_workers)
+                makeflags = os.environ.get('MAKEFLAGS')
+                if served:
+                    os.environ['MAKEFLAGS'] = self.dist.job_tokens.makeflags(makeflags)
+                try:
+                    await self.schedule(event_loop, job_pool)
+                finally:
+                    if outer_tokens is None and self.dist.job_tokens is not None:
+                        if self.dist.job_tokens is not self.dist.jobserver:
+                            self.dist.job_tokens.close()
+                        self.dist.job_tokens = None
+                    if served:
+                        if makeflags is None:
+                            del os.environ['MAKEFLAGS']
+                        else:
+                            os.environ['MAKEFLAGS'] = makeflags
+                    self.dist.job_pool = outer_pool
+                    self.dist.scheduler = outer_scheduler
+                    self.dist.spawn_slots = outer_slots
+                    self.dist.cancelled = False
+        finally:
+            if self.process_pool is not None:
+                self.process_pool.shutdown()
+                self.process_pool = None
+
+    def run(self):
+        """run all commands in concurrency"""
+        if not self.indegree:
+            return
+        event_loop = asyncio.new_event_loop()
+        try:
+            event_loop.run_until_complete(self.run_async())
+        finally:
+            event_loop.close()
+
+
+def physical_memory():
+    """returns the size of the physical memory in bytes, or None if unknown"""
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+class _WorkerDistribution(Distribution):
+    """distribution of a command run by a worker process
+
+    sub commands have already run in the parent process"""
+
+    def run_command(self, command):
+        pass
+
+
+def _run_in_process(klass, state):
+    """run a command of ``klass`` with ``state`` in a worker process. returns its result"""
+    cmd_obj = klass.__new__(klass)
+    cmd_obj.__dict__.update(state)
+    cmd_obj.distribution = _WorkerDistribution()
+    cmd_obj.run()
+    return getattr(cmd_obj, 'result', None)
+
+
 class OrchCommand(Command):
     """base class of commands in orchdist
 
     added useful methods to custom a command"""
 
     cmdclass = {}
+    cost = None
+    executor = None
+    resources = None
 
     def __init__(self, dist):
         super().__init__(dist)
@@ -237,6 +1276,12 @@ class OrchCommand(Command):
     def finalize_options(self):
         pass
 
+    def get_state(self):
+        """returns the attributes shipped to a worker process to run this command there"""
+        state = vars(self).copy()
+        del state['distribution']
+        return state
+
     def run(self):
         for cmd_name in self.get_sub_commands():
             self.run_command(cmd_name)
@@ -248,11 +1293,24 @@ class CommandCreator:
         self.cmddep = {}
         self.cmdcls = {}
         self.cmdfn = {}
+        self.linked = set()
         self.distribution = distribution
 
     def add(self, command, deps=tuple()):
         """add command with name ``command`` and dependencies ``deps``"""
-        self.cmddep[command] = deps
+        self.cmddep[sys.intern(command)] = tuple(sys.intern(dep) for dep in deps)
+
+    def has(self, command):
+        """returns whether ``command`` has been added"""
+        return command in self.cmddep
+
+    def deps_of(self, command):
+        """returns the dependencies of ``command``, or None if its command class
+        decides them by redefining ``sub_commands`` or ``get_sub_commands``"""
+        fns = self.cmdfn.get(command)
+        if fns and ('sub_commands' in fns or 'get_sub_commands' in fns):
+            return None
+        return self.cmddep[command]
 
     def on(self, command, name=None, fn=None):
         """redefine method ``name`` of ``command``
@@ -276,8 +1334,9 @@ class CommandCreator:
                 return fn
             return func
 
-    def create(self, command, klass=OrchCommand):
-        """create command class of ``command`` to be subclass of ``klass``"""
+    def command_class(self, command, klass=OrchCommand):
+        """create command class of ``command`` to be subclass of ``klass``,
+        naming its dependencies as sub commands without creating their classes"""
         if command in self.cmdcls:
             return self.cmdcls[command]
         cmdclass = klass.create_subclass()
@@ -286,7 +1345,16 @@ class CommandCreator:
             cmdclass.on(name, fn)
         self.cmdcls[command] = cmdclass
         for dep in self.cmddep[command]:
-            cmdclass.add_sub_command(dep, None, self.create(dep, klass))
+            cmdclass.add_sub_command(dep)
+        return cmdclass
+
+    def create(self, command, klass=OrchCommand):
+        """create command class of ``command`` to be subclass of ``klass``"""
+        cmdclass = self.command_class(command, klass)
+        if command not in self.linked:
+            self.linked.add(command)
+            for dep in self.cmddep[command]:
+                cmdclass.cmdclass[dep] = self.create(dep, klass)
         return cmdclass
 
     def create_all(self):
@@ -297,10 +1365,375 @@ class CommandCreator:
         return result
 
     def apply(self, dist=None):
+        """add the commands to ``dist``, an ``OrchDistribution``. their command
+        classes are created when they are first looked up"""
         if dist is None:
             dist = self.distribution
-        dist.register_cmdclasses(self.create_all())
-        dist.add_commands(*self.create_all().keys())
+        dist.register_creator(self)
+        dist.add_commands(*self.cmddep)
+
+
+class BuildDatabase:
+    """on-disk database of ``BuildC`` results used to skip up-to-date targets
+
+    an entry is keyed on the command name and records the digest of everything
+    the command reads, its ``result`` and the stamps of the files it wrote.
+    file digests are cached by ``(mtime, size)`` so a null build only stats files.
+    with ``filename`` None the database lives in memory only"""
+
+    VERSION = 1
+    INCLUDE_RE = re.compile(rb'^[ \t]*#[ \t]*include[ \t]*([<"])([^>"\n]+)[>"]', re.M)
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.files = {}
+        self.dirty = False
+        if filename is None:
+            return
+        try:
+            with open(filename, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') == self.VERSION:
+            self.entries = data.get('entries', {})
+            self.files = data.get('files', {})
+
+    @staticmethod
+    def stamp(path):
+        """returns ``[mtime_ns, size]`` of ``path`` or None if it does not exist"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [st.st_mtime_ns, st.st_size]
+
+    def scan_file(self, path):
+        """returns the cached ``(digest, includes)`` of ``path``
+
+        ``includes`` is a list of ``[quoted, name]`` of its include directives.
+        returns None if ``path`` does not exist"""
+        path = os.path.abspath(path)
+        stamp = self.stamp(path)
+        if stamp is None:
+            return None
+        with self.lock:
+            cached = self.files.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1], cached[2]
+        with open(path, 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+        includes = [[quote == b'"', name.decode('utf-8', 'replace')]
+                    for quote, name in self.INCLUDE_RE.findall(content)]
+        with self.lock:
+            self.files[path] = [stamp, digest, includes]
+            self.dirty = True
+        return digest, includes
+
+    def file_digest(self, path):
+        """returns the content digest of ``path`` or None if it does not exist"""
+        scanned = self.scan_file(path)
+        return scanned[0] if scanned is not None else None
+
+    def headers(self, sources, include_dirs=None):
+        """returns the headers included by ``sources`` transitively
+
+        quoted includes are searched in the directory of the including file
+        first. headers not found in ``include_dirs`` (system headers) are ignored"""
+        include_dirs = list(include_dirs or ())
+        found = []
+        seen = set()
+        stack = list(sources)
+        while stack:
+            path = stack.pop()
+            scanned = self.scan_file(path)
+            if scanned is None:
+                continue
+            for quoted, name in scanned[1]:
+                dirs = include_dirs
+                if quoted:
+                    dirs = [os.path.dirname(path)] + include_dirs
+                for dir in dirs:
+                    header = os.path.normpath(os.path.join(dir, name))
+                    if os.path.isfile(header):
+                        if header not in seen:
+                            seen.add(header)
+                            found.append(header)
+                            stack.append(header)
+                        break
+        return sorted(found)
+
+    def lookup(self, name, key):
+        """returns the entry of command ``name`` if it was built with ``key``
+        and its outputs are unchanged. otherwise returns None"""
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry is None or entry['key'] != key:
+            return None
+        for path, stamp in entry['outputs']:
+            if self.stamp(path) != stamp:
+                return None
+        return entry
+
+    def record(self, name, key, result, outputs):
+        """record that command ``name`` was built with ``key``"""
+        entry = {
+            'key': key,
+            'result': result,
+            'outputs': [[path, self.stamp(path)] for path in outputs],
+        }
+        with self.lock:
+            self.entries[name] = entry
+            self.dirty = True
+
+    def save(self):
+        """write the database to ``self.filename`` if it has changed"""
+        with self.lock:
+            if not self.dirty or self.filename is None:
+                return
+            data = {'version': self.VERSION, 'entries': self.entries, 'files': self.files}
+            tmpname = '%s.%d.tmp' % (self.filename, os.getpid())
+            with open(tmpname, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmpname, self.filename)
+            self.dirty = False
+
+
+class ArtifactCache:
+    """content-addressed store of build outputs shared across checkouts and machines
+
+    subclasses implement ``get`` and ``put``. keys are hex digests computed by
+    ``BuildC`` from the compiler identity, the options and the contents of the inputs"""
+
+    def get(self, key):
+        """returns the content stored under ``key`` or None"""
+        raise NotImplementedError
+
+    def put(self, key, data):
+        """store ``data`` under ``key``"""
+        raise NotImplementedError
+
+    @staticmethod
+    def digest(path):
+        """returns the content digest of the file ``path``"""
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(partial(f.read, 1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+
+class LocalArtifactCache(ArtifactCache):
+    """artifact cache in a local directory
+
+    when its size exceeds ``max_size`` bytes the least recently used entries are
+    evicted. the modification time of an entry is its last use"""
+
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.index = None
+        self.size = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def load_index(self):
+        """scan the directory for entries unless already done"""
+        if self.index is not None:
+            return
+        self.index = {}
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                self.index[path] = (st.st_mtime, st.st_size)
+                self.size += st.st_size
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        with self.lock:
+            if self.index is not None:
+                self.index[path] = (time.time(), len(data))
+        return data
+
+    def put(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmpname = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmpname, 'wb') as f:
+            f.write(data)
+        os.replace(tmpname, path)
+        with self.lock:
+            self.load_index()
+            old = self.index.get(path)
+            if old is not None:
+                self.size -= old[1]
+            self.index[path] = (time.time(), len(data))
+            self.size += len(data)
+            self.evict()
+
+    def evict(self):
+        """remove least recently used entries until the size fits ``max_size``"""
+        if self.max_size is None or self.size <= self.max_size:
+            return
+        for path, (used, size) in sorted(self.index.items(), key=lambda item: item[1][0]):
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            del self.index[path]
+            self.size -= size
+
+
+class HTTPArtifactCache(ArtifactCache):
+    """artifact cache on an HTTP server, which answers ``GET`` and ``PUT`` on ``url/key``
+
+    errors are logged and taken as misses, so an unreachable server never fails a build"""
+
+    def __init__(self, url, timeout=10):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def get(self, key):
+        try:
+            with urllib.request.urlopen('%s/%s' % (self.url, key), timeout=self.timeout) as response:
+                return response.read()
+        except urllib.error.HTTPError as e:
+            if e.code != 404:
+                log.warn('artifact cache %s: %s', self.url, e)
+        except (urllib.error.URLError, OSError) as e:
+            log.warn('artifact cache %s: %s', self.url, e)
+        return None
+
+    def put(self, key, data):
+        request = urllib.request.Request('%s/%s' % (self.url, key), data=data, method='PUT')
+        try:
+            urllib.request.urlopen(request, timeout=self.timeout).close()
+        except (urllib.error.URLError, OSError) as e:
+            log.warn('artifact cache %s: %s', self.url, e)
+
+
+class TieredArtifactCache(ArtifactCache):
+    """artifact cache looking ``caches`` up in order, like a local cache in front of a
+    remote one. a hit is copied into the caches before it, ``put`` stores into all"""
+
+    def __init__(self, *caches):
+        self.caches = caches
+
+    def get(self, key):
+        for i, cache in enumerate(self.caches):
+            data = cache.get(key)
+            if data is not None:
+                for earlier in self.caches[:i]:
+                    earlier.put(key, data)
+                return data
+        return None
+
+    def put(self, key, data):
+        for cache in self.caches:
+            cache.put(key, data)
+
+
+class CompilerPool:
+    """thread safe pool of configured compiler instances
+
+    instances are keyed by ``(plat, compiler, verbose, dry_run, force)``.
+    ``customize_compiler`` runs once per key; later instances are copies"""
+
+    # customize_compiler reads sysconfig lazily, which is not thread safe
+    configure_lock = threading.Lock()
+    # ``program_version`` by path, mtime and size of the executable
+    versions = {}
+    versions_lock = threading.Lock()
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.templates = {}
+        self.idle = {}
+        self.keys = {}
+
+    @classmethod
+    def configure(cls, plat, compiler, verbose, dry_run, force):
+        """returns a new compiler configured by ``customize_compiler``"""
+        with cls.configure_lock:
+            compiler = new_compiler(plat, compiler, verbose, dry_run, force)
+            customize_compiler(compiler)
+        return compiler
+
+    @classmethod
+    def program_version(cls, program):
+        """returns the output of ``program --version``, or the digest of its
+        executable if it gives none, or None if it is not found. it is cached
+        as long as the executable is unchanged"""
+        path = shutil.which(program)
+        if path is None:
+            return None
+        path = os.path.realpath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        stamp = (path, st.st_mtime_ns, st.st_size)
+        with cls.versions_lock:
+            version = cls.versions.get(stamp)
+        if version is not None:
+            return version
+        try:
+            # run by its name, as a wrapper like ccache tells its own version otherwise
+            process = subprocess.run([program, '--version'], stdin=subprocess.DEVNULL,
+                                     stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                     timeout=60)
+            if not process.returncode:
+                version = process.stdout.decode('utf-8', 'replace')
+        except (OSError, subprocess.SubprocessError):
+            pass
+        if not version:
+            version = ArtifactCache.digest(path)
+        with cls.versions_lock:
+            cls.versions[stamp] = version
+        return version
+
+    def acquire(self, key):
+        """check out a compiler configured for ``key``"""
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                compiler = idle.pop()
+                self.keys[id(compiler)] = key
+                return compiler
+            template = self.templates.get(key)
+        if template is None:
+            template = self.configure(*key)
+            with self.lock:
+                template = self.templates.setdefault(key, template)
+        compiler = copy.deepcopy(template)
+        with self.lock:
+            self.keys[id(compiler)] = key
+        return compiler
+
+    def release(self, compiler):
+        """give ``compiler`` checked out by ``acquire`` back to the pool"""
+        with self.lock:
+            key = self.keys.pop(id(compiler))
+            compiler.force = key[4]
+            compiler.__dict__.pop('spawn', None)
+            self.idle.setdefault(key, []).append(compiler)
 
 
 class BuildC(OrchCommand):
@@ -310,18 +1743,34 @@ class BuildC(OrchCommand):
     dry_run = 0
     force = 0
 
+    build_options = ()
+    spawn_error = CompileError
+    executable_output = False
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.result = None
 
     def new_compiler(self):
-        compiler = new_compiler(self.get_option('plat'),
-                                self.get_option('compiler'),
-                                self.get_option('verbose'),
-                                self.get_option('dry_run'),
-                                self.get_option('force'))
-        customize_compiler(compiler)
-        return compiler
+        """returns a configured compiler. it is checked out of the ``compiler_pool``
+        of the distribution if there is one. pass it to ``release_compiler`` when done"""
+        key = (self.get_option('plat'),
+               self.get_option('compiler'),
+               self.get_option('verbose'),
+               self.get_option('dry_run'),
+               self.get_option('force'))
+        pool = getattr(self.distribution, 'compiler_pool', None)
+        if pool is None:
+            return CompilerPool.configure(*key)
+        return pool.acquire(key)
+
+    def release_compiler(self, compiler):
+        """give ``compiler`` returned by ``new_compiler`` back"""
+        pool = getattr(self.distribution, 'compiler_pool', None)
+        if pool is not None:
+            pool.release(compiler)
+        else:
+            compiler.__dict__.pop('spawn', None)
 
     def get_option(self, option):
         value = getattr(self, option)
@@ -331,6 +1780,318 @@ class BuildC(OrchCommand):
         else:
             return value
 
+    INCLUDE_FLAGS = ('-isystem', '-iquote', '-idirafter', '-I')
+
+    @classmethod
+    def flag_include_dirs(cls, args):
+        """returns the directories given by ``INCLUDE_FLAGS`` in the command line ``args``"""
+        dirs = []
+        args = iter(args or ())
+        for arg in args:
+            for flag in cls.INCLUDE_FLAGS:
+                if arg == flag:
+                    dirs.append(next(args, ''))
+                    break
+                if arg.startswith(flag):
+                    dirs.append(arg[len(flag):])
+                    break
+        return dirs
+
+    def header_dirs(self):
+        """returns the directories headers are searched in, in the order the
+        compiler does: those given by ``INCLUDE_FLAGS`` in its flags, as taken
+        from ``CFLAGS``, and in ``extra_preargs``, ``include_dirs``, those of the
+        compiler and those in ``extra_postargs``"""
+        compiler = self.new_compiler()
+        try:
+            flags = list(getattr(compiler, 'compiler_so', None) or ())[1:]
+            compiler_dirs = list(compiler.include_dirs)
+        finally:
+            self.release_compiler(compiler)
+        return (self.flag_include_dirs(flags) +
+                self.flag_include_dirs(self.get_option('extra_preargs')) +
+                list(self.get_option('include_dirs') or ()) + compiler_dirs +
+                self.flag_include_dirs(self.get_option('extra_postargs')))
+
+        for option in self.build_options:
+            self.get_option(option)
+        return super().get_state()
+
+    def options_resolved(self):
+        """returns whether the ``build_options`` given as callables, such as
+        ``Builder.result_of``, resolve to a value. they give None, or fail on
+        it, while the commands they take the results of have not run"""
+        for option in self.build_options:
+            if isinstance(getattr(self, option), typing.Callable):
+                try:
+                    if self.get_option(option) is None:
+                        return False
+                except (TypeError, AttributeError):
+                    return False
+        return True
+
+    def build(self, compiler):
+        """invoke ``compiler``. returns the result
+
+        a subclass which does not override it is left to do its work in
+        ``run`` itself, after calling ``super().run()``"""
+        return None
+
+    def overrides_build(self):
+        """returns whether the class of this command overrides ``build``"""
+        return type(self).build is not BuildC.build
+
+    def input_files(self):
+        """returns the files read by ``build``"""
+        return []
+
+    def output_files(self):
+        """returns the files written by ``build``. called after ``result`` is set"""
+        return []
+
+    def is_cacheable(self):
+        """returns whether the result of this command can be taken from the build database"""
+        return not self.get_option('dry_run')
+
+    def ninja_inputs(self):
+        """returns the files ``build`` reads, for a ninja file"""
+        return self.input_files()
+
+    def ninja_edges(self, compiler):
+        """call ``build`` with the command lines ``compiler`` spawns recorded
+        instead of run, setting ``result``. returns the ninja build edges, a list
+        of ``(outputs, inputs, command lines, depfile)``"""
+        self.result, cmds = self.capture_spawns(compiler, self.build, compiler)
+        return [(self.output_files(), self.ninja_inputs(), cmds, None)]
+
+    @staticmethod
+    def depfile_edge(compiler, outputs, inputs, cmds):
+        """returns the ninja build edge running ``cmds``. with a unix compiler,
+        the headers they read are tracked through a depfile written by ``-MMD``"""
+        depfile = None
+        if compiler.compiler_type == 'unix' and cmds:
+            depfile = outputs[0] + '.d'
+            cmds = [cmd + ['-MMD', '-MF', depfile] for cmd in cmds]
+        return outputs, inputs, cmds, depfile
+
+    @staticmethod
+    def compiler_identity(compiler):
+        """returns the type and the executables of ``compiler``, with the
+        ``CompilerPool.program_version`` of the programs they run"""
+        executables = sorted((k, getattr(compiler, k, None)) for k in compiler.executables)
+        programs = sorted({cmd[0] for k, cmd in executables if cmd})
+        return (compiler.compiler_type, executables,
+                [(program, CompilerPool.program_version(program)) for program in programs])
+
+    def build_key(self, compiler, db):
+        """returns the digest of everything that affects the result of ``build``"""
+        h = hashlib.sha256()
+        h.update(repr((self.__class__.build.__qualname__,
+                       self.compiler_identity(compiler),
+                       [(k, self.get_option(k)) for k in self.build_options])).encode())
+        for path in self.input_files():
+            h.update(repr((path, db.file_digest(path))).encode())
+        return h.hexdigest()
+
+    def restore(self, compiler, key):
+        """take ``result`` from the build database if ``key`` is up to date
+
+        returns whether it was restored"""
+        if key is None or self.get_option('force'):
+            return False
+        entry = self.distribution.build_db.lookup(self.get_command_name(), key)
+        if entry is None:
+            # the inputs have changed. don't let second-granularity timestamps skip the work
+            compiler.force = 1
+            return False
+        self.result = entry['result']
+        return True
+
+    def cache_key(self, compiler):
+        """returns the ``build_key`` to look up in the build database,
+        or None if the database is not used"""
+        db = getattr(self.distribution, 'build_db', None)
+        if db is None or not self.is_cacheable():
+            return None
+        return self.build_key(compiler, db)
+
+    def store(self, key):
+        """record ``result`` in the build database"""
+        if key is not None:
+            self.distribution.build_db.record(self.get_command_name(), key,
+                                              self.result, self.output_files())
+
+    def output_artifact(self, compiler):
+        """returns ``(key, path)`` of the single output of this command to share
+        through the artifact cache of the distribution, or None not to share it.
+        only for commands whose ``result`` is None"""
+        return None
+
+    @staticmethod
+    def fetch_artifact(cache, key, path, executable=False):
+        """write the artifact ``key`` of ``cache`` to ``path``. returns whether it was there"""
+        data = cache.get(key)
+        if data is None:
+            return False
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmpname = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmpname, 'wb') as f:
+            f.write(data)
+        if executable:
+            mode = os.stat(tmpname).st_mode
+            os.chmod(tmpname, mode | (mode & 0o444) >> 2)
+        os.replace(tmpname, path)
+        return True
+
+    @staticmethod
+    def store_artifact(cache, key, path):
+        """store the file ``path`` into ``cache`` under ``key``"""
+        with open(path, 'rb') as f:
+            cache.put(key, f.read())
+
+    def fetch_output(self, compiler):
+        """restore the output of this command from the artifact cache
+
+        returns a tuple of whether it was restored and the ``output_artifact``
+        to pass to ``store_output`` after building"""
+        cache = getattr(self.distribution, 'artifact_cache', None)
+        if cache is None or self.get_option('dry_run'):
+            return False, None
+        artifact = self.output_artifact(compiler)
+        if artifact is None:
+            return False, None
+        if self.fetch_artifact(cache, *artifact, executable=self.executable_output):
+            self.result = None
+            return True, artifact
+        return False, artifact
+
+    def store_output(self, artifact):
+        """store the output built for ``artifact`` into the artifact cache"""
+        if artifact is not None:
+            self.store_artifact(self.distribution.artifact_cache, *artifact)
+
+    @staticmethod
+    def capture_spawns(compiler, fn, *args):
+        """call ``fn`` with the commands ``compiler`` spawns recorded instead of run
+
+        returns a tuple of the result and the list of recorded command lines"""
+        cmds = []
+        compiler.spawn = cmds.append
+        try:
+            result = fn(*args)
+        finally:
+            del compiler.spawn
+        return result, cmds
+
+    async def build_async(self, compiler):
+        """coroutine version of ``build``. the commands ``build`` spawns are
+        run one after another in ``asyncio`` subprocesses"""
+        result, cmds = self.capture_spawns(compiler, self.build, compiler)
+        for cmd in cmds:
+            await self.distribution.spawn_async(cmd, self.spawn_error, compiler.dry_run)
+        return result
+
+    def track_spawns(self, compiler):
+        """let the distribution spawn the commands of ``compiler`` so it can terminate them"""
+        spawn = getattr(self.distribution, 'spawn', None)
+        if spawn is not None and type(compiler).spawn is CCompiler.spawn:
+            compiler.spawn = partial(spawn, dry_run=compiler.dry_run)
+
+    def run(self):
+        super().run()
+        if not self.overrides_build():
+            return
+        compiler = self.new_compiler()
+        self.track_spawns(compiler)
+        try:
+            key = self.cache_key(compiler)
+            if not self.restore(compiler, key):
+                fetched, artifact = self.fetch_output(compiler)
+                if not fetched:
+                    self.result = self.build(compiler)
+                    self.store_output(artifact)
+                self.store(key)
+        finally:
+            self.release_compiler(compiler)
+
+    async def run_async(self):
+        """run this command on the event loop of an asynchronous ``OrchDistribution``
+
+        a command which does not override ``build`` is run by ``run`` in a thread"""
+        if not self.overrides_build():
+            await asyncio.get_event_loop().run_in_executor(None, self.run)
+            return
+        compiler = self.new_compiler()
+        try:
+            key = self.cache_key(compiler)
+            if not self.restore(compiler, key):
+                fetched, artifact = self.fetch_output(compiler)
+                if not fetched:
+                    self.result = await self.build_async(compiler)
+                    self.store_output(artifact)
+                self.store(key)
+        finally:
+            self.release_compiler(compiler)
+
+
+class MemoryBudget:
+    """bytes that may be held in memory at a time, shared by threads"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, size):
+        """take ``size`` bytes. returns False if they are not left"""
+        with self.lock:
+            if self.used + size > self.limit:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size):
+        """give back ``size`` bytes"""
+        with self.lock:
+            self.used -= size
+
+
+class PreprocessedSource:
+    """a translation unit preprocessed by ``Preprocess`` into memory
+
+    ``name`` is the ``output_file`` it stands for, which names the object
+    compiled from it, and ``command`` the ``Preprocess`` command producing it.
+    ``data`` is dropped by ``release`` once the commands using it have run"""
+
+    __slots__ = ('name', 'data', 'digest', 'budget', 'command')
+
+    def __init__(self, name, data, budget=None, command=None):
+        self.name = name
+        self.data = data
+        self.digest = hashlib.sha256(data).hexdigest()
+        self.budget = budget
+        self.command = command
+
+    def __repr__(self):
+        return 'PreprocessedSource(%r, %r)' % (self.name, self.digest)
+
+    def release(self):
+        """drop ``data`` and give its memory back to the budget"""
+        if self.data is not None and self.budget is not None:
+            self.budget.release(len(self.data))
+        self.data = None
+
+    def read(self):
+        """returns ``data``
+
+        raise ``CompileError`` if it has been released"""
+        if self.data is None:
+            raise CompileError('%s has been released; run %s again'
+                               % (self.name, self.command or 'its Preprocess'))
+        return self.data
+
 
 class Preprocess(BuildC):
     source = None
@@ -339,16 +2100,210 @@ class Preprocess(BuildC):
     include_dirs = None
     extra_preargs = None
     extra_postargs = None
+    in_memory = False
 
-    def run(self):
-        super().run()
-        compiler = self.new_compiler()
-        self.result = compiler.preprocess(self.get_option('source'),
-                                          self.get_option('output_file'),
-                                          self.get_option('macros'),
-                                          self.get_option('include_dirs'),
-                                          self.get_option('extra_preargs'),
-                                          self.get_option('extra_postargs'))
+    build_options = ('source', 'output_file', 'macros', 'include_dirs',
+                     'extra_preargs', 'extra_postargs')
+
+    def build(self, compiler):
+        """preprocess ``source`` into ``output_file``
+
+        with ``in_memory`` set and a unix compiler, the output is held in a
+        ``PreprocessedSource`` as long as the ``pipeline_budget`` of the
+        distribution allows, otherwise written to ``output_file``. ``result`` is
+        then a list of either, to be passed in ``sources`` of ``Compile``"""
+        if self.preprocesses_in_memory(compiler):
+            cmds = self.in_memory_commands(compiler)
+            try:
+                data = b''.join(self.distribution.spawn(cmd, capture_output=True) for cmd in cmds)
+            except DistutilsExecError as e:
+                raise CompileError(e)
+            return self.hold_in_memory(data)
+        return compiler.preprocess(self.get_option('source'),
+                                   self.get_option('output_file'),
+                                   self.get_option('macros'),
+                                   self.get_option('include_dirs'),
+                                   self.get_option('extra_preargs'),
+                                   self.get_option('extra_postargs'))
+
+    async def build_async(self, compiler):
+        """coroutine version of ``build``. the output held in memory is read from
+        the standard output of ``asyncio`` subprocesses"""
+        if not self.preprocesses_in_memory(compiler):
+            return await super().build_async(compiler)
+        data = b''
+        for cmd in self.in_memory_commands(compiler):
+            data += await self.distribution.spawn_async(cmd, self.spawn_error, capture_output=True)
+        return self.hold_in_memory(data)
+
+    def preprocesses_in_memory(self, compiler):
+        """returns whether ``build`` holds the output in memory"""
+        return (self.get_option('in_memory') and compiler.compiler_type == 'unix' and
+                self.get_option('output_file') is not None and not compiler.dry_run and
+                hasattr(self.distribution, 'pipeline_budget'))
+
+    def in_memory_commands(self, compiler):
+        """returns the command lines writing the preprocessed ``source`` to standard output"""
+        return self.capture_spawns(compiler, compiler.preprocess,
+                                   self.get_option('source'), None,
+                                   self.get_option('macros'),
+                                   self.get_option('include_dirs'),
+                                   self.get_option('extra_preargs'),
+                                   self.get_option('extra_postargs'))[1]
+
+    def hold_in_memory(self, data):
+        """returns ``result`` for the preprocessed ``data``, held in memory if the
+        budget allows, otherwise written to ``output_file``"""
+        output_file = self.get_option('output_file')
+        budget = self.distribution.pipeline_budget
+        if budget.reserve(len(data)):
+            return [PreprocessedSource(output_file, data, budget, self.get_command_name())]
+        log.info('orchdist: pipeline memory exhausted, writing %s', output_file)
+        dirname = os.path.dirname(output_file)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(output_file, 'wb') as f:
+            f.write(data)
+        return [output_file]
+
+    def release_result(self):
+        """release the ``PreprocessedSource`` in ``result``. this command is then
+        marked not run, so it runs again before a command using it does"""
+        released = False
+        for source in self.result if isinstance(self.result, list) else ():
+            if isinstance(source, PreprocessedSource) and source.data is not None:
+                source.release()
+                released = True
+        if released:
+            self.distribution.have_run[self.get_command_name()] = 0
+
+    def input_files(self):
+        db = self.distribution.build_db
+        source = self.get_option('source')
+        return [source] + db.headers([source], self.header_dirs())
+
+    def output_files(self):
+        if self.get_option('in_memory') and isinstance(self.result, list):
+            return [path for path in self.result if isinstance(path, str)]
+        return [self.get_option('output_file')]
+
+    def is_cacheable(self):
+        return (super().is_cacheable() and self.get_option('output_file') is not None and
+                not self.get_option('in_memory'))
+
+    def ninja_inputs(self):
+        return [self.get_option('source')]
+
+    def ninja_edges(self, compiler):
+        """the output is written to ``output_file``, even with ``in_memory`` set"""
+        _, cmds = self.capture_spawns(compiler, compiler.preprocess,
+                                      self.get_option('source'),
+                                      self.get_option('output_file'),
+                                      self.get_option('macros'),
+                                      self.get_option('include_dirs'),
+                                      self.get_option('extra_preargs'),
+                                      self.get_option('extra_postargs'))
+        self.result = [self.get_option('output_file')] if self.get_option('in_memory') else None
+        return [self.depfile_edge(compiler, self.output_files(), self.ninja_inputs(), cmds)]
+
+
+def write_if_changed(path, content):
+    """write ``content`` to the generated file ``path`` unless it is there already,
+    keeping its mtime so what depends on it is not rebuilt"""
+    try:
+        with open(path) as f:
+            if f.read() == content:
+                return
+    except OSError:
+        pass
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+class PrecompileHeader(BuildC):
+    """precompile ``header`` into ``output_dir`` with a gcc or clang compiler
+
+    ``result`` is the header to pass as ``pch`` of ``Compile``. it sits next
+    to the precompiled one and includes ``header``, so the compiler falls back
+    to it if the precompiled header is stale. the consumers have to be
+    compiled with the same macros and flags. with other compilers nothing is
+    done and ``result`` is None"""
+
+    header = None
+    output_dir = None
+    macros = None
+    include_dirs = None
+    debug = 0
+    extra_preargs = None
+    extra_postargs = None
+    language = None
+
+    build_options = ('header', 'output_dir', 'macros', 'include_dirs', 'debug',
+                     'extra_preargs', 'extra_postargs', 'language')
+
+    SUFFIXES = ('.gch', '.pch')
+    CXX_SUFFIXES = ('.hh', '.hpp', '.hxx', '.H', '.h++')
+
+    def include_file(self):
+        """returns the header the consumers include"""
+        return os.path.join(self.get_option('output_dir') or '',
+                            os.path.basename(self.get_option('header')))
+
+    @classmethod
+    def pch_file(cls, compiler, include):
+        """returns the precompiled header ``compiler`` looks for when including ``include``"""
+        if 'clang' in os.path.basename(compiler.compiler_so[0]):
+            return include + cls.SUFFIXES[1]
+        return include + cls.SUFFIXES[0]
+
+    def build(self, compiler):
+        if compiler.compiler_type != 'unix':
+            log.warn('%s: precompiled headers need gcc or clang', self.get_command_name())
+            return None
+        header = self.get_option('header')
+        include = self.include_file()
+        language = self.get_option('language')
+        if language is None:
+            language = 'c++' if header.endswith(self.CXX_SUFFIXES) else 'c'
+        compiler.mkpath(os.path.dirname(include) or '.')
+        content = '#include "%s"\n' % os.path.abspath(header).replace('\\', '/')
+        if not compiler.dry_run:
+            write_if_changed(include, content)
+        argv = list(compiler.compiler_so)
+        argv += gen_preprocess_options(self.get_option('macros') or [],
+                                       self.get_option('include_dirs') or [])
+        if self.get_option('debug'):
+            argv.append('-g')
+        argv += list(self.get_option('extra_preargs') or ())
+        argv += ['-x', language + '-header', header, '-o', self.pch_file(compiler, include)]
+        argv += list(self.get_option('extra_postargs') or ())
+        compiler.spawn(argv)
+        return include
+
+    def input_files(self):
+        db = self.distribution.build_db
+        header = self.get_option('header')
+        return [header] + db.headers([header], self.header_dirs())
+
+    def output_files(self):
+        if self.result is None:
+            return []
+        return [self.result] + [self.result + suffix for suffix in self.SUFFIXES
+                                if os.path.exists(self.result + suffix)]
+
+    def ninja_inputs(self):
+        return [self.get_option('header')]
+
+    def ninja_edges(self, compiler):
+        edges = super().ninja_edges(compiler)
+        if self.result is not None:
+            edges = [self.depfile_edge(compiler, [self.pch_file(compiler, self.result)],
+                                       inputs, cmds)
+                     for outputs, inputs, cmds, depfile in edges]
+        return edges
 
 
 class Compile(BuildC):
@@ -360,18 +2315,285 @@ class Compile(BuildC):
     extra_preargs = None
     extra_postargs = None
     depends = None
+    pch = None
+    parallel = True
+    unity = 0
+    unity_dir = None
+
+    build_options = ('sources', 'output_dir', 'macros', 'include_dirs', 'debug',
+                     'extra_preargs', 'extra_postargs', 'depends')
+
+    LINEMARKER_RE = re.compile(rb'^#(?:line)? *\d+[^\n]*\n?', re.M)
+    # flags of the preprocessor, with their forms taking the next argument
+    PREPROCESSOR_FLAGS = ('-I', '-D', '-U', '-isystem', '-iquote', '-idirafter',
+                          '-include', '-imacros')
+    PREPROCESSED_SUFFIXES = {'.cc': '.ii', '.cpp': '.ii', '.cxx': '.ii', '.C': '.ii', '.m': '.mi'}
+    PREPROCESSED_LANGUAGES = {'.ii': 'c++-cpp-output', '.mi': 'objective-c-cpp-output'}
+
+    def memory_sources(self):
+        """returns the ``PreprocessedSource`` in ``sources``"""
+        return [source for source in self.get_option('sources') or ()
+                if isinstance(source, PreprocessedSource)]
+
+    def unity_batches(self, sources):
+        """split ``sources`` into batches of about ``unity`` sources with the same suffix
+
+        a batch ends after a source whose path hashes to a multiple of
+        ``unity``, or at twice that size. adding or removing a source only
+        touches its own batch, so the others stay up to date"""
+        size = self.get_option('unity')
+        groups = {}
+        for source in sorted(sources):
+            groups.setdefault(os.path.splitext(source)[1], []).append(source)
+        batches = []
+        for suffix in sorted(groups):
+            batch = []
+            for source in groups[suffix]:
+                batch.append(source)
+                if (int(hashlib.sha1(source.encode()).hexdigest()[:8], 16) % size == 0 or
+                        len(batch) >= 2 * size):
+                    batches.append(batch)
+                    batch = []
+            if batch:
+                batches.append(batch)
+        return batches
+
+    def translation_units(self):
+        """returns the sources to compile. in unity mode, every batch of more than
+        one source is compiled as a generated source under ``unity_dir`` which
+        includes them. a ``PreprocessedSource`` is compiled alone"""
+        sources = self.get_option('sources')
+        memory = self.memory_sources()
+        if memory:
+            sources = [source for source in sources if not isinstance(source, PreprocessedSource)]
+        if not self.get_option('unity'):
+            return sources + memory
+        unity_dir = self.get_option('unity_dir')
+        if unity_dir is None:
+            unity_dir = os.path.join(self.get_option('output_dir') or '', 'unity')
+        units = []
+        for batch in self.unity_batches(sources):
+            if len(batch) == 1:
+                units.append(batch[0])
+                continue
+            suffix = os.path.splitext(batch[0])[1]
+            unit = os.path.join(unity_dir, 'unity_%s%s' % (
+                hashlib.sha1(batch[0].encode()).hexdigest()[:12], suffix))
+            content = ''.join('#include "%s"\n' % os.path.abspath(source).replace('\\', '/')
+                              for source in batch)
+            if not self.get_option('dry_run'):
+                write_if_changed(unit, content)
+            units.append(unit)
+        return units + memory
+
+    def build_key(self, compiler, db):
+        key = super().build_key(compiler, db)
+        if self.get_option('unity'):
+            key = hashlib.sha256(repr((key, self.get_option('unity'),
+                                       self.get_option('unity_dir'))).encode()).hexdigest()
+        return key
+
+    def compile_args(self):
+        """returns the arguments of ``compiler.compile`` after the sources
+
+        the header made by ``PrecompileHeader`` whose ``result`` is ``pch`` is
+        included ahead of every source and depended on"""
+        args = [self.get_option(option) for option in self.build_options[1:]]
+        pch = self.get_option('pch')
+        if pch:
+            args[4] = ['-include', pch, '-Winvalid-pch'] + list(args[4] or ())
+            args[6] = list(args[6] or ()) + [pch]
+        return args
+
+    def preprocess_source(self, compiler, source, args):
+        """returns the preprocessed content of ``source``"""
+        output_dir, macros, include_dirs, debug, extra_preargs, extra_postargs, depends = args
+        fd, preprocessed = tempfile.mkstemp(suffix='.i')
+        os.close(fd)
+        os.remove(preprocessed)
+        try:
+            compiler.preprocess(source, preprocessed, macros, include_dirs,
+                                extra_preargs, extra_postargs)
+            with open(preprocessed, 'rb') as f:
+                return f.read()
+        finally:
+            if os.path.exists(preprocessed):
+                os.remove(preprocessed)
+
+    def source_key(self, compiler, source, args, preprocessed):
+        """returns the key of the object of ``source`` in the artifact cache
+
+        it is computed from the ``preprocessed`` source without line markers,
+        so the same translation unit shares its object across checkouts. with
+        debugging information, which records the paths of the source and the
+        working directory, only within a checkout"""
+        output_dir, macros, include_dirs, debug, extra_preargs, extra_postargs, depends = args
+        # the precompiled header is part of the preprocessed source
+        extra_preargs = self.get_option('extra_preargs')
+        flags = (list(getattr(compiler, 'compiler_so', None) or ()) + (['-g'] if debug else []) +
+                 list(extra_preargs or ()) + list(extra_postargs or ()))
+        location = None
+        for flag in flags:
+            # the last of the ``-g`` flags wins
+            if flag.startswith('-g'):
+                location = (os.getcwd(), source) if flag != '-g0' else None
+        h = hashlib.sha256(repr(('compile', self.compiler_identity(compiler),
+                                 os.path.splitext(source)[1], debug,
+                                 extra_preargs, extra_postargs, location)).encode())
+        h.update(self.LINEMARKER_RE.sub(b'', preprocessed))
+        return h.hexdigest()
 
-    def run(self):
-        super().run()
-        compiler = self.new_compiler()
-        self.result = compiler.compile(self.get_option('sources'),
-                                       self.get_option('output_dir'),
-                                       self.get_option('macros'),
-                                       self.get_option('include_dirs'),
-                                       self.get_option('debug'),
-                                       self.get_option('extra_preargs'),
-                                       self.get_option('extra_postargs'),
-                                       self.get_option('depends'))
+    @classmethod
+    def strip_preprocessor_flags(cls, args):
+        """returns the command line ``args`` without the ``PREPROCESSOR_FLAGS``
+        and ``-Wp,`` flags, which do nothing to a preprocessed source"""
+        result = []
+        args = iter(args)
+        for arg in args:
+            if arg in cls.PREPROCESSOR_FLAGS:
+                next(args, None)
+            elif not (arg.startswith(cls.PREPROCESSOR_FLAGS) or arg.startswith('-Wp,')):
+                result.append(arg)
+        return result
+
+    def compile_remote(self, compiler, source, args, preprocessed, obj):
+        """compile the ``preprocessed`` source on a remote worker of the distribution
+
+        the preprocessed translation unit already carries the headers, so
+        workers need no checkout. returns whether a worker compiled it"""
+        if compiler.compiler_type != 'unix':
+            return False
+        output_dir, macros, include_dirs, debug, extra_preargs, extra_postargs, depends = args
+        extra_preargs = self.get_option('extra_preargs')
+        argv = list(compiler.compiler_so)
+        if debug:
+            argv.append('-g')
+        argv += list(extra_preargs or ()) + ['-c', remote.INPUT, '-o', remote.OUTPUT]
+        argv += list(extra_postargs or ())
+        argv = argv[:1] + self.strip_preprocessor_flags(argv[1:])
+        suffix = self.PREPROCESSED_SUFFIXES.get(os.path.splitext(source)[1], '.i')
+        dirname = os.path.dirname(obj)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        log.info('compiling %s remotely', source)
+        return self.distribution.remote_executor.compile(argv, suffix, preprocessed, obj)
+
+    def compile_memory(self, compiler, args, source):
+        """compile the ``PreprocessedSource`` ``source``, feeding it through the
+        standard input of the compiler. returns its object"""
+        output_dir, macros, include_dirs, debug, extra_preargs, extra_postargs, depends = args
+        # the precompiled header is part of the preprocessed source
+        extra_preargs = self.get_option('extra_preargs')
+        obj = compiler.object_filenames([source.name], output_dir=output_dir or '')[0]
+        suffix = self.PREPROCESSED_SUFFIXES.get(os.path.splitext(source.name)[1], '.i')
+        argv = list(compiler.compiler_so)
+        if debug:
+            argv.append('-g')
+        argv += list(extra_preargs or ()) + ['-x', self.PREPROCESSED_LANGUAGES.get(suffix, 'cpp-output'),
+                                             '-c', '-', '-o', obj]
+        argv += list(extra_postargs or ())
+        compiler.mkpath(os.path.dirname(obj))
+        data = source.read()
+        try:
+            self.distribution.spawn(argv, dry_run=compiler.dry_run, input=data)
+        except DistutilsExecError as e:
+            raise CompileError(e)
+        return obj
+
+    def compile_source(self, compiler, args, source):
+        """compile ``source`` alone
+
+        its object is taken from the artifact cache if there, otherwise it is
+        compiled on a remote worker if any takes it, or locally"""
+        cache = getattr(self.distribution, 'artifact_cache', None)
+        executor = getattr(self.distribution, 'remote_executor', None)
+        memory = isinstance(source, PreprocessedSource)
+        if (cache is None and executor is None) or compiler.dry_run:
+            if memory:
+                return [self.compile_memory(compiler, args, source)]
+            return compiler.compile([source], *args)
+        name = source.name if memory else source
+        obj = compiler.object_filenames([name], output_dir=args[0] or '')[0]
+        if memory:
+            preprocessed = source.read()
+        else:
+            preprocessed = self.preprocess_source(compiler, source, args)
+        if cache is not None:
+            key = self.source_key(compiler, name, args, preprocessed)
+            if self.fetch_artifact(cache, key, obj):
+                return [obj]
+        if executor is None or not self.compile_remote(compiler, name, args, preprocessed, obj):
+            if memory:
+                obj = self.compile_memory(compiler, args, source)
+            else:
+                obj = compiler.compile([source], *args)[0]
+        if cache is not None:
+            self.store_artifact(cache, key, obj)
+        return [obj]
+
+    def build(self, compiler):
+        """compile ``sources``. if ``parallel`` is set, every translation unit is
+        compiled as a separate job on the workers of the distribution"""
+        sources = self.translation_units()
+        args = self.compile_args()
+        map_jobs = getattr(self.distribution, 'map_jobs', None)
+        if self.get_option('parallel') and map_jobs is not None and len(sources) > 1:
+            objects = map_jobs(partial(self.compile_source, compiler, args), sources)
+        elif (getattr(self.distribution, 'artifact_cache', None) is not None or
+              getattr(self.distribution, 'remote_executor', None) is not None or
+              self.memory_sources()):
+            objects = [self.compile_source(compiler, args, source) for source in sources]
+        else:
+            return compiler.compile(sources, *args)
+        return [obj for objs in objects for obj in objs]
+
+    async def build_async(self, compiler):
+        """compile ``sources`` in concurrent ``asyncio`` subprocesses
+
+        with an artifact cache or remote workers, ``compile_source`` runs in
+        threads of the default executor instead"""
+        sources = self.translation_units()
+        args = self.compile_args()
+        if ((getattr(self.distribution, 'artifact_cache', None) is None and
+             getattr(self.distribution, 'remote_executor', None) is None and
+             not self.memory_sources()) or compiler.dry_run):
+            result, cmds = self.capture_spawns(compiler, compiler.compile, sources, *args)
+            await asyncio.gather(*[self.distribution.spawn_async(cmd, self.spawn_error, compiler.dry_run)
+                                   for cmd in cmds])
+            return result
+        event_loop = asyncio.get_event_loop()
+        objects = await asyncio.gather(*[
+            event_loop.run_in_executor(None, self.compile_source, compiler, args, source)
+            for source in sources])
+        return [obj for objs in objects for obj in objs]
+
+    def ninja_edges(self, compiler):
+        """one edge per translation unit. with a unix compiler, its headers are
+        tracked through a depfile written by ``-MMD``"""
+        args = self.compile_args()
+        depends = list(self.get_option('depends') or ())
+        self.result = []
+        edges = []
+        for source in self.translation_units():
+            objects, cmds = self.capture_spawns(compiler, compiler.compile, [source], *args)
+            self.result.extend(objects)
+            edges.append(self.depfile_edge(compiler, objects, [source] + depends, cmds))
+        return edges
+
+    def input_files(self):
+        db = self.distribution.build_db
+        # a ``PreprocessedSource`` is part of ``build_key`` through its digest
+        sources = [source for source in self.get_option('sources')
+                   if not isinstance(source, PreprocessedSource)]
+        pch = self.get_option('pch')
+        if pch:
+            pch = [pch] + [pch + suffix for suffix in PrecompileHeader.SUFFIXES
+                           if os.path.exists(pch + suffix)]
+        return (sources + list(self.get_option('depends') or ()) + list(pch or ()) +
+                db.headers(sources, self.header_dirs()))
+
+    def output_files(self):
+        return list(self.result)
 
 
 class StaticLink(BuildC):
@@ -381,14 +2603,40 @@ class StaticLink(BuildC):
     debug = 0
     target_lang = None
 
-    def run(self):
-        super().run()
+    build_options = ('objects', 'output_libname', 'output_dir', 'debug', 'target_lang')
+    spawn_error = LibError
+
+    def library_path(self, compiler):
+        """returns the path of the library written, as named by ``compiler``"""
+        return compiler.library_filename(self.get_option('output_libname'),
+                                         output_dir=self.get_option('output_dir') or '')
+
+    def output_artifact(self, compiler):
+        static_lib = self.library_path(compiler)
+        h = hashlib.sha256(repr(('static_link', self.compiler_identity(compiler),
+                                 os.path.basename(static_lib),
+                                 self.get_option('debug'),
+                                 self.get_option('target_lang'))).encode())
+        for obj in self.get_option('objects'):
+            h.update(ArtifactCache.digest(obj).encode())
+        return h.hexdigest(), static_lib
+
+    def build(self, compiler):
+        return compiler.create_static_lib(self.get_option('objects'),
+                                          self.get_option('output_libname'),
+                                          self.get_option('output_dir'),
+                                          self.get_option('debug'),
+                                          self.get_option('target_lang'))
+
+    def input_files(self):
+        return list(self.get_option('objects'))
+
+    def output_files(self):
         compiler = self.new_compiler()
-        self.result = compiler.create_static_lib(self.get_option('objects'),
-                                                 self.get_option('output_libname'),
-                                                 self.get_option('output_dir'),
-                                                 self.get_option('debug'),
-                                                 self.get_option('target_lang'))
+        try:
+            return [self.library_path(compiler)]
+        finally:
+            self.release_compiler(compiler)
 
 
 class Link(BuildC):
@@ -409,30 +2657,82 @@ class Link(BuildC):
     build_temp = None
     target_lang = None
 
-    def run(self):
-        super().run()
+    build_options = ('target_desc', 'objects', 'output_filename', 'output_dir',
+                     'libraries', 'library_dirs', 'runtime_library_dirs',
+                     'export_symbols', 'debug', 'extra_preargs', 'extra_postargs',
+                     'build_temp', 'target_lang')
+    spawn_error = LinkError
+    executable_output = True
+    resources = {'link': 1}
+
+    def library_files(self, compiler):
+        """returns the files of ``libraries`` found in ``library_dirs`` by ``compiler``,
+        None for those not found there"""
+        dirs = list(self.get_option('library_dirs') or ()) + list(compiler.library_dirs)
+        libraries = list(self.get_option('libraries') or ()) + list(compiler.libraries)
+        return [compiler.find_library_file(dirs, lib, self.get_option('debug'))
+                for lib in libraries]
+
+    def output_artifact(self, compiler):
+        """the link is not shared if a library is not found in ``library_dirs``,
+        as its content cannot be part of the key"""
+        libraries = self.library_files(compiler)
+        if None in libraries:
+            return None
+        h = hashlib.sha256(repr(('link', self.compiler_identity(compiler),
+                                 [(k, self.get_option(k)) for k in self.build_options
+                                  if k not in ('objects', 'output_dir', 'build_temp')])).encode())
+        for path in list(self.get_option('objects')) + libraries:
+            h.update(ArtifactCache.digest(path).encode())
+        return h.hexdigest(), self.output_files()[0]
+
+    def build(self, compiler):
+        return compiler.link(self.get_option('target_desc'),
+                             self.get_option('objects'),
+                             self.get_option('output_filename'),
+                             self.get_option('output_dir'),
+                             self.get_option('libraries'),
+                             self.get_option('library_dirs'),
+                             self.get_option('runtime_library_dirs'),
+                             self.get_option('export_symbols'),
+                             self.get_option('debug'),
+                             self.get_option('extra_preargs'),
+                             self.get_option('extra_postargs'),
+                             self.get_option('build_temp'),
+                             self.get_option('target_lang'))
+
+    def input_files(self):
         compiler = self.new_compiler()
-        self.result = compiler.link(self.get_option('target_desc'),
-                                    self.get_option('objects'),
-                                    self.get_option('output_filename'),
-                                    self.get_option('output_dir'),
-                                    self.get_option('libraries'),
-                                    self.get_option('library_dirs'),
-                                    self.get_option('runtime_library_dirs'),
-                                    self.get_option('export_symbols'),
-                                    self.get_option('debug'),
-                                    self.get_option('extra_preargs'),
-                                    self.get_option('extra_postargs'),
-                                    self.get_option('build_temp'),
-                                    self.get_option('target_lang'))
+        try:
+            libraries = self.library_files(compiler)
+        finally:
+            self.release_compiler(compiler)
+        return list(self.get_option('objects')) + [path for path in libraries if path is not None]
+
+    def output_files(self):
+        output_dir = self.get_option('output_dir')
+        output_filename = self.get_option('output_filename')
+        if output_dir is not None:
+            output_filename = os.path.join(output_dir, output_filename)
+        return [output_filename]
 
 
 class TargetCreator:
+    __slots__ = ('result',)
+
+    actions = {
+        'preprocess': Preprocess,
+        'precompile_header': PrecompileHeader,
+        'compile': Compile,
+        'static_link': StaticLink,
+        'link': Link,
+    }
+
     def __init__(self, result):
         self.result = result
 
     def do(self, cmdclass):
-        self.result['_cmdclass'] = cmdclass.create_subclass()
+        self.result['_cmdclass'] = cmdclass
         return self
 
     def set_option(self, option, value):
@@ -440,18 +2740,18 @@ class TargetCreator:
         return self
 
     def __getattr__(self, attr):
-        actions = {
-            'preprocess': partial(self.do, Preprocess),
-            'compile': partial(self.do, Compile),
-            'static_link': partial(self.do, StaticLink),
-            'link': partial(self.do, Link),
-        }
-        return actions.get(attr, partial(self.set_option, attr))
+        cmdclass = self.actions.get(attr)
+        if cmdclass is not None:
+            return partial(self.do, cmdclass)
+        return partial(self.set_option, attr)
 
     @staticmethod
-    def archive(target):
+    def archive(target, klass=None):
+        """set the options of ``target`` on ``klass``, a new subclass of its
+        command class if None. returns it"""
         target = target.copy()
-        klass = target['_cmdclass']
+        if klass is None:
+            klass = target['_cmdclass'].create_subclass()
         del target['_cmdclass']
         for k, v in target.items():
             getattr(klass, k)
@@ -459,31 +2759,184 @@ class TargetCreator:
         return klass
 
 
+class _ResultOf:
+    """option value resolving to the ``result`` of commands, concatenated if
+    there are several. unlike a lambda it can be pickled"""
+
+    __slots__ = ('commands',)
+
+    def __init__(self, *commands):
+        self.commands = commands
+
+    def __get__(self, cmd_obj, klass=None):
+        if cmd_obj is None:
+            return self
+        return partial(self.resolve, cmd_obj)
+
+    def __getstate__(self):
+        return self.commands
+
+    def __setstate__(self, state):
+        self.commands = state
+
+    def resolve(self, cmd_obj):
+        results = [cmd_obj.distribution.get_command_obj(command).result
+                   for command in self.commands]
+        if len(results) == 1:
+            return results[0]
+        return [item for result in results for item in result]
+
+
 class Builder(CommandCreator):
+    CACHE_VERSION = 1
+
     def __init__(self, distribution=None):
         super().__init__(distribution)
         self.targets = {}
 
     def target(self, name, deps=tuple()):
+        name = sys.intern(name)
         self.add(name, deps)
         self.targets[name] = {}
         return TargetCreator(self.targets[name])
 
+    def pch_target(self, command):
+        """returns the name of the target whose header ``command`` uses, or None"""
+        pch = self.targets[command].get('pch') if command in self.targets else None
+        if isinstance(pch, str) and pch in self.targets:
+            return pch
+        return None
+
+    def deps_of(self, command):
+        deps = super().deps_of(command)
+        pch = self.pch_target(command)
+        if deps is not None and pch is not None and pch not in deps:
+            deps += (pch,)
+        return deps
+
+    def command_class(self, command, klass=OrchCommand):
+        if command not in self.targets or command in self.cmdcls:
+            return super().command_class(command, klass)
+        target = self.targets[command]
+        pch = self.pch_target(command)
+        if pch is not None:
+            # a target name. depend on it and use its header
+            if pch not in self.cmddep[command]:
+                self.cmddep[command] += (pch,)
+            target = dict(target, pch=self.result_of(pch))
+        cmdclass = super().command_class(command, target['_cmdclass'])
+        return TargetCreator.archive(target, cmdclass)
+
     def create(self, command, klass=OrchCommand):
-        if command not in self.targets:
-            return super().create(command, klass)
+        if command in self.targets:
+            self.command_class(command)
+        return super().create(command, klass)
+
+    def result_of(self, *commands):
+        """returns an option value taking the ``result`` of ``commands``,
+        concatenated if there are several"""
+        return _ResultOf(*commands)
+
+    def add_target(self, name, action, deps=tuple(), **options):
+        """add target ``name`` of ``action``, a key of ``TargetCreator.actions``,
+        with ``options``. raise ``ValueError`` if the action or an option is unknown"""
+        cmdclass = TargetCreator.actions.get(action)
+        if cmdclass is None:
+            raise ValueError('unknown action %r of target %r' % (action, name))
+        for option in options:
+            if not hasattr(cmdclass, option):
+                raise ValueError('unknown option %r of target %r' % (option, name))
+        self.target(name, deps).do(cmdclass).result.update(options)
+
+    def load_manifest(self, manifest):
+        """add the targets of ``manifest``, a dict like ::
+
+            {"targets": {"main": {"action": "compile", "sources": ["main.c"]},
+                         "exe": {"action": "link", "deps": ["main"],
+                                 "objects": {"result_of": "main"},
+                                 "output_filename": "main"}}}
+
+        ``{"result_of": name}`` or ``{"result_of": [names]}`` stands for
+        ``result_of``"""
+        for name, target in manifest.get('targets', {}).items():
+            target = dict(target)
+            action = target.pop('action', None)
+            deps = target.pop('deps', ())
+            for option, value in target.items():
+                if isinstance(value, dict) and set(value) == {'result_of'}:
+                    commands = value['result_of']
+                    if isinstance(commands, str):
+                        commands = [commands]
+                    target[option] = self.result_of(*commands)
+            self.add_target(name, action, deps, **target)
+
+    def load(self, filename, cache=None):
+        """add the targets of the manifest ``filename``, JSON or, if it ends with
+        ``.toml``, TOML. see ``load_manifest``
+
+        the resolved targets are stored in ``cache``, ``filename + '.cache'`` by
+        default, keyed on the hash of the manifest, and loaded from it while the
+        manifest is unchanged. False disables the cache"""
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if cache is None:
+            cache = filename + '.cache'
+        key = hashlib.sha256(data).hexdigest()
+        if cache:
+            try:
+                with open(cache, 'rb') as f:
+                    version, cached_key, cmddep, targets = pickle.load(f)
+            except (OSError, ValueError, EOFError, AttributeError, ImportError,
+                    pickle.UnpicklingError):
+                # missing, or written by another version
+                pass
+            else:
+                if version == self.CACHE_VERSION and cached_key == key:
+                    self.cmddep.update(cmddep)
+                    self.targets.update(targets)
+                    return
+        if filename.endswith('.toml'):
+            try:
+                import tomllib
+            except ImportError:
+                import tomli as tomllib
+            manifest = tomllib.loads(data.decode())
         else:
-            return super().create(command, TargetCreator.archive(self.targets[command]))
-
-    def result_of(self, command):
-        return lambda self: self.distribution.get_command_obj(command).result
-
-
-__all__ = ('OrchDistribution',
+            manifest = json.loads(data.decode())
+        builder = Builder()
+        builder.load_manifest(manifest)
+        self.cmddep.update(builder.cmddep)
+        self.targets.update(builder.targets)
+        if cache:
+            tmpname = '%s.%d.tmp' % (cache, os.getpid())
+            try:
+                with open(tmpname, 'wb') as f:
+                    pickle.dump((self.CACHE_VERSION, key, builder.cmddep, builder.targets), f,
+                                pickle.HIGHEST_PROTOCOL)
+                os.replace(tmpname, cache)
+            except OSError as e:
+                log.warn('orchdist: cannot write manifest cache %s: %s', cache, e)
+
+
+__all__ = ('SequencifyFail',
+           'OrchDistribution',
+           'CommandsFailed',
+           'BuildHistory',
+           'BuildListener',
+           'CommandScheduler',
            'OrchCommand',
            'CommandCreator',
+           'BuildDatabase',
+           'ArtifactCache',
+           'LocalArtifactCache',
+           'HTTPArtifactCache',
+           'TieredArtifactCache',
+           'CompilerPool',
            'BuildC',
+           'MemoryBudget',
+           'PreprocessedSource',
            'Preprocess',
+           'PrecompileHeader',
            'Compile',
            'StaticLink',
            'Link',
@@ -0,0 +1,150 @@
+"""
+adaptive concurrency for orchdist
+
+``AdaptiveLimit`` samples the load average, the available memory and the
+pressure stall information of Linux (``/proc/pressure``) and moves the
+number of commands the scheduler runs at a time between its bounds: down
+by a quarter when the host is overloaded, up by one when the limit is
+reached and the load leaves room for another command
+"""
+
+
+#   Copyright (C) 2017 TitanSnow
+
+#   This library is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, write to the Free Software
+#   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#   USA
+
+
+from distutils import log
+import os
+
+
+def load_average():
+    """returns the load average of the last minute, or None if unknown"""
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+
+def available_memory():
+    """returns the memory available for new processes in bytes, or None if unknown"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def pressure(resource):
+    """returns the share in percent of the last 10 seconds some tasks were
+    stalled on ``resource``, ``'cpu'``, ``'memory'`` or ``'io'``, or None if unknown"""
+    try:
+        with open('/proc/pressure/' + resource) as f:
+            for line in f:
+                fields = line.split()
+                if fields and fields[0] == 'some':
+                    return float(dict(field.split('=') for field in fields[1:])['avg10'])
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def sample():
+    """returns the current ``load``, ``memory``, ``cpu_pressure`` and
+    ``memory_pressure``. those unknown are None"""
+    return {
+        'load': load_average(),
+        'memory': available_memory(),
+        'cpu_pressure': pressure('cpu'),
+        'memory_pressure': pressure('memory'),
+    }
+
+
+class AdaptiveLimit:
+    """number of commands to run at a time, adapted to the load of the host
+
+    keyword arguments:
+      min_workers: the lower bound of the limit
+      max_workers: the upper bound, the ``max_workers`` of the scheduler if None
+      interval: seconds between samples
+      max_load: load average above which the host is overloaded, the number
+        of CPUs by default
+      min_memory: bytes of available memory below which the host is
+        overloaded, 5% of the physical memory by default
+      cpu_pressure, memory_pressure: percent of stalled time above which the
+        host is overloaded
+      sampler: function returning the current load like ``sample``"""
+
+    def __init__(self, min_workers=1, max_workers=None, interval=1.0, max_load=None,
+                 min_memory=None, cpu_pressure=60.0, memory_pressure=10.0, sampler=sample):
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.interval = interval
+        self.max_load = max_load if max_load is not None else (os.cpu_count() or 1)
+        if min_memory is None:
+            try:
+                min_memory = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // 20
+            except (AttributeError, ValueError, OSError):
+                min_memory = 0
+        self.min_memory = min_memory
+        self.cpu_pressure = cpu_pressure
+        self.memory_pressure = memory_pressure
+        self.sampler = sampler
+        self.limit = None
+
+    def overloaded(self, current):
+        """returns whether ``current``, a result of ``sample``, shows the host overloaded"""
+        return any(value is not None and check(value) for value, check in (
+            (current.get('load'), lambda load: load > self.max_load),
+            (current.get('memory'), lambda memory: memory < self.min_memory),
+            (current.get('cpu_pressure'), lambda cpu: cpu > self.cpu_pressure),
+            (current.get('memory_pressure'), lambda memory: memory > self.memory_pressure),
+        ))
+
+    def clamp(self, limit):
+        return max(self.min_workers, min(self.max_workers, limit))
+
+    def start(self, max_workers):
+        """returns the limit to start with, the room left by the current load,
+        taking ``max_workers`` as the upper bound if none is given"""
+        if self.max_workers is None:
+            self.max_workers = max_workers
+        current = self.sampler()
+        if self.overloaded(current):
+            self.limit = self.min_workers
+        elif current.get('load') is not None:
+            self.limit = self.clamp(int(self.max_load - current['load'] + 0.5))
+        else:
+            self.limit = self.max_workers
+        return self.limit
+
+    def update(self, running):
+        """returns the limit for the next ``interval`` seconds, given the number of
+        commands ``running``"""
+        current = self.sampler()
+        limit = self.limit
+        if self.overloaded(current):
+            limit = self.clamp(limit - max(1, limit // 4))
+        elif running >= limit and (current.get('load') is None or
+                                   current['load'] + 1 <= self.max_load):
+            limit = self.clamp(limit + 1)
+        if limit != self.limit:
+            log.debug('orchdist: running up to %d commands at a time', limit)
+            self.limit = limit
+        return limit
@@ -0,0 +1,249 @@
+"""
+persistent build server for orchdist
+
+``BuildServer`` runs a setup script once and keeps the resulting
+distribution, its configured compilers and an in-memory build database
+between builds. ``build`` asks it over a Unix socket to run commands; the
+standard output and error of the client are passed to the server, so the
+output of the build goes straight to the client. ::
+
+    python -m orchdist.daemon serve setup.py &
+    python -m orchdist.daemon build build_ext
+    python -m orchdist.daemon stop
+"""
+
+
+#   Copyright (C) 2017 TitanSnow
+
+#   This library is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, write to the Free Software
+#   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#   USA
+
+
+from distutils import log
+from distutils.core import run_setup
+from distutils.errors import DistutilsError, CCompilerError
+import argparse
+import array
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+
+from . import BuildDatabase
+from .remote import send_message, recv_message
+
+
+SOCKET = '.orchdist-daemon.sock'
+
+
+def send_fds(sock, fds):
+    """send the file descriptors ``fds`` over the Unix socket ``sock``"""
+    sock.sendmsg([b'F'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+
+
+def recv_fds(sock, count):
+    """receive ``count`` file descriptors sent by ``send_fds``"""
+    fds = array.array('i')
+    msg, ancdata, flags, addr = sock.recvmsg(1, socket.CMSG_SPACE(count * fds.itemsize))
+    for level, type, data in ancdata:
+        if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+    if len(fds) != count:
+        for fd in fds:
+            os.close(fd)
+        raise ConnectionError('expected %d file descriptors' % count)
+    return list(fds)
+
+
+class BuildHandler(socketserver.BaseRequestHandler):
+    """handles a request of ``build`` or ``stop``"""
+
+    def handle(self):
+        header, _ = recv_message(self.request)
+        if header.get('stop'):
+            send_message(self.request, {'status': 0})
+            threading.Thread(target=self.server.shutdown).start()
+            return
+        fds = recv_fds(self.request, 2)
+        try:
+            status = self.server.build(header['commands'], header['cwd'], *fds)
+        finally:
+            for fd in fds:
+                os.close(fd)
+        send_message(self.request, {'status': status})
+
+
+class BuildServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """server building the commands of the distribution set up by ``script``
+
+    builds run one at a time in the directory the server was started in.
+    the script runs again when it has changed. the command objects are
+    created afresh for every build, while the build database skips the
+    commands whose inputs are unchanged"""
+
+    daemon_threads = True
+
+    def __init__(self, path, script):
+        if os.path.exists(path):
+            try:
+                with socket.socket(socket.AF_UNIX) as sock:
+                    sock.connect(path)
+            except OSError:
+                os.remove(path)
+            else:
+                raise OSError('a build server is listening on %s already' % path)
+        super().__init__(path, BuildHandler)
+        self.script = os.path.abspath(script)
+        self.cwd = os.getcwd()
+        self.lock = threading.Lock()
+        self.dist = None
+        self.loaded = None
+
+    def load(self):
+        """returns the distribution of the script, running it if it has changed"""
+        mtime = os.stat(self.script).st_mtime_ns
+        if self.dist is None or self.loaded != mtime:
+            dist = run_setup(self.script, script_args=[], stop_after='init')
+            if getattr(dist, 'build_db', False) is None:
+                dist.build_db = BuildDatabase(None)
+            self.dist, self.loaded = dist, mtime
+        return self.dist
+
+    def build(self, commands, cwd, stdout, stderr):
+        """run ``commands`` writing the output to the file descriptors ``stdout``
+        and ``stderr``. returns the exit status"""
+        with self.lock:
+            saved = os.dup(1), os.dup(2)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(stdout, 1)
+            os.dup2(stderr, 2)
+            streams = sys.stdout, sys.stderr
+            sys.stdout = open(1, 'w', closefd=False)
+            sys.stderr = open(2, 'w', closefd=False)
+            try:
+                if os.path.realpath(cwd) != os.path.realpath(self.cwd):
+                    sys.stderr.write('error: the build server runs in %s\n' % self.cwd)
+                    return 1
+                dist = self.load()
+                dist.command_obj.clear()
+                dist.have_run.clear()
+                dist.commands = list(commands)
+                dist.run_commands()
+            except (DistutilsError, CCompilerError, OSError, RuntimeError) as e:
+                sys.stderr.write('error: %s\n' % e)
+                return 1
+            except Exception as e:
+                log.error('orchdist: build failed: %r', e)
+                return 1
+            finally:
+                sys.stdout.close()
+                sys.stderr.close()
+                sys.stdout, sys.stderr = streams
+                os.dup2(saved[0], 1)
+                os.dup2(saved[1], 2)
+                os.close(saved[0])
+                os.close(saved[1])
+            return 0
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+
+def request(path, header, fds=None):
+    """send ``header``, and ``fds`` if any, to the server at ``path``. returns its reply"""
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(path)
+        send_message(sock, header)
+        if fds is not None:
+            send_fds(sock, fds)
+        return recv_message(sock)[0]
+
+
+def build(path, commands, stdout=None, stderr=None):
+    """let the server at ``path`` run ``commands``, writing the output to the file
+    descriptors ``stdout`` and ``stderr`` (those of this process by default).
+    returns the exit status"""
+    if stdout is None:
+        stdout = sys.stdout.fileno()
+    if stderr is None:
+        stderr = sys.stderr.fileno()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return request(path, {'commands': list(commands), 'cwd': os.getcwd()},
+                   [stdout, stderr])['status']
+
+
+def stop(path):
+    """stop the server at ``path``"""
+    request(path, {'stop': True})
+
+
+def start(path, script, timeout=30):
+    """start a server for ``script`` at ``path`` in the background and wait for it"""
+    subprocess.Popen([sys.executable, '-m', 'orchdist.daemon', 'serve',
+                      '--socket', path, script],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, start_new_session=True)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            with socket.socket(socket.AF_UNIX) as sock:
+                sock.connect(path)
+            return
+        except OSError:
+            if time.time() >= deadline:
+                raise
+            time.sleep(0.05)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='orchdist build server')
+    parser.add_argument('--socket', default=SOCKET)
+    subparsers = parser.add_subparsers(dest='action')
+    serve_parser = subparsers.add_parser('serve', help='run a build server')
+    serve_parser.add_argument('script', nargs='?', default='setup.py')
+    build_parser = subparsers.add_parser('build', help='build commands on the server')
+    build_parser.add_argument('--start', metavar='SCRIPT', default=None,
+                              help='start a server for SCRIPT if none is running')
+    build_parser.add_argument('commands', nargs='+')
+    subparsers.add_parser('stop', help='stop the server')
+    args = parser.parse_args(argv)
+    if args.action == 'serve':
+        server = BuildServer(args.socket, args.script)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+    elif args.action == 'build':
+        if args.start is not None and not os.path.exists(args.socket):
+            start(args.socket, args.start)
+        sys.exit(build(args.socket, args.commands))
+    elif args.action == 'stop':
+        stop(args.socket)
+    else:
+        parser.print_usage()
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+"""
+GNU make jobserver support for orchdist
+
+a jobserver is a pipe, or a named fifo, holding one byte per job slot
+shared by every process of a nested build. a process always owns one
+implicit slot and must read a token before starting any further job, then
+write it back when the job finishes. ``Jobserver.from_environ`` joins the
+jobserver advertised in ``MAKEFLAGS``; ``Jobserver.serve`` creates one for
+the sub builds spawned by commands
+"""
+
+
+#   Copyright (C) 2017 TitanSnow
+
+#   This library is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, write to the Free Software
+#   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#   USA
+
+
+from distutils import log
+import os
+import re
+import select
+import shutil
+import tempfile
+import threading
+
+
+AUTH_RE = re.compile(r'--jobserver-(?:auth|fds)=(\S+)')
+JOBS_RE = re.compile(r'^-j\S*$|^--jobs(=\S*)?$|^--jobserver-(auth|fds)=\S*$')
+TOKEN = b'+'
+
+
+def parse_makeflags(makeflags):
+    """returns the jobserver named by ``--jobserver-auth`` in ``makeflags``,
+    ``('fifo', path)`` or ``('pipe', (read_fd, write_fd))``, or None"""
+    auth = AUTH_RE.findall(makeflags or '')
+    if not auth:
+        return None
+    auth = auth[-1]
+    if auth.startswith('fifo:'):
+        return 'fifo', auth[len('fifo:'):]
+    try:
+        read_fd, write_fd = (int(fd) for fd in auth.split(','))
+    except ValueError:
+        return None
+    if read_fd < 0 or write_fd < 0:
+        return None
+    return 'pipe', (read_fd, write_fd)
+
+
+def strip_makeflags(makeflags):
+    """returns ``makeflags`` without its job options"""
+    return ' '.join(word for word in (makeflags or '').split() if not JOBS_RE.match(word))
+
+
+class Jobserver:
+    """client of a GNU make jobserver
+
+    ``read_fd`` and ``write_fd`` are the ends of the token pipe, ``fifo`` its
+    path if it is a named fifo. the read end is reopened non-blocking where the
+    platform allows, so waiting for a token never blocks a thread; otherwise
+    ``acquire_async`` waits in a helper thread
+
+    children need ``makeflags`` in their ``MAKEFLAGS`` and, for a pipe,
+    ``pass_fds`` kept open to join the jobserver"""
+
+    def __init__(self, read_fd, write_fd, fifo=None, jobs=None):
+        self.fds = (read_fd, write_fd)
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+        self.fifo = fifo
+        self.jobs = jobs
+        self.nonblocking = False
+        self.owned = []
+        self.tmpdir = None
+        if fifo is not None:
+            self.nonblocking = True
+        else:
+            try:
+                self.read_fd = os.open('/proc/self/fd/%d' % read_fd, os.O_RDONLY | os.O_NONBLOCK)
+            except OSError:
+                pass
+            else:
+                self.owned.append(self.read_fd)
+                self.nonblocking = True
+
+    @classmethod
+    def from_environ(cls, environ=None):
+        """join the jobserver advertised in ``MAKEFLAGS`` of ``environ``.
+        returns None if there is none or it is not reachable"""
+        if environ is None:
+            environ = os.environ
+        auth = parse_makeflags(environ.get('MAKEFLAGS'))
+        if auth is None:
+            return None
+        style, address = auth
+        try:
+            if style == 'fifo':
+                fd = os.open(address, os.O_RDWR | os.O_NONBLOCK)
+                jobserver = cls(fd, fd, fifo=address)
+                jobserver.owned.append(fd)
+                return jobserver
+            for fd in address:
+                os.fstat(fd)
+        except OSError as e:
+            log.warn('orchdist: jobserver unavailable (%s), '
+                     'mark the parent make rule with "+" to share it', e)
+            return None
+        return cls(*address)
+
+    @classmethod
+    def serve(cls, jobs, style='pipe'):
+        """create a jobserver allowing ``jobs`` jobs at a time, ``jobs - 1`` tokens
+        and the implicit one of the caller. ``style`` is ``'pipe'``, understood by
+        every make supporting a jobserver, or ``'fifo'`` (make 4.4)"""
+        if style == 'fifo':
+            tmpdir = tempfile.mkdtemp(prefix='orchdist-')
+            fifo = os.path.join(tmpdir, 'jobserver')
+            os.mkfifo(fifo, 0o600)
+            fd = os.open(fifo, os.O_RDWR | os.O_NONBLOCK)
+            jobserver = cls(fd, fd, fifo=fifo, jobs=jobs)
+            jobserver.owned.append(fd)
+            jobserver.tmpdir = tmpdir
+        elif style == 'pipe':
+            read_fd, write_fd = os.pipe()
+            for fd in (read_fd, write_fd):
+                os.set_inheritable(fd, True)
+            jobserver = cls(read_fd, write_fd, jobs=jobs)
+            jobserver.owned.extend((read_fd, write_fd))
+        else:
+            raise ValueError('unknown jobserver style %r' % style)
+        os.write(jobserver.write_fd, TOKEN * (jobs - 1))
+        return jobserver
+
+    @property
+    def auth(self):
+        """the ``--jobserver-auth`` value naming this jobserver"""
+        if self.fifo is not None:
+            return 'fifo:' + self.fifo
+        return '%d,%d' % self.pass_fds
+
+    @property
+    def pass_fds(self):
+        """the file descriptors a child has to inherit to join this jobserver"""
+        if self.fifo is not None:
+            return ()
+        return self.fds
+
+    def makeflags(self, makeflags=None):
+        """returns ``makeflags`` with the job options replaced by this jobserver"""
+        flags = strip_makeflags(makeflags)
+        if self.jobs is not None:
+            flags += ' -j%d' % self.jobs
+        return (flags + ' --jobserver-auth=' + self.auth).lstrip()
+
+    def try_read(self):
+        """read a token if one is available. returns it or None
+
+        raise ``OSError`` if the jobserver has been closed"""
+        try:
+            if not self.nonblocking and not select.select([self.read_fd], [], [], 0)[0]:
+                return None
+            token = os.read(self.read_fd, 1)
+        except (BlockingIOError, InterruptedError):
+            return None
+        if not token:
+            raise OSError('jobserver closed')
+        return token
+
+    def acquire(self, blocking=True):
+        """take a token. returns it, or None if ``blocking`` is false and there is none"""
+        while True:
+            token = self.try_read()
+            if token is not None or not blocking:
+                return token
+            select.select([self.read_fd], [], [])
+
+    def acquire_async(self, event_loop):
+        """returns a future of ``event_loop`` resolving to a token
+
+        cancelling the future stops waiting. a token read after that is
+        written back"""
+        future = event_loop.create_future()
+
+        def deliver(token, error=None):
+            if future.cancelled():
+                if token is not None:
+                    self.release(token)
+            elif error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(token)
+
+        if self.nonblocking:
+            def readable():
+                try:
+                    token = self.try_read()
+                except OSError as e:
+                    event_loop.remove_reader(self.read_fd)
+                    deliver(None, e)
+                    return
+                if token is not None:
+                    event_loop.remove_reader(self.read_fd)
+                    deliver(token)
+
+            event_loop.add_reader(self.read_fd, readable)
+            future.add_done_callback(lambda _: event_loop.remove_reader(self.read_fd))
+            return future
+
+        def wait():
+            try:
+                token, error = self.acquire(), None
+            except OSError as e:
+                token, error = None, e
+            try:
+                event_loop.call_soon_threadsafe(deliver, token, error)
+            except RuntimeError:
+                if token is not None:
+                    self.release(token)
+
+        threading.Thread(target=wait, name='orchdist-jobserver', daemon=True).start()
+        return future
+
+    def release(self, token):
+        """give ``token`` back"""
+        os.write(self.write_fd, token)
+
+    def close(self):
+        """close the file descriptors opened by this client or server"""
+        for fd in self.owned:
+            os.close(fd)
+        self.owned = []
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+            self.tmpdir = None
@@ -0,0 +1,161 @@
+"""
+ninja build file export for orchdist
+
+``NinjaExporter`` lowers the commands of an ``OrchDistribution`` into a
+``build.ninja``. ``BuildC`` commands become the compiler command lines they
+would spawn; other commands become steps calling back into the setup script
+through ``python -m orchdist.ninja SCRIPT COMMAND``
+"""
+
+
+#   Copyright (C) 2017 TitanSnow
+
+#   This library is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, write to the Free Software
+#   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#   USA
+
+
+from distutils.core import run_setup
+import argparse
+import os
+import shlex
+import sys
+
+from . import BuildC
+
+
+STAMP_DIR = '.orchdist'
+
+
+def escape_path(path):
+    """escape ``path`` for the build and input lists of a ninja file"""
+    return path.replace('$', '$$').replace(' ', '$ ').replace(':', '$:')
+
+
+def escape_command(argv):
+    """returns the shell command line of ``argv`` escaped for a ninja variable"""
+    return ' '.join(shlex.quote(arg) for arg in argv).replace('$', '$$')
+
+
+class NinjaExporter:
+    """lowers the commands of ``dist`` into ninja build statements
+
+    a ``BuildC`` command is built with its compiler recording instead of
+    running the command lines, which fills in its ``result`` so commands
+    wired through ``Builder.result_of`` resolve to concrete files. other
+    commands run ``callback``, a format string of ``python``, ``script``,
+    ``command`` and ``stamp``, which has to touch the stamp file when done"""
+
+    callback = '{python} -m orchdist.ninja --stamp {stamp} {script} {command}'
+
+    def __init__(self, dist, script=None, callback=None):
+        self.dist = dist
+        self.script = os.path.abspath(script if script is not None else sys.argv[0])
+        if callback is not None:
+            self.callback = callback
+        self.outputs = {}
+
+    def lower(self, command):
+        """returns the build edges of ``command``, a list of
+        ``(outputs, inputs, command lines, depfile)``"""
+        cmd_obj = self.dist.get_command_obj(command)
+        cmd_obj.ensure_finalized()
+        if not isinstance(cmd_obj, BuildC):
+            stamp = os.path.join(STAMP_DIR, command + '.stamp')
+            argv = shlex.split(self.callback.format(python=shlex.quote(sys.executable),
+                                                    script=shlex.quote(self.script),
+                                                    command=shlex.quote(command),
+                                                    stamp=shlex.quote(stamp)))
+            return [([stamp], [], [argv], None)]
+        compiler = cmd_obj.new_compiler()
+        dry_run, force = compiler.dry_run, compiler.force
+        compiler.dry_run, compiler.force = 1, 1
+        try:
+            return cmd_obj.ninja_edges(compiler)
+        finally:
+            compiler.dry_run, compiler.force = dry_run, force
+            cmd_obj.release_compiler(compiler)
+
+    def statements(self, commands):
+        """yield the lines of the build statements of ``commands`` and their sub commands"""
+        order, deps = self.dist.command_graph(commands)
+        for command in order:
+            implicit = [output for dep in deps[command] for output in self.outputs[dep]]
+            outputs = []
+            for edge_outputs, inputs, cmds, depfile in self.lower(command):
+                if not edge_outputs or None in edge_outputs:
+                    raise ValueError('command %r has no output file to export' % command)
+                outputs.extend(edge_outputs)
+                line = 'build %s: %s %s' % (' '.join(escape_path(path) for path in edge_outputs),
+                                            'cc' if depfile is not None else 'run',
+                                            ' '.join(escape_path(path) for path in inputs))
+                extra = [path for path in implicit if path not in inputs]
+                if extra:
+                    line += ' | ' + ' '.join(escape_path(path) for path in extra)
+                yield line
+                yield '  cmd = ' + ' && '.join(escape_command(cmd) for cmd in cmds)
+                yield '  desc = %s %s' % (command, edge_outputs[0] if edge_outputs else '')
+                if depfile is not None:
+                    yield '  depfile = ' + escape_path(depfile)
+            self.outputs[command] = outputs
+            yield 'build %s: phony %s' % (escape_path(command),
+                                          ' '.join(escape_path(path) for path in outputs))
+            yield ''
+
+    def write(self, f, commands):
+        """write the ninja file building ``commands`` to the file object ``f``"""
+        f.write('# generated by orchdist. do not edit\n\n'
+                'ninja_required_version = 1.3\n\n'
+                'rule run\n'
+                '  command = $cmd\n'
+                '  description = $desc\n\n'
+                'rule cc\n'
+                '  command = $cmd\n'
+                '  description = $desc\n'
+                '  deps = gcc\n\n')
+        for line in self.statements(commands):
+            f.write(line + '\n')
+        f.write('default %s\n' % ' '.join(escape_path(command) for command in commands))
+
+    def run_step(self, command, stamp=None):
+        """run ``command`` alone, as a callback step of the ninja file, then touch
+        ``stamp``. its sub commands are taken as built; the ``result`` of those
+        that are ``BuildC`` commands is filled in again"""
+        order, _ = self.dist.command_graph([command])
+        for sub in order[:-1]:
+            if isinstance(self.dist.get_command_obj(sub), BuildC):
+                self.lower(sub)
+            self.dist.have_run[sub] = 1
+        self.dist.run_command(command)
+        if stamp is not None:
+            dirname = os.path.dirname(stamp)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            with open(stamp, 'a'):
+                os.utime(stamp)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='run a command of a setup script '
+                                                 'as a step of an orchdist ninja file')
+    parser.add_argument('--stamp', default=None, help='file to touch when done')
+    parser.add_argument('script')
+    parser.add_argument('command')
+    args = parser.parse_args(argv)
+    dist = run_setup(args.script, script_args=[], stop_after='init')
+    NinjaExporter(dist, args.script).run_step(args.command, args.stamp)
+
+
+if __name__ == '__main__':
+    main()
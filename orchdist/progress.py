@@ -0,0 +1,225 @@
+"""
+build progress reporting for orchdist
+
+``BuildProgress`` counts the commands of a build and estimates the time
+left from the durations of their previous runs, as recorded by
+``BuildHistory``. ``ProgressReporter`` shows it on a terminal and
+``PrometheusExporter`` writes it for the textfile collector of the
+Prometheus node exporter. pass them in ``listeners`` of ``OrchDistribution``
+"""
+
+
+#   Copyright (C) 2017 TitanSnow
+
+#   This library is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, write to the Free Software
+#   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#   USA
+
+
+import os
+import sys
+
+from . import BuildListener
+
+
+class BuildProgress(BuildListener):
+    """counts the commands of the running build
+
+    the estimated cost of a command is ``OrchDistribution.command_cost``.
+    the time left is the cost of the commands not finished yet, scaled by
+    how long the finished ones took against their estimate, divided among
+    the workers until a command has finished"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """forget the counts of the last build"""
+        self.scheduler = None
+        self.start = None
+        self.costs = {}
+        self.total = 0
+        self.ready = 0
+        self.running = 0
+        self.finished = 0
+        self.failed = 0
+        self.duration_sum = 0.0
+        self.remaining_cost = 0.0
+        self.finished_cost = 0.0
+
+    def on_build_start(self, scheduler, timestamp):
+        self.reset()
+        self.scheduler = scheduler
+        self.start = timestamp
+        self.costs = {cmd: scheduler.dist.command_cost(cmd) for cmd in scheduler.indegree}
+        self.total = len(self.costs)
+        self.remaining_cost = sum(self.costs.values())
+
+    def on_ready(self, command, timestamp):
+        self.ready += 1
+
+    def on_start(self, command, timestamp):
+        self.ready -= 1
+        self.running += 1
+
+    def on_finish(self, command, timestamp, duration):
+        self.running -= 1
+        self.finished += 1
+        self.duration_sum += duration
+        self.remaining_cost -= self.costs.get(command, 0)
+        self.finished_cost += self.costs.get(command, 0)
+
+    def on_error(self, command, timestamp, error):
+        self.running -= 1
+        self.failed += 1
+        self.remaining_cost -= self.costs.get(command, 0)
+
+    def eta(self, now):
+        """returns the estimated seconds left at ``now``, or None if unknown"""
+        if self.start is None:
+            return None
+        if self.finished_cost > 0:
+            return max(self.remaining_cost * (now - self.start) / self.finished_cost, 0.0)
+        return self.remaining_cost / max(self.scheduler.max_workers, 1)
+
+
+def format_seconds(seconds):
+    """returns ``seconds`` as ``H:MM:SS``"""
+    seconds = int(seconds + 0.5)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class ProgressReporter(BuildProgress):
+    """writes the progress of builds to ``stream``, standard error by default
+
+    on a terminal the status line is rewritten in place, otherwise a line is
+    written for every command finished"""
+
+    def __init__(self, stream=None):
+        super().__init__()
+        self.stream = stream
+
+    def get_stream(self):
+        return self.stream if self.stream is not None else sys.stderr
+
+    def status(self, command, timestamp):
+        """returns the status line after ``command`` has finished"""
+        done = self.finished + self.failed
+        line = '[%d/%d %3d%%] %s' % (done, self.total, done * 100 // max(self.total, 1), command)
+        if self.failed:
+            line += ', %d failed' % self.failed
+        eta = self.eta(timestamp)
+        if eta is not None and done < self.total:
+            line += ' ETA %s' % format_seconds(eta)
+        return line
+
+    def write(self, line):
+        stream = self.get_stream()
+        if stream.isatty():
+            stream.write('\r\x1b[K' + line)
+        else:
+            stream.write(line + '\n')
+        stream.flush()
+
+    def on_finish(self, command, timestamp, duration):
+        super().on_finish(command, timestamp, duration)
+        self.write(self.status(command, timestamp))
+
+    def on_error(self, command, timestamp, error):
+        super().on_error(command, timestamp, error)
+        self.write(self.status(command + ' failed', timestamp))
+
+    def on_build_finish(self, scheduler, timestamp):
+        stream = self.get_stream()
+        if stream.isatty() and self.finished + self.failed:
+            stream.write('\n')
+            stream.flush()
+
+
+class PrometheusExporter(BuildProgress):
+    """writes the progress of builds to ``filename``, which should end with
+    ``.prom``, in the Prometheus text format at most every ``interval`` seconds
+    and when a build is over. ``labels`` is a dict of labels of every metric"""
+
+    METRICS = (
+        ('orchdist_commands', 'gauge', 'commands of the build', 'total'),
+        ('orchdist_commands_ready', 'gauge', 'commands waiting for a worker', 'ready'),
+        ('orchdist_commands_running', 'gauge', 'commands running', 'running'),
+        ('orchdist_commands_finished', 'gauge', 'commands finished', 'finished'),
+        ('orchdist_commands_failed', 'gauge', 'commands failed', 'failed'),
+        ('orchdist_command_duration_seconds_sum', 'gauge',
+         'seconds taken by the commands finished', 'duration_sum'),
+        ('orchdist_build_start_time_seconds', 'gauge',
+         'unix time the build started', 'start'),
+    )
+
+    def __init__(self, filename, interval=1.0, labels=None):
+        super().__init__()
+        self.filename = filename
+        self.interval = interval
+        self.labels = labels or {}
+        self.written = None
+
+    def format_labels(self):
+        if not self.labels:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                                              .replace('"', '\\"').replace('\n', '\\n'))
+                                 for k, v in sorted(self.labels.items()))
+
+    def metrics(self, now):
+        """returns the content of the file at ``now``"""
+        labels = self.format_labels()
+        lines = []
+        values = [(name, kind, help, getattr(self, attr)) for name, kind, help, attr in self.METRICS]
+        values.append(('orchdist_build_eta_seconds', 'gauge',
+                       'estimated seconds left of the build', self.eta(now)))
+        values.append(('orchdist_last_update_time_seconds', 'gauge',
+                       'unix time of this update', now))
+        for name, kind, help, value in values:
+            if value is None:
+                continue
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('%s%s %s' % (name, labels, repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+    def export(self, now, force=False):
+        """write the file if ``interval`` seconds have passed since the last time, or ``force``"""
+        if not force and self.written is not None and now - self.written < self.interval:
+            return
+        self.written = now
+        tmpname = '%s.%d.tmp' % (self.filename, os.getpid())
+        with open(tmpname, 'w') as f:
+            f.write(self.metrics(now))
+        os.replace(tmpname, self.filename)
+
+    def on_build_start(self, scheduler, timestamp):
+        super().on_build_start(scheduler, timestamp)
+        self.export(timestamp, True)
+
+    def on_start(self, command, timestamp):
+        super().on_start(command, timestamp)
+        self.export(timestamp)
+
+    def on_finish(self, command, timestamp, duration):
+        super().on_finish(command, timestamp, duration)
+        self.export(timestamp)
+
+    def on_error(self, command, timestamp, error):
+        super().on_error(command, timestamp, error)
+        self.export(timestamp)
+
+    def on_build_finish(self, scheduler, timestamp):
+        self.export(timestamp, True)
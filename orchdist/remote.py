@@ -0,0 +1,269 @@
+"""
+distributed compilation for orchdist
+
+``WorkerServer`` is a daemon compiling preprocessed translation units sent
+over a socket; ``RemoteExecutor`` is its client used by ``Compile``.
+start a worker with ``python -m orchdist.remote --port PORT``. it listens
+on localhost unless ``--host`` is given
+"""
+
+
+#   Copyright (C) 2017 TitanSnow
+
+#   This library is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, write to the Free Software
+#   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#   USA
+
+
+from distutils import log
+from distutils.errors import CompileError
+import argparse
+import json
+import os
+import re
+import shlex
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import sysconfig
+import tempfile
+import threading
+import time
+
+
+INPUT = '{input}'
+OUTPUT = '{output}'
+SUFFIXES = ('.i', '.ii', '.mi')
+# flags a worker passes to the compiler. those naming files, plugins, wrappers
+# or options of other tools are refused
+FLAG_RE = re.compile(r'^(-c|-g\S*|-O\S*|-m\S+|-std=\S+|-[DU]\S+|-w|-pipe|-pthread|'
+                     r'-pedantic(-errors)?|-W(?![alp],)\S*|'
+                     r'-f(?!plugin|profile|auto-profile|dump|record-gcc-switches)\S+)$')
+
+
+def recv_exactly(sock, size):
+    """receive exactly ``size`` bytes from ``sock``"""
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def send_message(sock, header, payload=b''):
+    """send a message. it is a length prefixed json ``header`` followed by ``payload``"""
+    header = dict(header, size=len(payload))
+    data = json.dumps(header).encode()
+    sock.sendall(struct.pack('!I', len(data)) + data)
+    if payload:
+        sock.sendall(payload)
+
+
+def recv_message(sock):
+    """receive a message sent by ``send_message``. returns ``(header, payload)``"""
+    size = struct.unpack('!I', recv_exactly(sock, 4))[0]
+    header = json.loads(recv_exactly(sock, size).decode())
+    return header, recv_exactly(sock, header['size'])
+
+
+def default_compilers():
+    """returns the names of the compilers a worker accepts by default"""
+    compilers = {'cc', 'gcc', 'clang', 'c++', 'g++', 'clang++'}
+    for var in ('CC', 'CXX'):
+        value = sysconfig.get_config_var(var)
+        if value:
+            compilers.add(os.path.basename(shlex.split(value)[0]))
+    return compilers
+
+
+def worker_argv(argv, compilers, input_file, output_file):
+    """returns the command line a worker runs for ``argv`` sent by a client,
+    compiling ``input_file`` into ``output_file``. its compiler has to be one of
+    ``compilers`` and every flag allowed by ``FLAG_RE``
+
+    raise ``ValueError`` naming the argument refused"""
+    if not argv or os.path.basename(argv[0]) not in compilers:
+        raise ValueError(argv[0] if argv else 'empty command line')
+    result = [argv[0]]
+    args = iter(argv[1:])
+    for arg in args:
+        if arg == INPUT:
+            result.append(input_file)
+        elif arg == '-o':
+            if next(args, None) != OUTPUT:
+                raise ValueError('-o')
+            result += ['-o', output_file]
+        elif FLAG_RE.match(arg):
+            result.append(arg)
+        else:
+            raise ValueError(arg)
+    return result
+
+
+class WorkerHandler(socketserver.BaseRequestHandler):
+    """handles a request of a ``RemoteExecutor``"""
+
+    def handle(self):
+        header, payload = recv_message(self.request)
+        server = self.server
+        if not server.slots.acquire(blocking=False):
+            send_message(self.request, {'busy': True})
+            return
+        try:
+            reply, output = server.compile(header, payload)
+        finally:
+            server.slots.release()
+        send_message(self.request, reply, output)
+
+
+class WorkerServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """worker daemon compiling preprocessed translation units
+
+    at most ``slots`` jobs run at a time; further requests are answered busy
+    so the client compiles them elsewhere. only compilers named in
+    ``compilers`` are run, with the flags ``worker_argv`` allows; other
+    requests are answered refused so the client compiles them locally.
+    clients are not authenticated, so listen on trusted networks only"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, slots=None, compilers=None):
+        super().__init__(address, WorkerHandler)
+        self.slots = threading.BoundedSemaphore(slots or os.cpu_count() or 1)
+        self.compilers = set(compilers) if compilers is not None else default_compilers()
+
+    def compile(self, header, payload):
+        """compile ``payload`` with the command line in ``header``. returns ``(reply, object)``"""
+        suffix = header['suffix']
+        if suffix not in SUFFIXES:
+            return {'refused': 'suffix %r' % suffix}, b''
+        with tempfile.TemporaryDirectory() as tmp:
+            input_file = os.path.join(tmp, 'input' + suffix)
+            output_file = os.path.join(tmp, 'output.o')
+            try:
+                argv = worker_argv(header['argv'], self.compilers, input_file, output_file)
+            except ValueError as e:
+                return {'refused': str(e)}, b''
+            with open(input_file, 'wb') as f:
+                f.write(payload)
+            try:
+                process = subprocess.run(argv, stdout=subprocess.PIPE,
+                                         stderr=subprocess.STDOUT, cwd=tmp)
+            except OSError as e:
+                return {'returncode': 1, 'output': 'orchdist worker: %s\n' % e}, b''
+            reply = {'returncode': process.returncode,
+                     'output': process.stdout.decode('utf-8', 'replace')}
+            if process.returncode:
+                return reply, b''
+            try:
+                with open(output_file, 'rb') as f:
+                    return reply, f.read()
+            except OSError:
+                reply['returncode'] = 1
+                reply['output'] += 'orchdist worker: no object written\n'
+                return reply, b''
+
+
+class RemoteExecutor:
+    """client sending compile jobs to ``WorkerServer`` daemons
+
+    ``workers`` is a list of ``'host:port'``. jobs go to the workers in turn;
+    a busy worker is skipped, an unreachable one is skipped for
+    ``retry_interval`` seconds. ``compile`` returns False when no worker took
+    the job, or a worker refused its command line, so the caller compiles it
+    locally"""
+
+    def __init__(self, workers, timeout=300, retry_interval=30):
+        self.workers = []
+        for worker in workers:
+            host, port = worker.rsplit(':', 1)
+            self.workers.append((host, int(port)))
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.lock = threading.Lock()
+        self.down_until = {}
+        self.next = 0
+
+    def candidates(self):
+        """returns the workers to try, in turn, leaving out the unreachable ones"""
+        now = time.time()
+        with self.lock:
+            start = self.next
+            self.next = (self.next + 1) % max(len(self.workers), 1)
+            workers = self.workers[start:] + self.workers[:start]
+            return [worker for worker in workers if self.down_until.get(worker, 0) <= now]
+
+    def request(self, worker, header, payload):
+        """send a job to ``worker``. returns its reply"""
+        with socket.create_connection(worker, timeout=self.timeout) as sock:
+            send_message(sock, header, payload)
+            return recv_message(sock)
+
+    def compile(self, argv, suffix, data, output_file):
+        """compile the preprocessed ``data`` with the command line ``argv``, in which
+        ``INPUT`` and ``OUTPUT`` stand for the input and object files, and write the
+        object to ``output_file``. returns whether a worker compiled it
+
+        raise ``CompileError`` if the compiler fails"""
+        for worker in self.candidates():
+            try:
+                reply, obj = self.request(worker, {'argv': argv, 'suffix': suffix}, data)
+            except (OSError, ValueError) as e:
+                log.warn('orchdist worker %s:%d: %s', worker[0], worker[1], e)
+                with self.lock:
+                    self.down_until[worker] = time.time() + self.retry_interval
+                continue
+            if reply.get('busy'):
+                continue
+            if reply.get('refused'):
+                log.info('orchdist worker %s:%d refused %r, compiling locally',
+                         worker[0], worker[1], reply['refused'])
+                return False
+            if reply['output']:
+                sys.stderr.write(reply['output'])
+            if reply['returncode']:
+                raise CompileError('remote compile on %s:%d failed with exit code %d'
+                                   % (worker[0], worker[1], reply['returncode']))
+            tmpname = '%s.%d.%d.tmp' % (output_file, os.getpid(), threading.get_ident())
+            with open(tmpname, 'wb') as f:
+                f.write(obj)
+            os.replace(tmpname, output_file)
+            return True
+        return False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='orchdist compile worker')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen on. clients are not authenticated')
+    parser.add_argument('--port', type=int, required=True)
+    parser.add_argument('--slots', type=int, default=None)
+    parser.add_argument('--compiler', action='append', dest='compilers', default=None,
+                        help='name of a compiler to accept (repeatable)')
+    args = parser.parse_args(argv)
+    server = WorkerServer((args.host, args.port), args.slots, args.compilers)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""
+watch mode for orchdist
+
+``Watch`` builds commands once, then keeps the distribution, its command
+objects and an in-memory build database around, waits for the files the
+commands read to change and rebuilds only the commands reading them and
+their dependents. files are watched with inotify on Linux and polled
+elsewhere
+"""
+
+
+#   Copyright (C) 2017 TitanSnow
+
+#   This library is free software; you can redistribute it and/or
+#   modify it under the terms of the GNU Lesser General Public
+#   License as published by the Free Software Foundation; either
+#   version 2.1 of the License, or (at your option) any later version.
+
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#   Lesser General Public License for more details.
+
+#   You should have received a copy of the GNU Lesser General Public
+#   License along with this library; if not, write to the Free Software
+#   Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+#   USA
+
+
+from distutils import log
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+from . import BuildDatabase
+
+
+class PollingWatcher:
+    """watches files by comparing their ``(mtime, size)`` every ``interval`` seconds"""
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.stamps = {}
+
+    def set_paths(self, paths):
+        """watch ``paths`` from now on. the stamps of paths already watched are
+        kept, so changes made meanwhile are still reported"""
+        stamps = {}
+        for path in paths:
+            path = os.path.abspath(path)
+            stamps[path] = self.stamps[path] if path in self.stamps else BuildDatabase.stamp(path)
+        self.stamps = stamps
+
+    def wait(self, timeout=None):
+        """returns the set of watched paths changed since the last call, waiting
+        for one to change at most ``timeout`` seconds (forever if None)"""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            changed = set()
+            for path, stamp in self.stamps.items():
+                current = BuildDatabase.stamp(path)
+                if current != stamp:
+                    self.stamps[path] = current
+                    changed.add(path)
+            if changed or (deadline is not None and time.time() >= deadline):
+                return changed
+            time.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """watches files through inotify on the directories holding them
+
+    events are collected until none comes for ``delay`` seconds, so a save
+    touching a file several times is reported once"""
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.dirs = {}
+        self.wds = {}
+        self.paths = set()
+
+    def set_paths(self, paths):
+        """watch ``paths`` from now on"""
+        self.paths = {os.path.abspath(path) for path in paths}
+        dirs = {os.path.dirname(path) for path in self.paths}
+        for dir in set(self.dirs) - dirs:
+            self.libc.inotify_rm_watch(self.fd, self.dirs.pop(dir))
+        for dir in dirs - set(self.dirs):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir), self.MASK)
+            if wd < 0:
+                log.warn('orchdist: cannot watch %s: %s', dir, os.strerror(ctypes.get_errno()))
+                continue
+            self.dirs[dir] = wd
+            self.wds[wd] = dir
+
+    def read_events(self):
+        """returns the watched paths named by the pending events"""
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, size = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                name = data[offset:offset + size].rstrip(b'\0')
+                offset += size
+                if mask & self.IN_Q_OVERFLOW:
+                    changed.update(self.paths)
+                elif wd in self.wds:
+                    path = os.path.join(self.wds[wd], os.fsdecode(name))
+                    if path in self.paths:
+                        changed.add(path)
+
+    def wait(self, timeout=None):
+        """returns the set of watched paths changed since the last call, waiting
+        for one to change at most ``timeout`` seconds (forever if None)"""
+        deadline = None if timeout is None else time.time() + timeout
+        changed = self.read_events()
+        while not changed:
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            if not select.select([self.fd], [], [], remaining)[0]:
+                return changed
+            changed = self.read_events()
+        while select.select([self.fd], [], [], self.delay)[0]:
+            changed.update(self.read_events())
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def default_watcher():
+    """returns an ``InotifyWatcher`` if inotify is available, otherwise a ``PollingWatcher``"""
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError, TypeError):
+        return PollingWatcher()
+
+
+class Watch:
+    """a watch session building ``commands`` of ``dist`` with ``watcher``
+
+    the files watched are those indexed by ``OrchDistribution.input_index``.
+    the distribution gets an in-memory build database if it has none, so
+    dependents whose inputs come out unchanged are not rebuilt"""
+
+    def __init__(self, dist, commands, watcher=None):
+        self.dist = dist
+        self.commands = list(commands)
+        self.watcher = watcher if watcher is not None else default_watcher()
+        if dist.build_db is None:
+            dist.build_db = BuildDatabase(None)
+        self.owners = {}
+
+    def build(self, commands):
+        """run ``commands``. returns whether they succeeded; failures are logged"""
+        try:
+            self.dist._run_commands(commands)
+        except Exception as e:
+            log.error('orchdist: build failed: %s', e)
+            return False
+        return True
+
+    def scan(self):
+        """index the files the commands read and watch them"""
+        self.owners = self.dist.input_index(self.commands)
+        self.watcher.set_paths(self.owners)
+
+    def rebuild(self, paths):
+        """rebuild the commands affected by the change of ``paths``. returns them"""
+        commands = self.dist.affected_commands(paths, self.commands, self.owners)
+        if not commands:
+            return commands
+        log.info('orchdist: %s changed, rebuilding %s',
+                 ', '.join(sorted(paths)), ', '.join(commands))
+        try:
+            self.dist.run_affected(paths, self.commands, self.owners)
+        except Exception as e:
+            log.error('orchdist: build failed: %s', e)
+        self.scan()
+        return commands
+
+    def run(self, rounds=None, callback=None):
+        """build the commands, then rebuild them on changes until interrupted, or
+        ``rounds`` rebuilds have been done. ``callback`` is called with the list
+        of commands after every build"""
+        try:
+            self.build(self.commands)
+            self.scan()
+            if callback is not None:
+                callback(self.dist.sequencify_commands(self.commands))
+            done = 0
+            while rounds is None or done < rounds:
+                commands = self.rebuild(self.watcher.wait())
+                if commands:
+                    done += 1
+                    if callback is not None:
+                        callback(commands)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.watcher.close()
@@ -1,9 +1,68 @@
 import unittest
 import time
 import orchdist
+import orchdist.adaptive
+import orchdist.daemon
+import orchdist.jobserver
+import orchdist.ninja
+import orchdist.progress
+import orchdist.remote
+import orchdist.watch
 import os
+import sys
 from os import path
 import subprocess
+import tempfile
+import json
+import asyncio
+import threading
+import http.server
+import io
+from unittest import mock
+
+
+class SquareInProcess(orchdist.OrchCommand):
+    executor = 'process'
+
+    def finalize_options(self):
+        self.value = 7
+
+    def run(self):
+        super().run()
+        self.result = (os.getpid(), self.value * self.value)
+
+
+class SpawnRecorder(orchdist.OrchDistribution):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.spawned = []
+
+    def spawn(self, cmd, dry_run=0):
+        self.spawned.append(cmd)
+        super().spawn(cmd, dry_run)
+
+
+class ArtifactHandler(http.server.BaseHTTPRequestHandler):
+    store = {}
+
+    def do_GET(self):
+        data = self.store.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_PUT(self):
+        self.store[self.path] = self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
 
 
 class TestOrchdist(unittest.TestCase):
@@ -124,25 +183,82 @@ class TestOrchdist(unittest.TestCase):
         cmd.run()
         self.assertTrue(run)
 
-    def test_run_command_fallback(self):
+    def test_run_command_cycle(self):
         crt = orchdist.CommandCreator()
+        crt.add('c', ['a'])
         crt.add('a', ['b'])
         crt.add('b', ['a'])
         result = []
         @crt.on('a')
         @crt.on('b')
+        @crt.on('c')
         def run(self):
             result.append(self.get_command_name())
         dist = orchdist.OrchDistribution()
         dist.register_cmdclasses(crt.create_all())
-        dist.add_commands(*crt.create_all().keys())
+        dist.add_commands('c')
+        with self.assertRaises(orchdist.SequencifyFail) as cm:
+            dist.run_commands()
+        self.assertEqual(cm.exception.cycle, ['a', 'b', 'a'])
+        self.assertIn('a -> b -> a', str(cm.exception))
+        self.assertEqual(result, [])
+        self.assertFalse(bool(dist.have_run.get('a')))
+        self.assertFalse(bool(dist.have_run.get('b')))
+
+    def test_deep_graph(self):
+        crt = orchdist.CommandCreator()
+        depth = 5000
+        crt.add('cmd0')
+        for i in range(1, depth):
+            crt.add('cmd%d' % i, ['cmd%d' % (i - 1)])
+        dist = orchdist.OrchDistribution()
+        for i in range(depth):
+            dist.register_cmdclass('cmd%d' % i, crt.create('cmd%d' % i))
+        order = dist.sequencify_commands(['cmd%d' % (depth - 1)])
+        self.assertEqual(order, ['cmd%d' % i for i in range(depth)])
+        with mock.patch.object(orchdist, 'CommandScheduler',
+                               wraps=orchdist.CommandScheduler) as scheduler:
+            dist.run_command('cmd%d' % (depth - 1))
+        # running the sub commands again does not schedule them again
+        self.assertEqual(scheduler.call_count, 1)
+        self.assertTrue(all(dist.have_run.get(cmd) for cmd in order))
+        klass = dist.cmdclass['cmd0']
+        klass.add_sub_command('cmd%d' % (depth - 1))
+        with self.assertRaises(orchdist.SequencifyFail) as cm:
+            dist.sequencify_commands(['cmd%d' % (depth - 1)])
+        self.assertEqual(len(cm.exception.cycle), depth + 1)
+
+    def test_lazy_command_classes(self):
+        crt = orchdist.CommandCreator()
+        width = 1000
+        for i in range(width):
+            crt.add('cmd%d' % i)
+        crt.add('all', ['cmd%d' % i for i in range(width)])
+        ran = []
+        crt.on('cmd0', 'run', lambda self: ran.append(self.get_command_name()))
+        started = []
+
+        class Listener(orchdist.BuildListener):
+            def on_start(self, command, timestamp):
+                started.append((command, len(dist.command_obj)))
+
+        dist = orchdist.OrchDistribution(priority=True, listeners=[Listener()])
+        crt.apply(dist)
+        order = dist.sequencify_commands(['all'])
+        self.assertEqual(order, ['cmd%d' % i for i in range(width)] + ['all'])
+        # the graph is built without command classes or objects
+        self.assertEqual(dist.cmdclass, {})
+        self.assertEqual(dist.command_obj, {})
+        dist.run_command('cmd0')
+        self.assertEqual(ran, ['cmd0'])
+        self.assertEqual(list(dist.cmdclass), ['cmd0'])
         dist.run_commands()
-        self.assertEqual(len(result), 2)
-        self.assertEqual(set(result), set('ab'))
-        self.assertTrue(bool(dist.have_run.get('a')))
-        self.assertTrue(bool(dist.have_run.get('b')))
-        self.assertFalse(bool(dist.is_running.get('a')))
-        self.assertFalse(bool(dist.is_running.get('b')))
+        self.assertEqual(len(dist.cmdclass), width + 1)
+        self.assertEqual(ran, ['cmd0'])
+        # command objects are created as the commands run, not up front
+        self.assertEqual(len(started), width + 1)
+        for i, (command, created) in enumerate(started):
+            self.assertLessEqual(created, i + 1)
 
     def test_max_workers(self):
         # single worker
@@ -171,6 +287,30 @@ class TestOrchdist(unittest.TestCase):
         dist.run_command('a')
         self.assertEqual(result, ['c', 'b', 'a'])
     
+    def test_scheduler_wide_graph(self):
+        crt = orchdist.CommandCreator()
+        result = []
+        evaluated = []
+        leaves = ['leaf%d' % i for i in range(200)]
+        for leaf in leaves:
+            crt.add(leaf)
+        crt.add('root', leaves)
+        def run(self):
+            orchdist.OrchCommand.run(self)
+            result.append(self.get_command_name())
+        for cmd in leaves + ['root']:
+            crt.on(cmd, 'run', run)
+        klass = crt.create('root')
+        klass.add_sub_command('extra', lambda self: evaluated.append(1) or False)
+        dist = orchdist.OrchDistribution(max_workers=4)
+        dist.register_cmdclasses(crt.create_all())
+        dist.run_command('root')
+        self.assertEqual(len(result), 201)
+        self.assertEqual(set(result[:-1]), set(leaves))
+        self.assertEqual(result[-1], 'root')
+        self.assertLessEqual(len(evaluated), 2)
+        self.assertEqual(dist.is_running, {})
+
     def test_build(self):
         dist = orchdist.OrchDistribution()
         builder = orchdist.Builder(dist)
@@ -213,6 +353,1263 @@ class TestOrchdist(unittest.TestCase):
         os.remove('libhelloworld.so')
         os.remove('helloworld.out')
 
+    def test_load_manifest(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(path.join(tmp, 'a.c'), 'w') as f:
+                f.write('int a(void){return 3;}\n')
+            with open(path.join(tmp, 'b.c'), 'w') as f:
+                f.write('int a(void);\nint main(void){return a();}\n')
+            manifest = path.join(tmp, 'build.json')
+            with open(manifest, 'w') as f:
+                json.dump({'targets': {
+                    'ca': {'action': 'compile', 'sources': [path.join(tmp, 'a.c')],
+                           'output_dir': tmp},
+                    'cb': {'action': 'compile', 'sources': [path.join(tmp, 'b.c')],
+                           'output_dir': tmp},
+                    'exe': {'action': 'link', 'deps': ['ca', 'cb'],
+                            'objects': {'result_of': ['ca', 'cb']},
+                            'target_desc': orchdist.Link.EXECUTABLE,
+                            'output_dir': tmp, 'output_filename': 'main.out'},
+                }}, f)
+            dist = orchdist.OrchDistribution()
+            builder = orchdist.Builder(dist)
+            builder.load(manifest)
+            self.assertTrue(path.exists(manifest + '.cache'))
+            builder.apply()
+            dist.run_command('exe')
+            self.assertEqual(subprocess.call([path.join(tmp, 'main.out')]), 3)
+            # the cached targets are loaded without reading the manifest
+            with mock.patch.object(orchdist.Builder, 'load_manifest', side_effect=AssertionError):
+                cached = orchdist.Builder()
+                cached.load(manifest)
+            self.assertEqual(cached.cmddep, builder.cmddep)
+            self.assertEqual(cached.targets['exe']['objects'].commands, ('ca', 'cb'))
+            with open(manifest, 'w') as f:
+                json.dump({'targets': {'ca': {'action': 'compile', 'source': 'a.c'}}}, f)
+            with self.assertRaises(ValueError):
+                orchdist.Builder().load(manifest)
+
+    def test_preprocess_in_memory(self):
+        for memory, spilled in ((256 << 20, False), (1, True)):
+            with tempfile.TemporaryDirectory() as tmp:
+                with open(path.join(tmp, 'value.h'), 'w') as f:
+                    f.write('#define VALUE 5\n')
+                with open(path.join(tmp, 'a.c'), 'w') as f:
+                    f.write('#include "value.h"\nint a(void){return VALUE;}\n')
+                with open(path.join(tmp, 'b.c'), 'w') as f:
+                    f.write('int a(void);\nint main(void){return a();}\n')
+                dist = orchdist.OrchDistribution(pipeline_memory=memory)
+                builder = orchdist.Builder(dist)
+                for name in 'ab':
+                    builder.target('pp' + name)                                 \
+                           .source(path.join(tmp, name + '.c'))                 \
+                           .preprocess()                                        \
+                           .output_file(path.join(tmp, 'pp', name + '.c'))      \
+                           .in_memory(True)
+                builder.target('compile', ['ppa', 'ppb'])                       \
+                       .sources(builder.result_of('ppa', 'ppb'))                \
+                       .compile()                                               \
+                       .output_dir(path.join(tmp, 'obj'))                       \
+                       .depends([path.join(tmp, 'extra.h')])
+                builder.target('exe', ['compile'])                              \
+                       .objects(builder.result_of('compile'))                   \
+                       .target_desc(orchdist.Link.EXECUTABLE)                   \
+                       .link()                                                  \
+                       .output_dir(tmp)                                         \
+                       .output_filename('main.out')
+                builder.apply()
+                dist.run_command('exe')
+                self.assertEqual(subprocess.call([path.join(tmp, 'main.out')]), 5)
+                self.assertEqual(path.exists(path.join(tmp, 'pp', 'a.c')), spilled)
+                source = dist.get_command_obj('ppa').result[0]
+                if spilled:
+                    self.assertEqual(source, path.join(tmp, 'pp', 'a.c'))
+                else:
+                    self.assertIsInstance(source, orchdist.PreprocessedSource)
+                    self.assertIsNone(source.data)
+                    with self.assertRaises(orchdist.CompileError):
+                        dist.get_command_obj('compile').compile_memory(
+                            orchdist.CompilerPool.configure(None, None, 0, 0, 0),
+                            [path.join(tmp, 'obj')] + [None] * 6, source)
+                    self.assertFalse(dist.have_run.get('ppa'))
+                    with open(path.join(tmp, 'value.h'), 'w') as f:
+                        f.write('#define VALUE 6\n')
+                    with open(path.join(tmp, 'extra.h'), 'w') as f:
+                        f.write('\n')
+                    self.assertEqual(dist.run_affected([path.join(tmp, 'extra.h')]),
+                                     ['compile', 'exe'])
+                    self.assertEqual(subprocess.call([path.join(tmp, 'main.out')]), 6)
+                self.assertEqual(dist.pipeline_budget.used, 0)
+
+    def test_preprocess_in_memory_async(self):
+        for asynchronous in (False, True):
+            with tempfile.TemporaryDirectory() as tmp:
+                with open(path.join(tmp, 'a.c'), 'w') as f:
+                    f.write('#define VALUE 7\nint main(void){return VALUE;}\n')
+                started = []
+
+                class Listener(orchdist.BuildListener):
+                    def on_start(self, command, timestamp):
+                        started.append(command)
+
+                dist = orchdist.OrchDistribution(max_workers=1, listeners=[Listener()])
+                builder = orchdist.Builder(dist)
+                builder.target('pp')                                        \
+                       .source(path.join(tmp, 'a.c'))                       \
+                       .preprocess()                                        \
+                       .output_file(path.join(tmp, 'pp', 'a.c'))            \
+                       .in_memory(True)
+                # two variants compiled from the same preprocessed source
+                for variant in ('debug', 'release'):
+                    builder.target('compile_' + variant, ['pp'])                \
+                           .sources(builder.result_of('pp'))                    \
+                           .compile()                                           \
+                           .output_dir(path.join(tmp, variant))                 \
+                           .debug(variant == 'debug')
+                    builder.target('exe_' + variant, ['compile_' + variant])    \
+                           .objects(builder.result_of('compile_' + variant))    \
+                           .target_desc(orchdist.Link.EXECUTABLE)               \
+                           .link()                                              \
+                           .output_dir(path.join(tmp, variant))                 \
+                           .output_filename('main.out')
+                builder.apply()
+                commands = ['exe_debug', 'exe_release']
+                if asynchronous:
+                    event_loop = asyncio.new_event_loop()
+                    try:
+                        event_loop.run_until_complete(dist.run_commands_async(commands))
+                    finally:
+                        event_loop.close()
+                else:
+                    dist.add_commands(*commands)
+                    dist.run_commands()
+                source = dist.get_command_obj('pp').result[0]
+                self.assertIsInstance(source, orchdist.PreprocessedSource)
+                self.assertFalse(path.exists(path.join(tmp, 'pp', 'a.c')))
+                for variant in ('debug', 'release'):
+                    self.assertEqual(subprocess.call([path.join(tmp, variant, 'main.out')]), 7)
+                # preprocessed once, released once both variants are compiled
+                self.assertEqual(started.count('pp'), 1)
+                self.assertIsNone(source.data)
+                self.assertEqual(dist.pipeline_budget.used, 0)
+                self.assertFalse(dist.have_run.get('pp'))
+
+    def test_precompile_header(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            header = path.join(tmp, 'common.h')
+            with open(header, 'w') as f:
+                f.write('#include <stdio.h>\n#define GREETING "HelloPCH!"\n')
+            source = path.join(tmp, 'main.c')
+            with open(source, 'w') as f:
+                f.write('int main(void){puts(GREETING);return 0;}\n')
+            dist = SpawnRecorder()
+            builder = orchdist.Builder(dist)
+            builder.target('pch')                           \
+                   .header(header)                          \
+                   .precompile_header()                     \
+                   .output_dir(path.join(tmp, 'pch'))
+            builder.target('compile')                       \
+                   .sources([source])                       \
+                   .compile()                               \
+                   .output_dir(tmp)                         \
+                   .pch('pch')
+            builder.target('exe', ['compile'])              \
+                   .objects(builder.result_of('compile'))   \
+                   .target_desc(orchdist.Link.EXECUTABLE)   \
+                   .link()                                  \
+                   .output_dir(tmp)                         \
+                   .output_filename('main.out')
+            builder.apply()
+            self.assertEqual(dist.sequencify_commands(['exe']), ['pch', 'compile', 'exe'])
+            dist.run_commands()
+            include = path.join(tmp, 'pch', 'common.h')
+            self.assertEqual(dist.get_command_obj('pch').result, include)
+            pch = orchdist.PrecompileHeader.pch_file(orchdist.CompilerPool.configure(None, None, 0, 0, 0),
+                                                     include)
+            self.assertTrue(path.exists(pch))
+            self.assertIn(pch, dist.spawned[0])
+            self.assertIn(['-include', include, '-Winvalid-pch'],
+                          [cmd[i:i + 3] for cmd in dist.spawned[1:2] for i in range(len(cmd))])
+            self.assertEqual(subprocess.check_output([path.join(tmp, 'main.out')],
+                                                     universal_newlines=True), 'HelloPCH!\n')
+
+    def test_unity(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            sources = []
+            for i in range(12):
+                sources.append(path.join(tmp, 'f%02d.c' % i))
+                with open(sources[-1], 'w') as f:
+                    f.write('static int value%d(void){return %d;}\n'
+                            'int f%d(void){return value%d();}\n' % (i, i, i, i))
+            main = path.join(tmp, 'main.c')
+            with open(main, 'w') as f:
+                f.write('int f11(void);\nint main(void){return f11() != 11;}\n')
+            dist = orchdist.OrchDistribution(max_workers=4)
+            builder = orchdist.Builder(dist)
+            builder.target('compile')                       \
+                   .sources(sources + [main])               \
+                   .compile()                               \
+                   .output_dir(tmp)                         \
+                   .unity(4)
+            builder.target('exe', ['compile'])              \
+                   .objects(builder.result_of('compile'))   \
+                   .target_desc(orchdist.Link.EXECUTABLE)   \
+                   .link()                                  \
+                   .output_dir(tmp)                         \
+                   .output_filename('main.out')
+            builder.apply()
+            dist.run_commands()
+            cmd_obj = dist.get_command_obj('compile')
+            batches = cmd_obj.unity_batches(sources + [main])
+            self.assertEqual(sorted(s for batch in batches for s in batch), sorted(sources + [main]))
+            self.assertEqual(len(cmd_obj.result), len(batches))
+            self.assertLess(len(batches), 13)
+            subprocess.check_call([path.join(tmp, 'main.out')])
+            extra = path.join(tmp, 'f05a.c')
+            changed = [batch for batch in cmd_obj.unity_batches(sources + [main, extra])
+                       if batch not in batches]
+            self.assertLessEqual(len(changed), 2)
+
+    def test_watch(self):
+        for watcher in (orchdist.watch.default_watcher, lambda: orchdist.watch.PollingWatcher(0.02)):
+            with tempfile.TemporaryDirectory() as tmp:
+                header = path.join(tmp, 'value.h')
+                with open(header, 'w') as f:
+                    f.write('#define VALUE 1\n')
+                with open(path.join(tmp, 'a.c'), 'w') as f:
+                    f.write('#include "value.h"\nint a(void){return VALUE;}\n')
+                with open(path.join(tmp, 'b.c'), 'w') as f:
+                    f.write('int a(void);\nint main(void){return a();}\n')
+                dist = orchdist.OrchDistribution()
+                builder = orchdist.Builder(dist)
+                for name in 'ab':
+                    builder.target('c' + name)                          \
+                           .sources([path.join(tmp, name + '.c')])      \
+                           .compile()                                   \
+                           .output_dir(tmp)
+                builder.target('exe', ['ca', 'cb'])                     \
+                       .objects(lambda self: (self.distribution.get_command_obj('ca').result +
+                                              self.distribution.get_command_obj('cb').result)) \
+                       .target_desc(orchdist.Link.EXECUTABLE)           \
+                       .link()                                          \
+                       .output_dir(tmp)                                 \
+                       .output_filename('main.out')
+                builder.apply()
+                built = []
+                ready = threading.Event()
+                def callback(commands):
+                    built.append(commands)
+                    ready.set()
+                thread = threading.Thread(target=dist.watch,
+                                          args=(['exe'], watcher(), 1, callback))
+                thread.start()
+                self.assertTrue(ready.wait(30))
+                self.assertEqual(subprocess.call([path.join(tmp, 'main.out')]), 1)
+                with open(header, 'w') as f:
+                    f.write('#define VALUE 2\n')
+                thread.join(30)
+                self.assertFalse(thread.is_alive())
+                self.assertEqual(built, [['ca', 'cb', 'exe'], ['ca', 'exe']])
+                self.assertEqual(subprocess.call([path.join(tmp, 'main.out')]), 2)
+
+    def test_affected_commands(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            header = path.join(tmp, 'value.h')
+            with open(header, 'w') as f:
+                f.write('#define VALUE 1\n')
+            with open(path.join(tmp, 'a.c'), 'w') as f:
+                f.write('#include "value.h"\nint a(void){return VALUE;}\n')
+            with open(path.join(tmp, 'b.c'), 'w') as f:
+                f.write('int a(void);\nint main(void){return a();}\n')
+            with open(path.join(tmp, 'c.c'), 'w') as f:
+                f.write('int c(void){return 0;}\n')
+            dist = orchdist.OrchDistribution()
+            builder = orchdist.Builder(dist)
+            for name in 'abc':
+                builder.target('c' + name)                          \
+                       .sources([path.join(tmp, name + '.c')])      \
+                       .compile()                                   \
+                       .output_dir(tmp)
+            builder.target('exe', ['ca', 'cb'])                     \
+                   .objects(lambda self: (self.distribution.get_command_obj('ca').result +
+                                          self.distribution.get_command_obj('cb').result)) \
+                   .target_desc(orchdist.Link.EXECUTABLE)           \
+                   .link()                                          \
+                   .output_dir(tmp)                                 \
+                   .output_filename('main.out')
+            builder.apply()
+            commands = ['exe', 'cc']
+            cc = dist.get_command_obj('cc')
+            index = dist.input_index(commands)
+            self.assertEqual(index[header], {'ca'})
+            # objects created before are kept, those created for the index are not
+            self.assertEqual(list(dist.command_obj), ['cc'])
+            self.assertIs(dist.get_command_obj('cc'), cc)
+            self.assertNotIn('sources', vars(cc))
+            # failures other than options not resolved yet are logged
+            with mock.patch.object(orchdist.Compile, 'input_files', side_effect=OSError), \
+                    mock.patch.object(orchdist.log, 'warn') as warn:
+                self.assertEqual(dist.input_index(commands), {})
+            self.assertEqual(sorted(call[0][1] for call in warn.call_args_list), ['ca', 'cb', 'cc'])
+            self.assertEqual(dist.affected_commands([header], commands, index), ['ca', 'exe'])
+            self.assertEqual(dist.affected_commands([path.join(tmp, 'c.c')], commands), ['cc'])
+            self.assertEqual(dist.affected_commands([path.join(tmp, 'd.c')], commands), [])
+            self.assertEqual(dist.run_affected([header], commands), ['ca', 'exe'])
+            self.assertEqual(subprocess.call([path.join(tmp, 'main.out')]), 1)
+            self.assertFalse(dist.have_run.get('cc'))
+            # files written by commands are not indexed
+            obj = path.abspath(dist.get_command_obj('cb').result[0])
+            self.assertNotIn(obj, dist.input_index(commands))
+
+    def test_daemon(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = path.join(tmp, 'main.c')
+            with open(source, 'w') as f:
+                f.write('int main(void){return 0;}\n')
+            script = path.join(tmp, 'setup.py')
+            with open(script, 'w') as f:
+                f.write('from distutils.core import setup\n'
+                        'import orchdist\n'
+                        'builder = orchdist.Builder()\n'
+                        'builder.target("compile").sources([%r]).compile().output_dir(%r)\n'
+                        'builder.add("bad")\n'
+                        '@builder.on("bad")\n'
+                        'def run(self):\n'
+                        '    raise orchdist.DistutilsExecError("bad command")\n'
+                        'setup(name="t", distclass=orchdist.OrchDistribution,\n'
+                        '      cmdclass=builder.create_all())\n' % (source, tmp))
+            socket_path = path.join(tmp, 'daemon.sock')
+            server = orchdist.daemon.BuildServer(socket_path, script)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                with tempfile.TemporaryFile() as out:
+                    self.assertEqual(orchdist.daemon.build(socket_path, ['compile'],
+                                                           out.fileno(), out.fileno()), 0)
+                    obj = server.dist.get_command_obj('compile').result[0]
+                    mtime = os.stat(obj).st_mtime_ns
+                    dist = server.dist
+                    self.assertEqual(orchdist.daemon.build(socket_path, ['compile'],
+                                                           out.fileno(), out.fileno()), 0)
+                    self.assertIs(server.dist, dist)
+                    self.assertEqual(os.stat(obj).st_mtime_ns, mtime)
+                    self.assertEqual(orchdist.daemon.build(socket_path, ['bad'],
+                                                           out.fileno(), out.fileno()), 1)
+                    out.seek(0)
+                    self.assertIn(b'error: bad command', out.read())
+            finally:
+                orchdist.daemon.stop(socket_path)
+                thread.join(10)
+                server.server_close()
+            self.assertFalse(path.exists(socket_path))
+
+    def test_export_ninja(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            dist = orchdist.OrchDistribution()
+            builder = orchdist.Builder(dist)
+            builder.target('compile')                       \
+                   .sources([path.abspath('tests/helloworld.c')])\
+                   .compile()                               \
+                   .output_dir(tmp)
+            builder.target('exe', ['compile'])              \
+                   .objects(builder.result_of('compile'))   \
+                   .target_desc(orchdist.Link.EXECUTABLE)   \
+                   .link()                                  \
+                   .output_dir(tmp)                         \
+                   .output_filename('helloworld.out')
+            builder.add('report', ['exe'])
+            reported = []
+            @builder.on('report')
+            def run(self):
+                reported.append(self.distribution.get_command_obj('compile').result)
+            builder.apply()
+            filename = path.join(tmp, 'build.ninja')
+            dist.export_ninja(filename, ['report'], script='setup.py')
+            obj = dist.get_command_obj('compile').result[0]
+            self.assertFalse(path.exists(obj))
+            with open(filename) as f:
+                lines = f.read().splitlines()
+            self.assertIn('build %s: cc %s' % (obj.replace(':', '$:'),
+                                                path.abspath('tests/helloworld.c').replace(':', '$:')),
+                          lines)
+            self.assertIn('  depfile = ' + obj + '.d', lines)
+            self.assertIn('build exe: phony ' + path.join(tmp, 'helloworld.out'), lines)
+            self.assertIn('build report: phony .orchdist/report.stamp', lines)
+            self.assertEqual(lines[-1], 'default report')
+            cmds = [line[len('  cmd = '):].replace('$$', '$') for line in lines
+                    if line.startswith('  cmd = ')]
+            self.assertIn('-m orchdist.ninja --stamp .orchdist/report.stamp', cmds[-1])
+            os.makedirs(path.dirname(obj))
+            for cmd in cmds[:-1]:
+                subprocess.check_call(cmd, shell=True)
+            self.assertEqual(subprocess.check_output([path.join(tmp, 'helloworld.out')],
+                                                     universal_newlines=True), 'HelloWorld!\n')
+
+            dist = orchdist.OrchDistribution()
+            builder.apply(dist)
+            stamp = path.join(tmp, 'report.stamp')
+            orchdist.ninja.NinjaExporter(dist, 'setup.py').run_step('report', stamp)
+            self.assertEqual(reported, [[obj]])
+            self.assertTrue(path.exists(stamp))
+            self.assertTrue(dist.have_run.get('compile'))
+
+    def test_export_ninja_depfiles(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            header = path.join(tmp, 'value.h')
+            with open(header, 'w') as f:
+                f.write('#define VALUE 1\n')
+            source = path.join(tmp, 'a.c')
+            with open(source, 'w') as f:
+                f.write('#include "value.h"\nint a(void){return VALUE;}\n')
+            with open(path.join(tmp, 'common.h'), 'w') as f:
+                f.write('#include "value.h"\n')
+            dist = orchdist.OrchDistribution()
+            builder = orchdist.Builder(dist)
+            builder.target('pp')                                    \
+                   .source(source)                                  \
+                   .preprocess()                                    \
+                   .output_file(path.join(tmp, 'pp', 'a.c'))        \
+                   .in_memory(True)
+            builder.target('pch')                                   \
+                   .header(path.join(tmp, 'common.h'))              \
+                   .precompile_header()                             \
+                   .output_dir(path.join(tmp, 'pch'))
+            builder.apply()
+            compiler = orchdist.CompilerPool.configure(None, None, 0, 0, 0)
+            for command, output in (('pp', path.join(tmp, 'pp', 'a.c')),
+                                    ('pch', path.join(tmp, 'pch', 'common.h.gch'))):
+                (outputs, inputs, cmds, depfile), = \
+                    dist.get_command_obj(command).ninja_edges(compiler)
+                self.assertEqual(outputs, [output])
+                self.assertEqual(depfile, output + '.d')
+                os.makedirs(path.dirname(output), exist_ok=True)
+                for cmd in cmds:
+                    subprocess.check_call(cmd)
+                self.assertTrue(path.exists(output))
+                with open(depfile) as f:
+                    self.assertIn(header, f.read())
+
+    def test_build_db(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = path.join(tmp, 'main.c')
+            header = path.join(tmp, 'main.h')
+            with open(source, 'w') as f:
+                f.write('#include "main.h"\nint main(void){return VALUE;}\n')
+            with open(header, 'w') as f:
+                f.write('#define VALUE 0\n')
+            def build():
+                dist = orchdist.OrchDistribution(build_db=path.join(tmp, 'build.db'))
+                builder = orchdist.Builder(dist)
+                builder.target('compile')                   \
+                       .sources([source])                   \
+                       .compile()                           \
+                       .output_dir(path.join(tmp, 'obj'))
+                builder.target('exe', ['compile'])          \
+                       .objects(builder.result_of('compile'))\
+                       .target_desc(orchdist.Link.EXECUTABLE)\
+                       .link()                              \
+                       .output_dir(tmp)                     \
+                       .output_filename('main.out')
+                builder.apply()
+                dist.run_commands()
+                return dist.get_command_obj('compile').result
+            objects = build()
+            self.assertEqual(len(objects), 1)
+            stamps = [os.stat(f).st_mtime_ns for f in objects + [path.join(tmp, 'main.out')]]
+            time.sleep(0.01)
+            self.assertEqual(build(), objects)
+            self.assertEqual([os.stat(f).st_mtime_ns for f in objects + [path.join(tmp, 'main.out')]], stamps)
+            with open(header, 'w') as f:
+                f.write('#define VALUE 1\n')
+            self.assertEqual(build(), objects)
+            self.assertNotEqual(os.stat(objects[0]).st_mtime_ns, stamps[0])
+            self.assertEqual(subprocess.call([path.join(tmp, 'main.out')]), 1)
+            # headers found through include flags of the compiler
+            self.assertEqual(orchdist.BuildC.flag_include_dirs(
+                ['-O2', '-Ia', '-I', 'b', '-isystem', 'c', '-iquoted', '-DI']), ['a', 'b', 'c', 'd'])
+            os.mkdir(path.join(tmp, 'inc'))
+            with open(path.join(tmp, 'inc', 'v.h'), 'w') as f:
+                f.write('#define VALUE 2\n')
+            with open(source, 'w') as f:
+                f.write('#include <v.h>\nint main(void){return VALUE;}\n')
+            for value in (2, 3):
+                with open(path.join(tmp, 'inc', 'v.h'), 'w') as f:
+                    f.write('#define VALUE %d\n' % value)
+                dist = orchdist.OrchDistribution(build_db=path.join(tmp, 'build.db'))
+                builder = orchdist.Builder(dist)
+                builder.target('exe')                        \
+                       .sources([source])                    \
+                       .compile()                            \
+                       .output_dir(path.join(tmp, 'obj'))    \
+                       .extra_preargs(['-I' + path.join(tmp, 'inc')])
+                builder.apply()
+                dist.run_commands()
+                self.assertIn(path.join(tmp, 'inc', 'v.h'),
+                              dist.get_command_obj('exe').input_files())
+                self.assertNotEqual(os.stat(objects[0]).st_mtime_ns, stamps[0])
+                stamps[0] = os.stat(objects[0]).st_mtime_ns
+            # built, then taken from the database
+            for _ in range(2):
+                dist = orchdist.OrchDistribution(build_db=path.join(tmp, 'build.db'))
+                builder = orchdist.Builder(dist)
+                builder.target('lib')                        \
+                       .objects(objects)                     \
+                       .static_link()                        \
+                       .output_dir(tmp)                      \
+                       .output_libname('v')
+                builder.apply()
+                with mock.patch.object(orchdist.log, 'warn') as warn:
+                    dist.run_commands()
+                    self.assertEqual(dist.get_command_obj('lib').output_files(),
+                                     [path.join(tmp, 'libv.a')])
+                    dist.input_index()
+                warn.assert_not_called()
+
+    def test_build_c_run(self):
+        # a subclass doing its work in ``run`` without ``build``
+        class MyBuild(orchdist.BuildC):
+            def run(self):
+                super().run()
+                compiler = self.new_compiler()
+                self.result = compiler.compiler_type
+                self.release_compiler(compiler)
+
+        for asynchronous in (False, True):
+            dist = orchdist.OrchDistribution(build_db=None)
+            dist.register_cmdclass('my', MyBuild)
+            if asynchronous:
+                event_loop = asyncio.new_event_loop()
+                try:
+                    event_loop.run_until_complete(dist.run_commands_async(['my']))
+                finally:
+                    event_loop.close()
+            else:
+                dist.run_command('my')
+            self.assertEqual(dist.get_command_obj('my').result, 'unix')
+
+    def test_map_jobs(self):
+        for max_workers in (1, 4):
+            crt = orchdist.CommandCreator()
+            crt.add('a')
+            threads = set()
+            results = []
+            def job(n):
+                time.sleep(0.02)
+                threads.add(orchdist.threading.get_ident())
+                return n * n
+            @crt.on('a')
+            def run(self):
+                results.extend(self.distribution.map_jobs(job, range(8)))
+            dist = orchdist.OrchDistribution(max_workers=max_workers)
+            dist.register_cmdclasses(crt.create_all())
+            dist.run_command('a')
+            self.assertEqual(results, [n * n for n in range(8)])
+            self.assertEqual(len(threads), max_workers)
+        # jobs take the slots of the scheduler, limited by ``resources`` or ``adaptive``
+        running = []
+        peaks = []
+        lock = threading.Lock()
+        def job(n):
+            with lock:
+                running.append(n)
+                peaks.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(n)
+        crt = orchdist.CommandCreator()
+        crt.add('a')
+        crt.on('a', 'run', lambda self: self.distribution.map_jobs(job, range(8)))
+        overloaded = orchdist.adaptive.AdaptiveLimit(sampler=lambda: {'load': 1000.0})
+        for kwargs, peak in (({'resources': {'slots': 1}}, 1),
+                             ({'resources': {'slots': 3}}, 3),
+                             ({'adaptive': overloaded}, 1)):
+            del peaks[:]
+            dist = orchdist.OrchDistribution(max_workers=8, **kwargs)
+            dist.register_cmdclasses(crt.create_all())
+            dist.run_command('a')
+            self.assertEqual(max(peaks), peak)
+
+    def test_jobserver(self):
+        crt = orchdist.CommandCreator()
+        running = []
+        peak = []
+        lock = threading.Lock()
+        for i in range(6):
+            crt.add('c%d' % i)
+            @crt.on('c%d' % i)
+            def run(self):
+                with lock:
+                    running.append(self)
+                    peak.append(len(running))
+                time.sleep(0.05)
+                with lock:
+                    running.remove(self)
+        server = orchdist.jobserver.Jobserver.serve(2)
+        makeflags = os.environ.get('MAKEFLAGS')
+        os.environ['MAKEFLAGS'] = server.makeflags('-k')
+        try:
+            dist = orchdist.OrchDistribution(max_workers=8)
+            dist.register_cmdclasses(crt.create_all())
+            dist.add_commands(*('c%d' % i for i in range(6)))
+            dist.run_commands()
+        finally:
+            if makeflags is None:
+                del os.environ['MAKEFLAGS']
+            else:
+                os.environ['MAKEFLAGS'] = makeflags
+        self.assertEqual(max(peak), 2)
+        self.assertIsNotNone(server.acquire(blocking=False))
+        self.assertIsNone(server.acquire(blocking=False))
+        server.close()
+
+        child = ('import sys, orchdist.jobserver; '
+                 'jobserver = orchdist.jobserver.Jobserver.from_environ(); '
+                 'sys.exit(jobserver is None or jobserver.acquire(blocking=False) is None)')
+        crt = orchdist.CommandCreator()
+        crt.add('make')
+        @crt.on('make')
+        def run(self):
+            self.distribution.spawn([sys.executable, '-c', child])
+        dist = orchdist.OrchDistribution(max_workers=3, jobserver='pipe')
+        dist.register_cmdclasses(crt.create_all())
+        dist.run_command('make')
+        self.assertEqual(os.environ.get('MAKEFLAGS'), makeflags)
+
+    def test_resources(self):
+        crt = orchdist.CommandCreator()
+        running = []
+        peaks = {'all': [], 'link': [], 'big': []}
+        lock = threading.Lock()
+        commands = ['big'] + ['l%d' % i for i in range(4)] + ['c%d' % i for i in range(4)]
+        for name in commands:
+            crt.add(name)
+            @crt.on(name)
+            def run(self):
+                name = self.get_command_name()
+                with lock:
+                    running.append(name)
+                    peaks['all'].append(len(running))
+                    peaks['link'].append(sum(cmd.startswith('l') for cmd in running))
+                    if name == 'big':
+                        peaks['big'].append(len(running))
+                time.sleep(0.05)
+                with lock:
+                    running.remove(name)
+        classes = crt.create_all()
+        classes['big'].resources = {'slots': 8, 'memory': 1 << 60}
+        for i in range(4):
+            classes['l%d' % i].resources = {'link': 1}
+        dist = orchdist.OrchDistribution(max_workers=4, resources={'link': 2})
+        dist.register_cmdclasses(classes)
+        dist.add_commands(*commands)
+        dist.run_commands()
+        self.assertEqual(max(peaks['link']), 2)
+        self.assertEqual(max(peaks['all']), 4)
+        self.assertEqual(peaks['big'], [1])
+        self.assertEqual(dist.get_command_obj('big').resources['slots'], 8)
+        # ``slots`` given in ``resources`` bounds the commands running at a time
+        del peaks['all'][:]
+        dist = orchdist.OrchDistribution(max_workers=8, resources={'slots': 2})
+        dist.register_cmdclasses(classes)
+        dist.add_commands(*commands[1:])
+        dist.run_commands()
+        self.assertEqual(max(peaks['all']), 2)
+
+    def test_adaptive(self):
+        loads = {'load': 100.0}
+        limit = orchdist.adaptive.AdaptiveLimit(min_workers=1, max_load=4, interval=0.01,
+                                                sampler=lambda: dict(loads))
+        self.assertEqual(limit.start(8), 1)
+        loads['load'] = 1.0
+        self.assertEqual(limit.update(0), 1)
+        self.assertEqual(limit.update(1), 2)
+        self.assertEqual(limit.start(8), 3)
+        loads['load'] = 6.0
+        self.assertEqual(limit.update(3), 2)
+        self.assertEqual(limit.update(3), 1)
+        self.assertEqual(limit.update(3), 1)
+        loads.update(load=None, memory=0)
+        self.assertTrue(limit.overloaded(loads))
+        for load, peak in ((100.0, 1), (0.0, 4)):
+            crt = orchdist.CommandCreator()
+            running = []
+            peaks = []
+            lock = threading.Lock()
+            commands = ['c%d' % i for i in range(12)]
+            for name in commands:
+                crt.add(name)
+                @crt.on(name)
+                def run(self):
+                    with lock:
+                        running.append(self)
+                        peaks.append(len(running))
+                    time.sleep(0.03)
+                    with lock:
+                        running.remove(self)
+            dist = orchdist.OrchDistribution(max_workers=4, adaptive=dict(
+                max_load=4, interval=0.01, sampler=lambda: {'load': load}))
+            crt.apply(dist)
+            dist.run_commands()
+            self.assertEqual(max(peaks), peak)
+
+    def test_listeners(self):
+        events = []
+        class Recorder(orchdist.BuildListener):
+            def on_ready(self, command, timestamp):
+                events.append(('ready', command))
+            def on_start(self, command, timestamp):
+                events.append(('start', command))
+            def on_finish(self, command, timestamp, duration):
+                events.append(('finish', command))
+            def on_error(self, command, timestamp, error):
+                events.append(('error', command, str(error)))
+            def on_build_finish(self, scheduler, timestamp):
+                raise RuntimeError('ignored')
+        crt = orchdist.CommandCreator()
+        crt.add('a')
+        crt.add('b', ['a'])
+        crt.add('bad')
+        @crt.on('bad')
+        def run(self):
+            raise orchdist.DistutilsExecError('bad command')
+        with tempfile.TemporaryDirectory() as tmp:
+            out = io.StringIO()
+            metrics = path.join(tmp, 'orchdist.prom')
+            dist = orchdist.OrchDistribution(listeners=[
+                Recorder(), orchdist.progress.ProgressReporter(out),
+                orchdist.progress.PrometheusExporter(metrics, labels={'job': 'test'})])
+            crt.apply(dist)
+            dist.run_command('b')
+            self.assertEqual(events, [('ready', 'a'), ('start', 'a'), ('finish', 'a'),
+                                      ('ready', 'b'), ('start', 'b'), ('finish', 'b')])
+            self.assertEqual(out.getvalue().splitlines()[-1], '[2/2 100%] b')
+            with open(metrics) as f:
+                content = f.read()
+            self.assertIn('# TYPE orchdist_commands_finished gauge\n'
+                          'orchdist_commands_finished{job="test"} 2.0\n', content)
+            self.assertNotIn('orchdist_commands_failed{job="test"} 1.0', content)
+            del events[:]
+            with self.assertRaises(orchdist.DistutilsExecError):
+                dist.run_command('bad')
+            self.assertEqual(events, [('ready', 'bad'), ('start', 'bad'),
+                                      ('error', 'bad', 'bad command')])
+            self.assertEqual(out.getvalue().splitlines()[-1], '[1/1 100%] bad failed, 1 failed')
+            with open(metrics) as f:
+                self.assertIn('orchdist_commands_failed{job="test"} 1.0', f.read())
+
+    def test_parallel_compile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            sources = []
+            for i in range(4):
+                sources.append(path.join(tmp, 'f%d.c' % i))
+                with open(sources[-1], 'w') as f:
+                    f.write('int f%d(void){return %d;}\n' % (i, i))
+            dist = orchdist.OrchDistribution(max_workers=4)
+            builder = orchdist.Builder(dist)
+            builder.target('compile')                       \
+                   .sources(sources)                        \
+                   .compile()                               \
+                   .output_dir(tmp)
+            builder.apply()
+            dist.run_commands()
+            objects = dist.get_command_obj('compile').result
+            self.assertEqual(len(objects), 4)
+            for source, obj in zip(sources, objects):
+                self.assertIn(path.splitext(path.basename(source))[0], obj)
+                self.assertTrue(path.exists(obj))
+
+    def test_priority(self):
+        crt = orchdist.CommandCreator()
+        result = []
+        crt.add('s1')
+        crt.add('s2')
+        crt.add('x1')
+        crt.add('x2', ['x1'])
+        crt.add('x3', ['x2'])
+        for cmd in ('s1', 's2', 'x1', 'x2', 'x3'):
+            crt.on(cmd, 'run', lambda self: result.append(self.get_command_name()))
+        crt.create('x1').cost = 10
+        def run(priority, durations=None):
+            del result[:]
+            dist = orchdist.OrchDistribution(max_workers=1, priority=priority)
+            dist.register_cmdclasses(crt.create_all())
+            dist.add_commands('s1', 's2', 'x3')
+            if durations is not None:
+                dist.durations.update(durations)
+            dist.run_commands()
+            return dist
+        run(False)
+        self.assertEqual(result, ['s1', 's2', 'x1', 'x2', 'x3'])
+        dist = run(True)
+        self.assertEqual(result, ['x1', 'x2', 's1', 's2', 'x3'])
+        self.assertEqual(set(dist.durations), set(result))
+        run(True, {'s2': 100})
+        self.assertEqual(result, ['s2', 'x1', 'x2', 's1', 'x3'])
+
+    def test_history(self):
+        crt = orchdist.CommandCreator()
+        crt.add('a')
+        crt.add('b', ['a'])
+        crt.add('bad')
+        @crt.on('a')
+        def run(self):
+            time.sleep(0.05)
+        @crt.on('bad')
+        def run(self):
+            raise ValueError('bad')
+        with tempfile.TemporaryDirectory() as tmp:
+            history_file = path.join(tmp, 'history.json')
+            dist = orchdist.OrchDistribution(history_file=history_file)
+            dist.register_cmdclasses(crt.create_all())
+            dist.run_command('b')
+            with self.assertRaises(ValueError):
+                dist.run_command('bad')
+            self.assertEqual([record['command'] for record in dist.records], ['a', 'b', 'bad'])
+            self.assertEqual(dist.records[2]['error'], repr(ValueError('bad')))
+            self.assertLessEqual(dist.records[0]['end'], dist.records[1]['start'])
+            history = orchdist.BuildHistory(history_file)
+            self.assertEqual(len(history.runs), 2)
+            self.assertEqual(set(history.durations()), {'a', 'b'})
+            self.assertGreaterEqual(history.durations()['a'], 0.05)
+            dist = orchdist.OrchDistribution(history_file=history_file)
+            self.assertEqual(dist.durations, history.durations())
+            trace_file = path.join(tmp, 'trace.json')
+            dist.records = history.runs[0]
+            dist.export_trace(trace_file)
+            with open(trace_file) as f:
+                events = json.load(f)['traceEvents']
+            self.assertEqual([event['name'] for event in events if event['ph'] == 'X'], ['a', 'b'])
+            self.assertIn('M', [event['ph'] for event in events])
+
+    def test_process_executor(self):
+        crt = orchdist.CommandCreator()
+        crt.add('a')
+        crt.add('square', ['a'])
+        result = []
+        @crt.on('a')
+        def run(self):
+            result.append(os.getpid())
+        dist = orchdist.OrchDistribution()
+        dist.register_cmdclasses(crt.create_all())
+        dist.register_cmdclass('square', SquareInProcess)
+        SquareInProcess.sub_commands = [('a', None)]
+        try:
+            dist.run_command('square')
+        finally:
+            SquareInProcess.sub_commands = []
+        self.assertEqual(result, [os.getpid()])
+        pid, value = dist.get_command_obj('square').result
+        self.assertNotEqual(pid, os.getpid())
+        self.assertEqual(value, 49)
+        self.assertTrue(dist.have_run.get('square'))
+        dist = orchdist.OrchDistribution(executor='fiber')
+        dist.register_cmdclasses(crt.create_all())
+        with self.assertRaises(ValueError):
+            dist.run_command('a')
+
+    def test_run_commands_async(self):
+        crt = orchdist.CommandCreator()
+        leaves = ['leaf%d' % i for i in range(50)]
+        for leaf in leaves:
+            crt.add(leaf)
+        crt.add('root', leaves)
+        threads = set()
+        result = []
+        async def run(self):
+            threads.add(threading.get_ident())
+            await asyncio.sleep(0.1)
+            result.append(self.get_command_name())
+        for cmd in leaves + ['root']:
+            crt.on(cmd, 'run', run)
+        dist = orchdist.OrchDistribution(max_workers=50)
+        dist.register_cmdclasses(crt.create_all())
+        dist.add_commands('root')
+        event_loop = asyncio.new_event_loop()
+        try:
+            start = time.time()
+            event_loop.run_until_complete(dist.run_commands_async())
+            self.assertLess(time.time() - start, 1)
+        finally:
+            event_loop.close()
+        self.assertEqual(threads, {threading.get_ident()})
+        self.assertEqual(set(result[:-1]), set(leaves))
+        self.assertEqual(result[-1], 'root')
+        self.assertTrue(dist.have_run.get('root'))
+
+    def test_build_async(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            sources = []
+            for i in range(3):
+                sources.append(path.join(tmp, 'f%d.c' % i))
+                with open(sources[-1], 'w') as f:
+                    f.write('int f%d(void){return %d;}\n' % (i, i))
+            with open(path.join(tmp, 'main.c'), 'w') as f:
+                f.write('int f2(void);\nint main(void){return f2();}\n')
+            with open(path.join(tmp, 'bad.c'), 'w') as f:
+                f.write('syntax error\n')
+            dist = orchdist.OrchDistribution()
+            builder = orchdist.Builder(dist)
+            builder.target('compile')                       \
+                   .sources(sources + [path.join(tmp, 'main.c')])\
+                   .compile()                               \
+                   .output_dir(tmp)
+            builder.target('static', ['compile'])           \
+                   .objects(builder.result_of('compile'))   \
+                   .static_link()                           \
+                   .output_dir(tmp)                         \
+                   .output_libname('f')
+            builder.target('exe', ['compile'])              \
+                   .objects(builder.result_of('compile'))   \
+                   .target_desc(orchdist.Link.EXECUTABLE)   \
+                   .link()                                  \
+                   .output_dir(tmp)                         \
+                   .output_filename('main.out')
+            builder.target('bad')                           \
+                   .sources([path.join(tmp, 'bad.c')])      \
+                   .compile()                               \
+                   .output_dir(tmp)
+            builder.apply()
+            event_loop = asyncio.new_event_loop()
+            try:
+                event_loop.run_until_complete(dist.run_commands_async(['static', 'exe']))
+                with self.assertRaises(orchdist.CompileError):
+                    event_loop.run_until_complete(dist.run_commands_async(['bad']))
+            finally:
+                event_loop.close()
+            self.assertEqual(len(dist.get_command_obj('compile').result), 4)
+            self.assertTrue(path.exists(path.join(tmp, 'libf.a')))
+            self.assertEqual(subprocess.call([path.join(tmp, 'main.out')]), 2)
+
+    def test_compiler_pool(self):
+        configured = []
+        configure = orchdist.CompilerPool.__dict__['configure']
+        def counting_configure(*key):
+            configured.append(key)
+            return configure.__func__(orchdist.CompilerPool, *key)
+        orchdist.CompilerPool.configure = staticmethod(counting_configure)
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                dist = orchdist.OrchDistribution(max_workers=4)
+                builder = orchdist.Builder(dist)
+                for i in range(8):
+                    source = path.join(tmp, 'f%d.c' % i)
+                    with open(source, 'w') as f:
+                        f.write('int f%d(void){return %d;}\n' % (i, i))
+                    builder.target('compile%d' % i)         \
+                           .sources([source])               \
+                           .compile()                       \
+                           .output_dir(tmp)
+                builder.apply()
+                dist.run_commands()
+                self.assertEqual(len(configured), 1)
+                pool = dist.compiler_pool
+                self.assertEqual(pool.keys, {})
+                key = configured[0]
+                compiler = pool.acquire(key)
+                compiler.force = 1
+                pool.release(compiler)
+                self.assertIs(pool.acquire(key), compiler)
+                self.assertEqual(compiler.force, key[4])
+        finally:
+            orchdist.CompilerPool.configure = configure
+
+    def test_keep_going(self):
+        crt = orchdist.CommandCreator()
+        crt.add('bad')
+        crt.add('after_bad', ['bad'])
+        crt.add('good1')
+        crt.add('good2', ['good1'])
+        result = []
+        class BadGuy(Exception):
+            pass
+        @crt.on('bad')
+        def run(self):
+            raise BadGuy
+        for cmd in ('after_bad', 'good1', 'good2'):
+            crt.on(cmd, 'run', lambda self: result.append(self.get_command_name()))
+        dist = orchdist.OrchDistribution(max_workers=1, keep_going=True)
+        dist.register_cmdclasses(crt.create_all())
+        dist.add_commands('after_bad', 'good2')
+        with self.assertRaises(orchdist.CommandsFailed) as cm:
+            dist.run_commands()
+        self.assertEqual([cmd for cmd, _ in cm.exception.errors], ['bad'])
+        self.assertIsInstance(cm.exception.errors[0][1], BadGuy)
+        self.assertEqual(cm.exception.skipped, ['after_bad'])
+        self.assertEqual(result, ['good1', 'good2'])
+        self.assertEqual(dist.is_running, {})
+        with self.assertRaises(ValueError):
+            orchdist.OrchDistribution(keep_going=True, fail_fast=True)
+
+    def test_fail_fast(self):
+        crt = orchdist.CommandCreator()
+        crt.add('slow_process')
+        crt.add('slow_coroutine')
+        crt.add('bad')
+        finished = []
+        class BadGuy(Exception):
+            pass
+        @crt.on('slow_process')
+        def run(self):
+            self.distribution.spawn(['sleep', '10'])
+            finished.append('slow_process')
+        @crt.on('slow_coroutine')
+        async def run(self):
+            await asyncio.sleep(10)
+            finished.append('slow_coroutine')
+        @crt.on('bad')
+        def run(self):
+            time.sleep(0.2)
+            raise BadGuy
+        dist = orchdist.OrchDistribution(fail_fast=True)
+        dist.register_cmdclasses(crt.create_all())
+        dist.add_commands('slow_process', 'slow_coroutine', 'bad')
+        start = time.time()
+        with self.assertRaises(BadGuy):
+            dist.run_commands()
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(finished, [])
+        self.assertFalse(dist.cancelled)
+        self.assertEqual(dist.processes, set())
+
+    def test_artifact_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = orchdist.LocalArtifactCache(path.join(tmp, 'cache'))
+            def build(checkout, run_async=False, debug=False):
+                os.makedirs(path.join(checkout, 'include'))
+                with open(path.join(checkout, 'include', 'value.h'), 'w') as f:
+                    f.write('#define VALUE 3\n')
+                sources = []
+                for name, code in (('main.c', 'int f(void);\nint main(void){return f();}\n'),
+                                   ('f.c', '#include "value.h"\nint f(void){return VALUE;}\n')):
+                    sources.append(path.join(checkout, name))
+                    with open(sources[-1], 'w') as f:
+                        f.write(code)
+                dist = SpawnRecorder(artifact_cache=cache)
+                builder = orchdist.Builder(dist)
+                builder.target('compile')                   \
+                       .sources(sources)                    \
+                       .include_dirs([path.join(checkout, 'include')])\
+                       .compile()                           \
+                       .output_dir(checkout)                \
+                       .extra_postargs([] if debug else ['-g0'])
+                builder.target('exe', ['compile'])          \
+                       .objects(builder.result_of('compile'))\
+                       .target_desc(orchdist.Link.EXECUTABLE)\
+                       .link()                              \
+                       .output_dir(checkout)                \
+                       .output_filename('main.out')
+                builder.apply()
+                if run_async:
+                    event_loop = asyncio.new_event_loop()
+                    try:
+                        event_loop.run_until_complete(dist.run_commands_async())
+                    finally:
+                        event_loop.close()
+                else:
+                    dist.run_commands()
+                self.assertEqual(subprocess.call([path.join(checkout, 'main.out')]), 3)
+                self.assertEqual([path.exists(obj) for obj in dist.get_command_obj('compile').result],
+                                 [True, True])
+                return [cmd for cmd in dist.spawned if '-E' not in cmd]
+            self.assertEqual(len(build(path.join(tmp, 'checkout1'))), 3)
+            self.assertEqual(build(path.join(tmp, 'checkout2')), [])
+            self.assertEqual(build(path.join(tmp, 'checkout3'), True), [])
+            # objects with debugging information record the paths of their checkout
+            self.assertEqual(len(build(path.join(tmp, 'checkout4'), debug=True)), 3)
+            self.assertEqual(len(build(path.join(tmp, 'checkout5'), debug=True)), 3)
+            # the version of the compiler is part of the keys
+            compiler = orchdist.CompilerPool.configure(None, None, 0, 0, 0)
+            identity = orchdist.BuildC.compiler_identity(compiler)
+            with mock.patch.object(orchdist.CompilerPool, 'versions', {}), \
+                    mock.patch('subprocess.run') as run:
+                run.return_value = subprocess.CompletedProcess([], 0, b'cc 99.0\n')
+                self.assertNotEqual(orchdist.BuildC.compiler_identity(compiler), identity)
+                self.assertEqual(orchdist.CompilerPool.program_version(compiler.compiler_so[0]),
+                                 'cc 99.0\n')
+
+    def test_artifact_cache_libraries(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = orchdist.LocalArtifactCache(path.join(tmp, 'cache'))
+            def build(checkout, value, libraries=('v',)):
+                os.makedirs(checkout)
+                with open(path.join(checkout, 'v.c'), 'w') as f:
+                    f.write('int v(void){return %d;}\n' % value)
+                with open(path.join(checkout, 'main.c'), 'w') as f:
+                    f.write('int v(void);\nint main(void){return v();}\n')
+                os.chdir(checkout)
+                try:
+                    dist = orchdist.OrchDistribution(artifact_cache=cache)
+                    builder = orchdist.Builder(dist)
+                    for name in ('v', 'main'):
+                        builder.target('c' + name).sources([name + '.c']).compile().output_dir('.')
+                    builder.target('libv', ['cv'])                  \
+                           .objects(builder.result_of('cv'))        \
+                           .static_link()                           \
+                           .output_dir('.')                         \
+                           .output_libname('v')
+                    builder.target('exe', ['cmain', 'libv'])        \
+                           .objects(builder.result_of('cmain'))     \
+                           .libraries(list(libraries))              \
+                           .library_dirs(['.'])                     \
+                           .target_desc(orchdist.Link.EXECUTABLE)   \
+                           .link()                                  \
+                           .output_filename('main.out')
+                    builder.apply()
+                    dist.run_command('exe')
+                    cmd_obj = dist.get_command_obj('exe')
+                    self.assertIn(path.join('.', 'libv.a'), cmd_obj.input_files())
+                    return subprocess.call([path.join(checkout, 'main.out')]), cmd_obj
+                finally:
+                    os.chdir(cwd)
+            self.assertEqual(build(path.join(tmp, 'a'), 1)[0], 1)
+            self.assertEqual(build(path.join(tmp, 'b'), 2)[0], 2)
+            self.assertEqual(build(path.join(tmp, 'c'), 1)[0], 1)
+            # a library not found in library_dirs keeps the link out of the cache
+            status, cmd_obj = build(path.join(tmp, 'd'), 1, ('v', 'c'))
+            compiler = cmd_obj.new_compiler()
+            self.assertIsNone(cmd_obj.output_artifact(compiler))
+            cmd_obj.release_compiler(compiler)
+
+    def test_local_artifact_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = orchdist.LocalArtifactCache(tmp, max_size=10)
+            cache.put('aa', b'1234')
+            time.sleep(0.01)
+            cache.put('bb', b'1234')
+            time.sleep(0.01)
+            self.assertEqual(cache.get('aa'), b'1234')
+            time.sleep(0.01)
+            cache.put('cc', b'1234')
+            self.assertEqual(cache.get('aa'), b'1234')
+            self.assertIsNone(cache.get('bb'))
+            self.assertEqual(cache.get('cc'), b'1234')
+            self.assertEqual(cache.size, 8)
+
+    def test_http_artifact_cache(self):
+        server = http.server.HTTPServer(('127.0.0.1', 0), ArtifactHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                url = 'http://127.0.0.1:%d/artifacts' % server.server_address[1]
+                remote = orchdist.HTTPArtifactCache(url)
+                self.assertIsNone(remote.get('missing'))
+                remote.put('key', b'object')
+                self.assertEqual(remote.get('key'), b'object')
+                local = orchdist.LocalArtifactCache(tmp)
+                tiered = orchdist.TieredArtifactCache(local, remote)
+                self.assertEqual(tiered.get('key'), b'object')
+                self.assertEqual(local.get('key'), b'object')
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertIsNone(orchdist.HTTPArtifactCache(url, timeout=1).get('key'))
+
+    def test_remote_workers(self):
+        lock = threading.Lock()
+        jobs = []
+
+        class WorkerServer(orchdist.remote.WorkerServer):
+            def compile(self, header, payload):
+                with lock:
+                    jobs.append(header['argv'])
+                return super().compile(header, payload)
+
+        servers = [WorkerServer(('127.0.0.1', 0), slots=2) for _ in range(2)]
+        threads = [threading.Thread(target=server.serve_forever) for server in servers]
+        for thread in threads:
+            thread.start()
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                sources = []
+                for i in range(4):
+                    sources.append(path.join(tmp, 'f%d.c' % i))
+                    with open(sources[-1], 'w') as f:
+                        f.write('#include "value.h"\nint f%d(void){return VALUE + %d;}\n' % (i, i))
+                with open(path.join(tmp, 'value.h'), 'w') as f:
+                    f.write('#define VALUE 10\n')
+                with open(path.join(tmp, 'main.c'), 'w') as f:
+                    f.write('int f3(void);\nint main(void){return f3();}\n')
+                workers = ['127.0.0.1:1'] + ['127.0.0.1:%d' % server.server_address[1]
+                                             for server in servers]
+                dist = orchdist.OrchDistribution(max_workers=4, remote_workers=workers)
+                builder = orchdist.Builder(dist)
+                builder.target('compile')                   \
+                       .sources(sources + [path.join(tmp, 'main.c')])\
+                       .compile()                           \
+                       .output_dir(path.join(tmp, 'obj'))
+                builder.target('exe', ['compile'])          \
+                       .objects(builder.result_of('compile'))\
+                       .target_desc(orchdist.Link.EXECUTABLE)\
+                       .link()                              \
+                       .output_dir(tmp)                     \
+                       .output_filename('main.out')
+                builder.apply()
+                dist.run_commands()
+                self.assertEqual(subprocess.call([path.join(tmp, 'main.out')]), 13)
+                self.assertEqual(len(jobs), 5)
+                with open(path.join(tmp, 'main.c'), 'w') as f:
+                    f.write('syntax error\n')
+                dist = orchdist.OrchDistribution(remote_workers=workers[1:])
+                with self.assertRaises(orchdist.CompileError):
+                    orchdist.Compile(dist).compile_remote(
+                        dist.compiler_pool.acquire((None, None, 0, 0, 0)),
+                        path.join(tmp, 'main.c'), [None] * 7, b'syntax error\n',
+                        path.join(tmp, 'main.o'))
+                # flags of the preprocessor are not sent, others refused are compiled locally
+                compile = orchdist.Compile(dist)
+                compiler = dist.compiler_pool.acquire((None, None, 0, 0, 0))
+                for postargs, remotely in ((['-Wp,-D_FORTIFY_SOURCE=2', '-I', tmp, '-DX'], True),
+                                           (['-frecord-gcc-switches'], False)):
+                    del jobs[:]
+                    self.assertEqual(compile.compile_remote(
+                        compiler, path.join(tmp, 'main.c'), [None] * 5 + [postargs, None],
+                        b'int main(void){return 0;}\n', path.join(tmp, 'main.o')), remotely)
+                    self.assertEqual(len(jobs), 1)
+                    self.assertFalse([arg for arg in jobs[0]
+                                      if arg.startswith(('-Wp,', '-I', '-DX')) or arg == tmp])
+        finally:
+            for server in servers:
+                server.shutdown()
+                server.server_close()
+            for thread in threads:
+                thread.join()
+
+    def test_remote_worker_argv(self):
+        remote = orchdist.remote
+        server = remote.WorkerServer(('127.0.0.1', 0), compilers={'gcc', 'true'})
+        try:
+            header = {'suffix': '.i'}
+            with mock.patch('subprocess.run') as run:
+                for argv in (['gcc', '-wrapper', 'sh,-c,id', '-c', remote.INPUT],
+                             ['gcc', '-B/tmp', '-c', remote.INPUT, '-o', remote.OUTPUT],
+                             ['gcc', '-fplugin=/tmp/p.so', '-c', remote.INPUT],
+                             ['gcc', '@/tmp/args', '-c', remote.INPUT],
+                             ['gcc', '-Wa,-adhln=/tmp/list', '-c', remote.INPUT],
+                             ['gcc', '-c', remote.INPUT, '-o', '/tmp/object.o'],
+                             ['sh', '-c', 'id']):
+                    reply, data = server.compile(dict(header, argv=argv), b'')
+                    self.assertTrue(reply['refused'])
+                    self.assertEqual(data, b'')
+                run.assert_not_called()
+            self.assertEqual(orchdist.Compile.strip_preprocessor_flags(
+                ['-O2', '-I', 'a', '-Ib', '-DNDEBUG', '-U', 'X', '-include', 'h.h', '-Wp,-DY', '-Wall']),
+                ['-O2', '-Wall'])
+            reply, data = server.compile(
+                dict(header, argv=['true', '-c', remote.INPUT, '-o', remote.OUTPUT]), b'')
+            self.assertEqual(reply['returncode'], 1)
+            self.assertIn('no object written', reply['output'])
+            reply, data = server.compile(
+                dict(header, argv=['gcc', '-Wall', '-DNDEBUG', '-O2', '-fPIC', '-std=c99',
+                                   '-c', remote.INPUT, '-o', remote.OUTPUT]),
+                b'int f(void){return 1;}\n')
+            self.assertEqual(reply['returncode'], 0)
+            self.assertTrue(data)
+        finally:
+            server.server_close()
+
 
 def suite():
     return unittest.TestLoader().loadTestsFromTestCase(TestOrchdist)